@@ -0,0 +1,82 @@
+"""Compare context archiving of docker-py with ContextArchive.
+
+docker-py walks and tars the context for every ``client.api.build(path=...)``
+call. ContextArchive scans the context once per run, reuses tar headers from
+the stat index of the previous run and streams file contents.
+
+Usage: PYTHONPATH=. python benchmarks/bench_context.py [--files N] [--size BYTES] [--configs N]
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+import docker.utils
+
+from docker_multi_build.context import ContextArchive, StatIndex
+
+
+DOCKERIGNORE = ['**/*.pyc']
+
+
+def make_context(root, files, size):
+    data = os.urandom(size)
+    for i in range(files):
+        dirname = os.path.join(root, 'pkg{}'.format(i % 100))
+        os.makedirs(dirname, exist_ok=True)
+        with open(os.path.join(dirname, 'module{}.py'.format(i)), 'wb') as fp:
+            fp.write(data)
+    with open(os.path.join(root, '.dockerignore'), 'w') as fp:
+        fp.write('\n'.join(DOCKERIGNORE))
+
+
+def docker_py(context, configs):
+    for _ in range(configs):
+        with docker.utils.tar(context, exclude=list(DOCKERIGNORE)) as fp:
+            while fp.read(1024 * 1024):
+                pass
+
+
+def context_archive(index):
+    def run(context, configs):
+        archive = ContextArchive.create(context, index)
+        for i in range(configs):
+            for _ in archive.stream('Dockerfile.{}'.format(i), 'FROM busybox'):
+                pass
+    return run
+
+
+def measure(fn, *args):
+    tracemalloc.start()
+    started = time.perf_counter()
+    fn(*args)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=10000)
+    parser.add_argument('--size', type=int, default=4096)
+    parser.add_argument('--configs', type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as context:
+        make_context(context, args.files, args.size)
+        index = StatIndex()
+        cases = [
+            ('docker-py', docker_py),
+            ('archive, cold index', context_archive(index)),
+            ('archive, warm index', context_archive(index)),
+        ]
+        print('{} files of {} bytes, {} configs'.format(args.files, args.size, args.configs))
+        for name, fn in cases:
+            elapsed, peak = measure(fn, context, args.configs)
+            print('{:<20} {:8.3f} s {:10.1f} KiB peak'.format(name, elapsed, peak / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""Measure throughput of docker_copy on a tree of small files.
+
+The archive is served from memory in socket-sized reads, so only the
+extraction is measured. Full extraction writes every member, incremental
+extraction only writes the files that differ from the ones on disk.
+
+Usage: PYTHONPATH=. python benchmarks/bench_docker_copy.py [--files N] [--size BYTES]
+"""
+import argparse
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+
+from docker_multi_build.build import docker_copy
+
+
+SOCKET_READ_SIZE = 16 * 1024
+
+
+class SocketStream(io.RawIOBase):
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), SOCKET_READ_SIZE, len(self.data) - self.pos)
+        b[:n] = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+
+class FakeContainer:
+    def __init__(self, data):
+        self.data = data
+
+    def get_archive(self, path):
+        return SocketStream(self.data), {}
+
+
+def make_archive(files, size):
+    data = os.urandom(size)
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tf:
+        dirs = set()
+        for i in range(files):
+            dirname = 'out/pkg{}'.format(i % 100)
+            if dirname not in dirs:
+                info = tarfile.TarInfo(dirname)
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                tf.addfile(info)
+                dirs.add(dirname)
+            info = tarfile.TarInfo('{}/module{}.py'.format(dirname, i))
+            info.size = size
+            info.mode = 0o644
+            tf.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=50000)
+    parser.add_argument('--size', type=int, default=1024)
+    args = parser.parse_args()
+
+    container = FakeContainer(make_archive(args.files, args.size))
+    megabytes = len(container.data) / 1024 / 1024
+    print('{} files of {} bytes, {:.1f} MiB archive'.format(args.files, args.size, megabytes))
+    with tempfile.TemporaryDirectory() as root:
+        dest = os.path.join(root, 'out')
+        cases = [
+            ('full', False, False, True),
+            ('incremental, empty', True, False, True),
+            ('incremental, same', True, False, False),
+            ('incremental, prune', True, True, False),
+        ]
+        for name, incremental, delete, clean in cases:
+            if clean:
+                shutil.rmtree(dest, ignore_errors=True)
+            started = time.perf_counter()
+            docker_copy(container, '/out/.', dest, incremental=incremental, delete=delete)
+            elapsed = time.perf_counter() - started
+            print('{:<20} {:8.3f} s {:10.0f} files/s {:8.1f} MiB/s'.format(
+                name, elapsed, args.files / elapsed, megabytes / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""Microbenchmark of the Dockerfile parser on large, continuation-heavy files.
+
+Usage: PYTHONPATH=. python benchmarks/bench_dockerfile.py [--instructions N] [--continuations N]
+"""
+import argparse
+import timeit
+
+from docker_multi_build import dockerfile
+
+
+def make_dockerfile(instructions, continuations):
+    lines = ['FROM python:3.6-alpine', '# Build dependencies']
+    for i in range(instructions):
+        lines.append('RUN apk add --no-cache package-{} \\'.format(i))
+        for j in range(continuations):
+            lines.append('    # step {}'.format(j))
+            lines.append('    && echo step-{}-{} \\'.format(i, j))
+        lines.append('    && true')
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--instructions', type=int, default=200)
+    parser.add_argument('--continuations', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    contents = make_dockerfile(args.instructions, args.continuations)
+    lines = contents.splitlines()
+    print('{} lines, {} instructions'.format(len(lines), args.instructions + 1))
+
+    def parse_uncached():
+        dockerfile.parse(contents.splitlines())
+
+    def parse_cached():
+        dockerfile.parse_contents(contents)
+
+    cases = [
+        ('tokenize', lambda: dockerfile.tokenize(lines)),
+        ('parse', parse_uncached),
+        ('parse_contents', parse_cached),
+    ]
+    for name, fn in cases:
+        best = min(timeit.repeat(fn, number=1, repeat=args.repeat))
+        print('{:<16} {:10.3f} ms'.format(name, best * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Measure how sort_configs scales with the number of configs.
+
+Every generated config is based on one of the previous configs and copies
+exports of a few others. The pairwise dependency check that sort_configs used
+to run is measured for comparison on smaller graphs.
+
+Usage: PYTHONPATH=. python benchmarks/bench_sort_configs.py [--sizes N,N,...]
+"""
+import argparse
+import random
+import time
+
+from docker_multi_build.config import BuildConfig, BuildExport, Dockerfile
+from docker_multi_build.sort_configs import get_config_dependents, sort_configs
+
+
+PAIRWISE_LIMIT = 500
+
+
+def make_configs(count, copies=3, seed=0):
+    rnd = random.Random(seed)
+    configs = []
+    for i in range(count):
+        lines = ['FROM {}'.format('stage-{}'.format(rnd.randrange(i)) if i else 'busybox')]
+        for _ in range(min(i, copies)):
+            lines.append('COPY out-{}/ /usr/src/'.format(rnd.randrange(i)))
+        lines.append('RUN make \\\n    && make install')
+        configs.append(BuildConfig('stage-{}'.format(i),
+                                   dockerfile=Dockerfile('\n'.join(lines)),
+                                   exports=[BuildExport('/out/.', 'out-{}/'.format(i))]))
+    rnd.shuffle(configs)
+    return configs
+
+
+def pairwise_dependents(configs):
+    return {config.tag: list(get_config_dependents(config, configs)) for config in configs}
+
+
+def measure(fn, *args):
+    started = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='125,250,500,1000,2000')
+    args = parser.parse_args()
+
+    print('{:>7} {:>12} {:>12}'.format('configs', 'sort_configs', 'pairwise'))
+    for size in map(int, args.sizes.split(',')):
+        configs = make_configs(size)
+        sort_elapsed = measure(sort_configs, configs)
+        if size <= PAIRWISE_LIMIT:
+            pairwise = '{:10.3f} s'.format(measure(pairwise_dependents, configs))
+        else:
+            pairwise = '{:>12}'.format('-')
+        print('{:>7} {:10.3f} s {}'.format(size, sort_elapsed, pairwise))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""In-process stand-in for docker.DockerClient, usable by Builder.
+
+Builds read the whole context stream and answer with a few events after
+a configurable latency. Containers serve archives of a configurable
+number of files of a configurable size.
+"""
+import hashlib
+import io
+import itertools
+import json
+import tarfile
+import threading
+import time
+
+import docker.errors
+
+
+class FakeClient:
+    def __init__(self, build_latency=0.0, archive_files=10, archive_file_size=1024):
+        self.api = FakeAPI(self, build_latency)
+        self.images = FakeImages()
+        self.containers = FakeContainers(self, archive_files, archive_file_size)
+
+
+class FakeAPI:
+    def __init__(self, client, build_latency):
+        self.client = client
+        self.build_latency = build_latency
+        self.lock = threading.Lock()
+        self.uploaded = 0
+
+    def build(self, fileobj, custom_context=False, dockerfile=None, tag=None, buildargs=None, rm=False, **kwargs):
+        h = hashlib.sha256()
+        size = 0
+        for chunk in fileobj:
+            h.update(chunk)
+            size += len(chunk)
+        with self.lock:
+            self.uploaded += size
+        time.sleep(self.build_latency)
+        image_id = h.hexdigest()[:12]
+        self.client.images.add(tag, 'sha256:' + h.hexdigest())
+        return self.events(tag, image_id)
+
+    def events(self, tag, image_id):
+        yield json.dumps({'stream': 'Step 1/1 : FROM busybox\n'}).encode()
+        yield json.dumps({'stream': ' ---> {}\n'.format(image_id)}).encode()
+        yield json.dumps({'stream': 'Successfully built {}\n'.format(image_id)}).encode()
+
+
+class FakeImages:
+    def __init__(self):
+        self.tags = {}
+        self.lock = threading.Lock()
+
+    def add(self, tag, image_id):
+        with self.lock:
+            self.tags[tag] = self.tags[image_id[len('sha256:'):][:12]] = image_id
+
+    def get(self, name):
+        with self.lock:
+            try:
+                return FakeImage(self.tags[name])
+            except KeyError:
+                raise docker.errors.ImageNotFound(name)
+
+
+class FakeImage:
+    def __init__(self, image_id):
+        self.id = image_id
+
+
+class FakeContainers:
+    def __init__(self, client, files, file_size):
+        self.client = client
+        self.files = files
+        self.file_size = file_size
+        self.archives = {}
+        self.ids = itertools.count()
+
+    def create(self, image):
+        return self.prepare_model({'Id': 'container{}'.format(next(self.ids)), 'Image': image})
+
+    def prepare_model(self, attrs):
+        return FakeContainer(self, attrs)
+
+    def archive(self, path):
+        # Archives are built once per path
+        data = self.archives.get(path)
+        if data is None:
+            data = self.archives[path] = make_archive(path, self.files, self.file_size)
+        return data
+
+
+class FakeContainer:
+    def __init__(self, containers, attrs):
+        self.containers = containers
+        self.attrs = attrs
+        self.id = attrs['Id']
+
+    def get_archive(self, path):
+        return io.BytesIO(self.containers.archive(path)), {}
+
+    def remove(self, **kwargs):
+        pass
+
+
+def make_archive(path, files, file_size):
+    name = path.rstrip('/').rsplit('/', 1)[-1]
+    data = b'x' * file_size
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tf:
+        info = tarfile.TarInfo(name)
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+        tf.addfile(info)
+        for i in range(files):
+            info = tarfile.TarInfo('{}/pkg{}/file{}'.format(name, i % 100, i))
+            info.size = file_size
+            info.mode = 0o644
+            tf.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
@@ -0,0 +1,62 @@
+"""Generate a synthetic docker-multi-build.yml.
+
+Images form a tree: every image has FANOUT dependents down to DEPTH
+levels. Every image with dependents exports EXPORTS paths, and each of
+its dependents copies one of them. Dockerfiles are in-line and have
+LINES instructions.
+
+Usage: PYTHONPATH=. python benchmarks/generate.py [--depth N] [--fanout N] [--exports N] [--lines N] [-o PATH]
+"""
+import argparse
+import sys
+
+
+def generate(depth=3, fanout=3, exports=1, lines=20):
+    # Return the contents of the file and the number of images
+    chunks = []
+    count = 0
+    level = [(None, None)]
+    for d in range(depth + 1):
+        next_level = []
+        for parent, copied in level:
+            tag = 'image_{}'.format(count)
+            count += 1
+            has_dependents = d < depth
+            chunks.append(image(tag, parent, copied, exports if has_dependents else 0, lines))
+            if has_dependents:
+                for i in range(fanout):
+                    out = '{}_out{}'.format(tag, i % exports) if exports else None
+                    next_level.append((tag, out))
+        level = next_level
+    return '\n'.join(chunks), count
+
+
+def image(tag, parent, copied, exports, lines):
+    instructions = ['FROM {}'.format(parent or 'alpine:3.5')]
+    if copied is not None:
+        instructions.append('COPY {} /src/'.format(copied))
+    for i in range(lines):
+        instructions.append('RUN echo {} step {} \\\n    && true'.format(tag, i))
+    doc = ['{}:'.format(tag), '  dockerfile: !inline |']
+    doc.extend('    ' + line for instruction in instructions for line in instruction.splitlines())
+    if exports:
+        doc.append('  exports:')
+        doc.extend('    - /out/{0}_out{1}:{0}_out{1}'.format(tag, j) for j in range(exports))
+    return '\n'.join(doc) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--fanout', type=int, default=3)
+    parser.add_argument('--exports', type=int, default=1)
+    parser.add_argument('--lines', type=int, default=20)
+    parser.add_argument('-o', '--output', type=argparse.FileType('w'), default=sys.stdout)
+    args = parser.parse_args()
+    contents, count = generate(args.depth, args.fanout, args.exports, args.lines)
+    args.output.write(contents)
+    print('{} images'.format(count), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
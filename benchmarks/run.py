@@ -0,0 +1,170 @@
+"""Benchmark suite that runs without a Docker daemon.
+
+Measures loading and sorting of a generated multi-build file, loading it
+from the config cache, scheduling overhead of MultiBuilder, a whole run
+of Builder against the fake client and docker_copy throughput. Results are the best of --repeat runs, saved
+as JSON along with the commit, so runs of different commits can be
+compared with --compare.
+
+Usage: PYTHONPATH=. python benchmarks/run.py [--output PATH] [--compare PATH] [options]
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+
+from docker_multi_build import config
+from docker_multi_build.build import Builder, MultiBuilder, docker_copy
+from docker_multi_build.context import ContextArchives
+from docker_multi_build.sort_configs import sort_configs
+
+from fake_docker import FakeClient, FakeContainers
+from generate import generate
+
+
+class NullBuilder:
+    def build(self, config, export=True):
+        return 'sha256:' + config.tag
+
+    def run_exports(self, config, image_id):
+        pass
+
+
+class NullOutput:
+    def write(self, tag, text):
+        pass
+
+
+def best_of(repeat, fn, setup=None):
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+
+def run(args, root):
+    contents, count = generate(args.depth, args.fanout, args.exports, args.lines)
+    path = os.path.join(root, 'docker-multi-build.yml')
+    with open(path, 'w') as fp:
+        fp.write(contents)
+
+    def load():
+        with open(path) as fp:
+            return config.load(fp)
+
+    configs = load()
+    all_dependents = sort_configs(list(configs.values()))
+    results = {'images': count}
+    results['config.load'] = best_of(args.repeat, load)
+
+    config_cache = config.ConfigCache(os.path.join(root, 'config-cache.json'))
+
+    def load_cached():
+        with open(path) as fp:
+            return config_cache.load(fp)
+
+    load_cached()
+    results['config cache hit'] = best_of(args.repeat, load_cached)
+    results['sort_configs'] = best_of(args.repeat, lambda: sort_configs(list(configs.values())))
+
+    elapsed = best_of(args.repeat, lambda: MultiBuilder(builder=NullBuilder(), jobs=args.jobs)
+                      .build_all(configs, all_dependents))
+    results['schedule per image'] = elapsed / count
+
+    def clean():
+        for name in os.listdir(root):
+            if name.endswith(tuple('_out{}'.format(i) for i in range(args.exports))):
+                shutil.rmtree(os.path.join(root, name))
+
+    def build():
+        client = FakeClient(args.latency, args.archive_files, args.archive_file_size)
+        builder = Builder(client, contexts=ContextArchives(), output=NullOutput())
+        MultiBuilder(builder=builder, jobs=args.jobs).build_all(configs, all_dependents)
+
+    results['build'] = best_of(args.repeat, build, setup=clean)
+    results['build overhead per image'] = (results['build'] - ideal_time(args)) / count
+
+    containers = FakeContainers(None, args.copy_files, args.copy_file_size)
+    container = containers.prepare_model({'Id': 'container'})
+    containers.archive('/out')
+    dest = os.path.join(root, 'copy')
+    for incremental in [False, True]:
+        name = 'docker_copy incremental' if incremental else 'docker_copy'
+        elapsed = best_of(args.repeat, lambda: docker_copy(container, '/out/.', dest, incremental=incremental),
+                          setup=None if incremental else lambda: shutil.rmtree(dest, ignore_errors=True))
+        results[name + ' files/s'] = args.copy_files / elapsed
+    return results
+
+
+def ideal_time(args):
+    # Duration of the run with no overhead: the longest chain of builds
+    return (args.depth + 1) * args.latency
+
+
+def git_revision():
+    try:
+        rev = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL)
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return rev.decode().strip() + ('-dirty' if dirty else '')
+
+
+def compare(old, new):
+    print('{:<30} {:>14} {:>14} {:>8}'.format('', old['revision'] or '?', new['revision'] or '?', 'ratio'))
+    for name, value in new['results'].items():
+        old_value = old['results'].get(name)
+        ratio = '{:8.2f}'.format(value / old_value) if old_value else ''
+        print('{:<30} {:>14.6g} {:>14.6g} {}'.format(name, old_value or float('nan'), value, ratio))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--fanout', type=int, default=3)
+    parser.add_argument('--exports', type=int, default=1)
+    parser.add_argument('--lines', type=int, default=20)
+    parser.add_argument('--jobs', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.01, help='build latency in seconds')
+    parser.add_argument('--archive-files', type=int, default=10)
+    parser.add_argument('--archive-file-size', type=int, default=1024)
+    parser.add_argument('--copy-files', type=int, default=10000)
+    parser.add_argument('--copy-file-size', type=int, default=1024)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', metavar='PATH', help='save results as JSON')
+    parser.add_argument('--compare', metavar='PATH', help='compare with results saved by another run')
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    revision = git_revision()
+    with tempfile.TemporaryDirectory() as root:
+        # Exports are written relative to the multi-build file
+        os.chdir(root)
+        try:
+            results = run(args, root)
+        finally:
+            os.chdir(cwd)
+
+    params = {name: value for name, value in vars(args).items() if name not in ('output', 'compare')}
+    report = {'revision': revision, 'python': platform.python_version(), 'params': params, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2)
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(json.load(fp), report)
+    else:
+        for name, value in results.items():
+            print('{:<30} {:>14.6g}'.format(name, value))
+
+
+if __name__ == '__main__':
+    main()
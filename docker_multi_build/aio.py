@@ -0,0 +1,357 @@
+import asyncio
+import codecs
+import json
+import os
+import tempfile
+import time
+from urllib.parse import quote, urlencode
+
+import attr
+import docker.errors
+
+from .build import BuildCancelled, Builder, Cancellation, MultiBuilder, docker_copy
+from .config import get_cache_from
+from .events import BuildEvents
+
+
+DEFAULT_SOCKET = '/var/run/docker.sock'
+API_VERSION = '1.26'
+CHUNK_SIZE = 64 * 1024
+SPOOL_SIZE = 1024 * 1024
+
+
+@attr.s
+class AsyncMultiBuilder(MultiBuilder):
+    # Same scheduling as MultiBuilder, but builds and exports are tasks of
+    # a single event loop. Threads of the default executor are used only
+    # for disk access.
+    loop = attr.ib(default=None, repr=False)
+
+    def __attrs_post_init__(self):
+        if self.cancellation is None:
+            self.cancellation = Cancellation()
+        if self.builder is None:
+            self.builder = AsyncBuilder(client=None, cancellation=self.cancellation)
+
+    def build_all(self, configs, all_dependents, built=None):
+        loop = self.loop or asyncio.new_event_loop()
+        try:
+            multi_builder = attr.assoc(self, loop=loop, executor=Tasks(loop), export_executor=Tasks(loop))
+            multi_builder = multi_builder.prepare(configs, all_dependents, built)
+            task = loop.create_task(multi_builder.run())
+            try:
+                loop.run_until_complete(task)
+            except BaseException:
+                # Interrupts stop the loop while run() is still waiting.
+                # Cancelled run() stops the builds and waits for them and
+                # the exports, so connections are closed and containers
+                # are removed before the loop is closed.
+                if not task.done():
+                    task.cancel()
+                    loop.run_until_complete(asyncio.wait([task]))
+                raise
+            multi_builder.check_failures()
+            return multi_builder.built()
+        finally:
+            if self.loop is None:
+                loop.close()
+
+    async def run(self):
+        try:
+            while self.ready or self.building or self.exporting:
+                self.start_ready()
+                done, _ = await asyncio.wait(list(self.building) + list(self.exporting),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                self.finish(done)
+        except BaseException:
+            # Cancelled builds close their connections, exports are left
+            # to finish like in MultiBuilder
+            self.abort()
+            pending = list(self.building) + list(self.exporting)
+            if pending:
+                await asyncio.wait(pending)
+            raise
+
+    async def build_image(self, config, parent_ids):
+        self.tracer.add('queue', self.ready_since[config.tag], self.tracer.now(), config.tag)
+        fp = None
+        if self.cache is not None and None not in parent_ids:
+            with self.tracer.span('cache lookup', config.tag):
+                fp, image_id = await self.loop.run_in_executor(None, self.cache.lookup, config, parent_ids)
+            if image_id is not None:
+                return image_id, fp, None
+        started = time.monotonic()
+        image_id = await self.builder.build(config, export=False)
+        return image_id, fp, time.monotonic() - started
+
+    async def export(self, config, image_id):
+        started = time.monotonic()
+        await self.builder.run_exports(config, image_id)
+        return time.monotonic() - started
+
+
+@attr.s
+class Tasks:
+    # Stands in for an executor, functions are coroutines run as tasks
+    loop = attr.ib()
+
+    def submit(self, fn, *args):
+        return self.loop.create_task(fn(*args))
+
+
+@attr.s
+class AsyncBuilder(Builder):
+    api = attr.ib(default=attr.Factory(lambda: AsyncAPIClient()), repr=False)
+
+    async def build(self, config, export=True):
+        self = attr.assoc(self, config=config)
+        loop = asyncio.get_event_loop()
+        with self.tracer.span('write_dockerfile', config.tag):
+            await loop.run_in_executor(None, self.write_dockerfile)
+        image_id = await self.build_image()
+        if export:
+            await self.export(image_id)
+        return image_id
+
+    async def run_exports(self, config, image_id):
+        self = attr.assoc(self, config=config)
+        await self.export(image_id)
+
+    async def build_image(self):
+        tag = self.config.tag
+        with self.tracer.span('build_image', tag) as span_args:
+            loop = asyncio.get_event_loop()
+            with self.tracer.span('context', tag):
+                archive = await loop.run_in_executor(None, self.contexts.get, self.config.context)
+            if self.prefetcher is not None:
+                with self.tracer.span('prefetch', tag):
+                    await loop.run_in_executor(None, self.prefetcher.wait, self.prefetched_images())
+            dockerfile = self.dockerfile_arcname()
+            chunks = archive.stream(dockerfile, self.config.dockerfile.contents)
+            params = {
+                't': self.config.tag,
+                'dockerfile': dockerfile,
+                'buildargs': json.dumps(self.config.args),
+                'rm': '1',
+            }
+            cache_from = get_cache_from(self.config, self.cache_registry)
+            if cache_from:
+                params['cachefrom'] = json.dumps(cache_from)
+            events = BuildEvents()
+            # The context is sent before the response starts
+            with self.tracer.span('upload', tag):
+                resp = await self.api.request('POST', '/build', params, body=read_in_executor(loop, chunks),
+                                              headers={'Content-Type': 'application/x-tar'})
+            waiting = self.tracer.now()
+            try:
+                async for event in resp.json_stream():
+                    if waiting is not None:
+                        now = self.tracer.now()
+                        self.tracer.add('first event', waiting, now, tag)
+                        span_args['time_to_first_event'] = now - waiting
+                        waiting = None
+                    self.redirect_output(event.get('stream', ''))
+                    events.feed(event)
+                    if self.cancellation is not None and self.cancellation.is_cancelled(self.config.tag):
+                        raise BuildCancelled(self.config.tag)
+            finally:
+                # The daemon aborts the build when the connection is closed
+                resp.close()
+            image = await self.api.call('GET', '/images/{}/json'.format(quote(events.result(), safe='')))
+            return image['Id']
+
+    async def export(self, image_id):
+        with self.tracer.span('export', self.config.tag):
+            await self.export_stale(image_id)
+
+    async def export_stale(self, image_id):
+        loop = asyncio.get_event_loop()
+        exports = self.config.exports
+        if self.export_cache is not None:
+            # Files are hashed in the executor
+            fresh = await asyncio.gather(*[
+                loop.run_in_executor(None, self.export_cache.is_fresh, self.config.tag, exported_path, image_id)
+                for exported_path in exports])
+            exports = [exported_path for exported_path, is_fresh in zip(exports, fresh) if not is_fresh]
+        if not exports:
+            return
+        container = await self.api.call('POST', '/containers/create', body={'Image': image_id})
+        try:
+            await asyncio.gather(*[self.export_path(container['Id'], image_id, exported_path)
+                                   for exported_path in exports])
+        finally:
+            await self.api.call('DELETE', '/containers/{}'.format(container['Id']), {'v': '1', 'force': '1'})
+
+    async def export_path(self, container_id, image_id, exported_path):
+        # The archive is spooled while it's received and extracted in the
+        # executor, extraction is the same as for the threaded builder
+        loop = asyncio.get_event_loop()
+        src_path = exported_path.container_src_path
+        archive_path = os.path.dirname(src_path) if src_path.endswith('/.') else src_path
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as spool, \
+                self.tracer.span('docker_copy', self.config.tag, path=src_path):
+            resp = await self.api.request('GET', '/containers/{}/archive'.format(container_id),
+                                          {'path': archive_path})
+            async for chunk in resp.iter_chunks():
+                spool.write(chunk)
+            spool.seek(0)
+            paths = await loop.run_in_executor(
+                None, lambda: docker_copy(SpooledContainer(spool), src_path, exported_path.dest_path,
+                                          incremental=self.incremental_exports, delete=self.prune_exports,
+                                          protected=self.protected_paths))
+        self.contexts.invalidate(exported_path.dest_path)
+        if self.export_cache is not None:
+            await loop.run_in_executor(None, self.export_cache.store, self.config.tag, exported_path, image_id, paths)
+
+
+@attr.s
+class SpooledContainer:
+    archive = attr.ib()
+
+    def get_archive(self, path):
+        return self.archive, {}
+
+
+async def read_in_executor(loop, chunks):
+    # Files of the context are read in the executor, chunk by chunk
+    while True:
+        chunk = await loop.run_in_executor(None, next, chunks, None)
+        if chunk is None:
+            return
+        yield chunk
+
+
+@attr.s
+class AsyncAPIClient:
+    # Minimal HTTP/1.1 client of the Docker Engine API over a unix socket.
+    # Every request opens its own connection, response bodies are
+    # streamed.
+    socket_path = attr.ib(default=DEFAULT_SOCKET)
+    version = attr.ib(default=API_VERSION)
+
+    @classmethod
+    def from_host(cls, host):
+        if host is None:
+            return cls()
+        if not host.startswith('unix://'):
+            raise ValueError('only unix sockets are supported: {}'.format(host))
+        return cls(host[len('unix://'):])
+
+    async def call(self, method, path, params=None, body=None):
+        # Send a request with a JSON body and return the decoded response
+        headers = {}
+        if body is not None:
+            body = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        resp = await self.request(method, path, params, body, headers)
+        data = await resp.read()
+        return json.loads(data.decode()) if data else None
+
+    async def request(self, method, path, params=None, body=None, headers=None):
+        reader, writer = await asyncio.open_unix_connection(self.socket_path)
+        url = '/v{}{}'.format(self.version, path)
+        if params:
+            url += '?' + urlencode(params)
+        lines = ['{} {} HTTP/1.1'.format(method, url), 'Host: docker', 'Connection: close']
+        for name, value in (headers or {}).items():
+            lines.append('{}: {}'.format(name, value))
+        if body is None or isinstance(body, bytes):
+            lines.append('Content-Length: {}'.format(len(body or b'')))
+        else:
+            lines.append('Transfer-Encoding: chunked')
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if isinstance(body, bytes):
+            writer.write(body)
+        elif body is not None:
+            async for chunk in body:
+                if chunk:
+                    writer.write('{:x}\r\n'.format(len(chunk)).encode() + chunk + b'\r\n')
+                    await writer.drain()
+            writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+        resp = await Response.read_head(reader, writer)
+        if resp.status >= 400:
+            data = await resp.read()
+            try:
+                message = json.loads(data.decode())['message']
+            except (ValueError, KeyError, TypeError):
+                message = data.decode(errors='replace')
+            error = docker.errors.NotFound if resp.status == 404 else docker.errors.APIError
+            raise error('{} {}: {}'.format(resp.status, resp.reason, message))
+        return resp
+
+
+@attr.s
+class Response:
+    status = attr.ib()
+    reason = attr.ib()
+    headers = attr.ib(repr=False)
+    reader = attr.ib(repr=False)
+    writer = attr.ib(repr=False)
+
+    @classmethod
+    async def read_head(cls, reader, writer):
+        status_line = (await reader.readline()).decode('latin-1')
+        _, status, reason = (status_line.rstrip('\r\n').split(' ', 2) + [''])[:3]
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').rstrip('\r\n')
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return cls(int(status), reason, headers, reader, writer)
+
+    async def iter_chunks(self):
+        try:
+            if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+                while True:
+                    size = int((await self.reader.readline()).split(b';')[0], 16)
+                    if size == 0:
+                        break
+                    yield await self.reader.readexactly(size)
+                    await self.reader.readexactly(2)
+            elif 'content-length' in self.headers:
+                remaining = int(self.headers['content-length'])
+                while remaining:
+                    chunk = await self.reader.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise asyncio.IncompleteReadError(b'', remaining)
+                    remaining -= len(chunk)
+                    yield chunk
+            else:
+                while True:
+                    chunk = await self.reader.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+        finally:
+            self.writer.close()
+
+    def close(self):
+        self.writer.close()
+
+    async def read(self):
+        return b''.join([chunk async for chunk in self.iter_chunks()])
+
+    async def json_stream(self):
+        # Objects may be split between chunks, or several may arrive in
+        # one chunk
+        decoder = json.JSONDecoder()
+        text = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        buf = ''
+        async for chunk in self.iter_chunks():
+            buf += text.decode(chunk)
+            while True:
+                buf = buf.lstrip()
+                if not buf:
+                    break
+                try:
+                    obj, end = decoder.raw_decode(buf)
+                except ValueError:
+                    break
+                yield obj
+                buf = buf[end:]
+        if buf.strip():
+            raise ValueError('incomplete JSON in response: {!r}'.format(buf[:100]))
@@ -1,157 +1,631 @@
 from concurrent import futures
+import hashlib
+import heapq
+import io
+import contextlib
 import os
-import re
+import shutil
+import socket
+import stat
 import tarfile
+import tempfile
+import threading
+import time
 
 import attr
 import docker
 import docker.utils
 from docker.utils.json_stream import json_stream
-from docker.errors import BuildError
 
-from .sort_configs import sort_configs
+from . import pool
+from .config import get_cache_from, get_saved_dockerfile
+from .context import ContextArchives, file_digest
+from .events import BuildEvents
+from .sort_configs import (get_base_reference, get_dependencies, get_direct_dependents, is_exported_file_copied,
+                           sort_configs)
+from .trace import NULL_TRACER
 
 
-def build_all(configs, multi_builder=None):
+EXPORT_WORKERS = 4
+COPY_BUFSIZE = 1024 * 1024
+
+
+def build_all(configs, multi_builder=None, all_dependents=None, built=None):
     if multi_builder is None:
         multi_builder = MultiBuilder()
-    all_dependents = sort_configs(list(configs.values()))
-    multi_builder.build_all(configs, all_dependents)
+    if all_dependents is None:
+        all_dependents = sort_configs(list(configs.values()))
+    return multi_builder.build_all(configs, all_dependents, built)
 
 
 @attr.s
 class MultiBuilder:
     builder = attr.ib(default=None)
     executor = attr.ib(default=None)
+    export_executor = attr.ib(default=None)
+    jobs = attr.ib(default=None)
+    durations = attr.ib(default=attr.Factory(dict), repr=False)
+    cache = attr.ib(default=None, repr=False)
+    tracer = attr.ib(default=NULL_TRACER, repr=False)
+    cancellation = attr.ib(default=None, repr=False)
+    keep_going = attr.ib(default=False)
 
     configs = attr.ib(init=False, repr=False)
     all_dependents = attr.ib(init=False, repr=False)
     all_dependencies = attr.ib(init=False, repr=False)
+    copying_dependents = attr.ib(init=False, repr=False)
+    priorities = attr.ib(init=False, repr=False)
+    remaining = attr.ib(init=False, repr=False)
+    ready = attr.ib(init=False, repr=False)
+    building = attr.ib(init=False, repr=False)
+    exporting = attr.ib(init=False, repr=False)
+    fingerprints = attr.ib(init=False, repr=False)
+    ready_since = attr.ib(init=False, repr=False)
+    failures = attr.ib(init=False, repr=False)
     completed = attr.ib(default=attr.Factory(set), repr=False)
+    image_ids = attr.ib(default=attr.Factory(dict), repr=False)
 
     def __attrs_post_init__(self):
+        if self.cancellation is None:
+            self.cancellation = Cancellation()
         if self.builder is None:
-            self.builder = Builder()
+            self.builder = Builder(cancellation=self.cancellation)
         if self.executor is None:
-            self.executor = futures.ThreadPoolExecutor()
-
-    def build_all(self, configs, all_dependents):
+            self.executor = futures.ThreadPoolExecutor(max_workers=self.jobs)
+        if self.export_executor is None:
+            self.export_executor = futures.ThreadPoolExecutor()
+
+    def build_all(self, configs, all_dependents, built=None):
+        self = self.prepare(configs, all_dependents, built)
+        with self.executor, self.export_executor:
+            try:
+                while self.ready or self.building or self.exporting:
+                    self.start_ready()
+                    done, _ = futures.wait(list(self.building) + list(self.exporting),
+                                           return_when=futures.FIRST_COMPLETED)
+                    self.finish(done)
+            except BaseException:
+                # Executors wait for the running builds and exports
+                self.abort()
+                raise
+        self.check_failures()
+        return self.built()
+
+    def prepare(self, configs, all_dependents, built=None):
+        # Tags in built map to image IDs of the stages that are already
+        # finished, every dependent of a stage that is not in built must
+        # not be in built either. The ID is None for missing images, the
+        # cache is not used for their dependents.
+        if built is None:
+            built = {}
         self = attr.assoc(self, configs=configs, all_dependents=all_dependents)
+        if self.cache is not None:
+            self.cache.prepare(configs, all_dependents)
         self.all_dependencies = self.setup_dependencies()
-        self.completed = set()
-        to_run = set(self.configs)
-        with self.executor:
-            while self.completed < to_run:
-                fs = {self.executor.submit(self.builder.build, self.configs[tag]): tag
-                      for tag in self.ready_to_build()}
-                for f in futures.as_completed(fs):
-                    f.result()
-                    tag = fs[f]
-                    self.completed.add(tag)
+        self.copying_dependents = self.setup_copying_dependents()
+        self.priorities = self.setup_priorities()
+        self.completed = set(built)
+        self.image_ids = dict(built)
+        # Number of dependencies that are not ready yet, a tag becomes
+        # ready as soon as its counter drops to zero. A dependency is
+        # ready when its image is built, or when its exports are
+        # finished if the dependent copies them.
+        self.remaining = {tag: sum(1 for dependency in dependencies if dependency not in built)
+                          for tag, dependencies in self.all_dependencies.items() if tag not in built}
+        self.ready = []
+        self.building = {}
+        self.exporting = {}
+        self.fingerprints = {}
+        self.ready_since = {}
+        self.failures = {}
+        for tag, count in self.remaining.items():
+            if count == 0:
+                self.push_ready(tag)
+        return self
+
+    def start_ready(self):
+        while self.ready and (self.jobs is None or len(self.building) < self.jobs):
+            _, tag = heapq.heappop(self.ready)
+            if self.is_cancelled(tag):
+                # Dependents of the tag never become ready
+                continue
+            self.building[self.submit(tag)] = tag
+
+    def finish(self, done):
+        for f in done:
+            is_build = f in self.building
+            tag = self.building.pop(f) if is_build else self.exporting.pop(f)
+            try:
+                result = f.result()
+            except BuildCancelled:
+                continue
+            except Exception as exc:
+                if not self.keep_going:
+                    raise
+                # Dependents of the tag never become ready, the other
+                # branches are built
+                self.failures[tag] = exc
+                continue
+            if is_build:
+                self.image_built(tag, *result)
+            else:
+                self.image_exported(tag, result)
+
+    def abort(self):
+        # Drop the queued builds and stop the running ones, results of
+        # the other builds would be thrown away. Exports are left to
+        # finish, so containers are removed and files are not half
+        # written.
+        self.ready = []
+        for f in self.building:
+            f.cancel()
+        self.cancellation.cancel_all()
+
+    def check_failures(self):
+        if self.failures:
+            raise BuildsFailed(self.failures)
+
+    def built(self):
+        return {tag: self.image_ids[tag] for tag in self.completed}
+
+    def is_cancelled(self, tag):
+        return self.cancellation is not None and self.cancellation.is_cancelled(tag)
+
+    def submit(self, tag):
+        parent_ids = [self.image_ids[dependency] for dependency in sorted(self.all_dependencies[tag])]
+        return self.executor.submit(self.build_image, self.configs[tag], parent_ids)
+
+    def build_image(self, config, parent_ids):
+        # Time between the moment the tag became ready and the start of
+        # its build, both in the queue and in the executor
+        self.tracer.add('queue', self.ready_since[config.tag], self.tracer.now(), config.tag)
+        fp = None
+        if self.cache is not None and None not in parent_ids:
+            with self.tracer.span('cache lookup', config.tag):
+                fp, image_id = self.cache.lookup(config, parent_ids)
+            if image_id is not None:
+                return image_id, fp, None
+        started = time.monotonic()
+        image_id = self.builder.build(config, export=False)
+        return image_id, fp, time.monotonic() - started
+
+    def export(self, config, image_id):
+        started = time.monotonic()
+        self.builder.run_exports(config, image_id)
+        return time.monotonic() - started
+
+    def image_built(self, tag, image_id, fp, elapsed):
+        self.image_ids[tag] = image_id
+        for dependent in self.direct_dependents(tag):
+            if dependent not in self.copying_dependents[tag]:
+                self.dependency_ready(dependent)
+        if elapsed is not None:
+            self.durations[tag] = elapsed
+            self.fingerprints[tag] = fp
+        if self.configs[tag].exports:
+            # Export in the background, dependents that are only based
+            # on the image are started already. Exports of unchanged
+            # images are still run, the builder skips the fresh ones.
+            f = self.export_executor.submit(self.export, self.configs[tag], image_id)
+            self.exporting[f] = tag
+        else:
+            self.image_exported(tag, 0)
+
+    def image_exported(self, tag, elapsed):
+        if tag in self.fingerprints:
+            self.durations[tag] += elapsed
+            if self.cache is not None and self.fingerprints[tag] is not None:
+                self.cache.store(tag, self.fingerprints[tag], self.image_ids[tag])
+        self.stage_finished(tag)
+
+    def stage_finished(self, tag):
+        self.completed.add(tag)
+        for dependent in self.copying_dependents[tag]:
+            self.dependency_ready(dependent)
+
+    def dependency_ready(self, tag):
+        self.remaining[tag] -= 1
+        if self.remaining[tag] == 0:
+            self.push_ready(tag)
+
+    def push_ready(self, tag):
+        # Longest remaining path goes first
+        self.ready_since[tag] = self.tracer.now()
+        heapq.heappush(self.ready, (-self.priorities[tag], tag))
 
     def setup_dependencies(self):
-        configs = {tag: [] for tag in self.all_dependents}
-        for tag, dependents in self.all_dependents.items():
-            for dependent in dependents:
-                if dependent.tag == tag:
-                    continue
-                configs[dependent.tag].append(tag)
-        return configs
-
-    def ready_to_build(self):
-        for tag in self.all_dependencies:
-            if not self.is_image_built(tag) and self.are_dependencies_ready(tag):
-                yield tag
+        return get_dependencies(self.all_dependents)
+
+    def setup_copying_dependents(self):
+        return {tag: {dependent for dependent in self.direct_dependents(tag)
+                      if is_exported_file_copied(self.configs[tag], self.configs[dependent])}
+                for tag in self.all_dependents}
+
+    def setup_priorities(self):
+        # Rank each tag by the longest path from it to a sink. Stages
+        # are weighted by their recorded durations, stages that have
+        # never been built weigh as much as an average known stage, or
+        # 1 when nothing is known, i.e. the rank falls back to the
+        # depth of the graph.
+        known = [self.durations[tag] for tag in self.all_dependents if tag in self.durations]
+        default_weight = sum(known) / len(known) if known else 1
+        priorities = {}
+        for tag in reversed(list(self.all_dependents)):
+            longest_tail = max((priorities[dependent] for dependent in self.direct_dependents(tag)), default=0)
+            priorities[tag] = self.durations.get(tag, default_weight) + longest_tail
+        return priorities
+
+    def direct_dependents(self, tag):
+        return get_direct_dependents(self.all_dependents, tag)
 
     def is_image_built(self, tag):
         return tag in self.completed
 
-    def are_dependencies_ready(self, tag):
-        return all(dependency in self.completed
-                   for dependency in self.all_dependencies[tag])
-
 
 @attr.s
 class SequentialMultiBuilder:
     builder = attr.ib(default=None)
+    durations = attr.ib(default=attr.Factory(dict), repr=False)
+    cache = attr.ib(default=None, repr=False)
+    cancellation = attr.ib(default=None, repr=False)
+    keep_going = attr.ib(default=False)
 
     def __attrs_post_init__(self):
         if self.builder is None:
-            self.builder = Builder()
-
-    def build_all(self, configs, all_dependents):
+            self.builder = Builder(cancellation=self.cancellation)
+
+    def build_all(self, configs, all_dependents, built=None):
+        all_dependencies = get_dependencies(all_dependents)
+        image_ids = dict(built or {})
+        failures = {}
+        if self.cache is not None:
+            self.cache.prepare(configs, all_dependents)
         for tag in all_dependents:
-            self.builder.build(configs[tag])
+            if tag in image_ids:
+                continue
+            if self.cancellation is not None and self.cancellation.is_cancelled(tag):
+                continue
+            if any(dependency not in image_ids for dependency in all_dependencies[tag]):
+                # A dependency was cancelled or failed
+                continue
+            parent_ids = [image_ids[dependency] for dependency in sorted(all_dependencies[tag])]
+            try:
+                image_ids[tag], elapsed = build_stage(self.builder, self.cache, configs[tag], parent_ids)
+            except BuildCancelled:
+                continue
+            except Exception as exc:
+                if not self.keep_going:
+                    raise
+                failures[tag] = exc
+                continue
+            if elapsed is not None:
+                self.durations[tag] = elapsed
+        if failures:
+            raise BuildsFailed(failures)
+        return image_ids
+
+
+class BuildCancelled(Exception):
+    pass
+
+
+class BuildsFailed(Exception):
+    def __init__(self, failures):
+        super().__init__('failed to build {}'.format(', '.join(sorted(failures))))
+        self.failures = failures
+
+
+@attr.s
+class Cancellation:
+    # Tags whose builds are made obsolete while they run. Schedulers
+    # check it before starting a build. Response streams of running
+    # builds are registered, so that they are shut down on cancel and
+    # the daemon aborts the builds.
+    tags = attr.ib(default=attr.Factory(set))
+    everything = attr.ib(default=False)
+    streams = attr.ib(default=attr.Factory(dict), repr=False)
+    lock = attr.ib(default=attr.Factory(threading.Lock), repr=False)
+
+    def cancel(self, tags):
+        with self.lock:
+            self.tags.update(tags)
+            responses = [response for tag in tags for response in self.streams.get(tag, [])]
+        for response in responses:
+            close_response(response)
+
+    def cancel_all(self):
+        with self.lock:
+            self.everything = True
+            responses = [response for tag_responses in self.streams.values() for response in tag_responses]
+        for response in responses:
+            close_response(response)
+
+    def is_cancelled(self, tag):
+        with self.lock:
+            return self.everything or tag in self.tags
+
+    def reset(self):
+        with self.lock:
+            self.tags.clear()
+            self.everything = False
+
+    @contextlib.contextmanager
+    def stream(self, tag, response):
+        with self.lock:
+            self.streams.setdefault(tag, []).append(response)
+        try:
+            if self.is_cancelled(tag):
+                close_response(response)
+            yield
+        finally:
+            with self.lock:
+                self.streams[tag].remove(response)
+                if not self.streams[tag]:
+                    del self.streams[tag]
+
+
+def close_response(response):
+    # Closing the response leaves the socket open, and the thread that
+    # reads it blocked until the daemon sends more output. Shutting the
+    # socket down wakes the thread up and tells the daemon to abort.
+    try:
+        sock = response.raw._fp.fp.raw._sock
+    except AttributeError:
+        pass
+    else:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    response.close()
+
+
+def build_stage(builder, cache, config, parent_ids):
+    # Build the config unless it's unchanged since the last build.
+    # Return the image ID and the build duration, which is None when the
+    # build is skipped.
+    if None in parent_ids:
+        cache = None
+    fp = None
+    if cache is not None:
+        fp, image_id = cache.lookup(config, parent_ids)
+        if image_id is not None:
+            builder.run_exports(config, image_id)
+            return image_id, None
+    started = time.monotonic()
+    image_id = builder.build(config)
+    elapsed = time.monotonic() - started
+    if cache is not None:
+        cache.store(config.tag, fp, image_id)
+    return image_id, elapsed
 
 
 @attr.s
 class Builder:
     client = attr.ib(default=attr.Factory(docker.from_env), repr=False)
+    contexts = attr.ib(default=attr.Factory(ContextArchives), repr=False)
+    write_dockerfiles = attr.ib(default=True)
+    incremental_exports = attr.ib(default=True)
+    prune_exports = attr.ib(default=False)
+    # Directories that pruned exports must not hold, besides the working
+    # directory
+    protected_paths = attr.ib(default=attr.Factory(list), repr=False)
+    export_cache = attr.ib(default=None, repr=False)
+    output = attr.ib(default=None, repr=False)
+    clients = attr.ib(default=None, repr=False)
+    tracer = attr.ib(default=NULL_TRACER, repr=False)
+    cancellation = attr.ib(default=None, repr=False)
+    prefetcher = attr.ib(default=None, repr=False)
+    cache_registry = attr.ib(default=None)
 
     config = attr.ib(init=False, repr=False)
     dockerfile_path = attr.ib(init=False, repr=False)
 
-    def build(self, config):
+    def build(self, config, export=True):
+        self = attr.assoc(self, config=config)
+        with self.tracer.span('write_dockerfile', config.tag):
+            self.write_dockerfile()
+        image = self.build_image()
+        if export:
+            self.export(image.id)
+        return image.id
+
+    def run_exports(self, config, image_id):
         self = attr.assoc(self, config=config)
-        self.write_dockerfile()
-        self.build_image()
-        self.export()
+        self.export(image_id)
 
     def write_dockerfile(self):
-        if self.config.dockerfile.name is not None:
+        # In-line Dockerfile is always sent as a member of the context
+        # archive, writing it to disk is optional
+        path = get_saved_dockerfile(self.config)
+        if path is None or not self.write_dockerfiles:
             return
 
-        self.config.dockerfile.name = os.path.join(self.config.context, 'Dockerfile.' + self.config.tag)
-        with open(self.config.dockerfile.name, 'w') as fp:
+        # Keep the modification time if the file is unchanged, so the
+        # context is not considered changed by the next run
+        try:
+            with open(path) as fp:
+                if fp.read() == self.config.dockerfile.contents:
+                    return
+        except FileNotFoundError:
+            pass
+        with open(path, 'w') as fp:
             fp.write(self.config.dockerfile.contents)
 
     def build_image(self, **kwargs):
-        resp = self.client.api.build(path=self.config.context,
-                                     dockerfile=os.path.basename(self.config.dockerfile.name),
-                                     tag=self.config.tag,
-                                     buildargs=self.config.args,
-                                     rm=True)
-        if isinstance(resp, str):
-            return self.client.images.get(resp)
-
-        events = []
+        tag = self.config.tag
+        with self.tracer.span('build_image', tag) as span_args:
+            with self.tracer.span('context', tag):
+                archive = self.contexts.get(self.config.context)
+            if self.prefetcher is not None:
+                with self.tracer.span('prefetch', tag):
+                    self.prefetcher.wait(self.prefetched_images())
+            dockerfile = self.dockerfile_arcname()
+            with self.lease(pool.STREAM) as client:
+                # The context is sent before the response starts
+                with self.tracer.span('upload', tag), capture_responses(client.api) as responses:
+                    resp = client.api.build(fileobj=archive.stream(dockerfile, self.config.dockerfile.contents),
+                                            custom_context=True,
+                                            dockerfile=dockerfile,
+                                            tag=tag,
+                                            buildargs=self.config.args,
+                                            rm=True,
+                                            # Older daemons don't know the parameter
+                                            cache_from=get_cache_from(self.config, self.cache_registry) or None)
+                if isinstance(resp, str):
+                    image_id = resp
+                else:
+                    with self.cancellable(responses):
+                        image_id = self.read_events(resp, span_args)
+            with self.lease(pool.CALL) as client:
+                return client.images.get(image_id)
+
+    def read_events(self, resp, span_args):
+        tag = self.config.tag
+        events = BuildEvents()
+        waiting = self.tracer.now()
         for event in json_stream(resp):
+            if waiting is not None:
+                now = self.tracer.now()
+                self.tracer.add('first event', waiting, now, tag)
+                span_args['time_to_first_event'] = now - waiting
+                waiting = None
             # TODO: Redirect image pull logs
             line = event.get('stream', '')
             self.redirect_output(line)
-            events.append(event)
-
-        if not events:
-            raise BuildError('Unknown')
-        event = events[-1]
-        if 'stream' in event:
-            match = re.search(r'(Successfully built |sha256:)([0-9a-f]+)', event.get('stream', ''))
-            if match:
-                image_id = match.group(2)
-                return self.client.images.get(image_id)
-
-        raise BuildError(event.get('error') or event)
-
-    def export(self):
-        container = self.client.containers.create(self.config.tag)
+            events.feed(event)
+        return events.result()
+
+    @contextlib.contextmanager
+    def cancellable(self, responses):
+        # Shut the response streams of the build down when it's cancelled,
+        # reading from the stream fails then
+        if self.cancellation is None:
+            yield
+            return
+        tag = self.config.tag
+        with contextlib.ExitStack() as stack:
+            for response in responses:
+                stack.enter_context(self.cancellation.stream(tag, response))
+            try:
+                yield
+            except Exception:
+                if self.cancellation.is_cancelled(tag):
+                    raise BuildCancelled(tag)
+                raise
+        if self.cancellation.is_cancelled(tag):
+            raise BuildCancelled(tag)
+
+    def prefetched_images(self):
+        # Base image, which the build would otherwise pull by itself, and
+        # images of the layer cache, which the build never pulls. Cache
+        # images that were not pulled ahead are pulled now.
+        cache_from = get_cache_from(self.config, self.cache_registry)
+        self.prefetcher.start(cache_from)
+        return [get_base_reference(self.config)] + cache_from
+
+    def dockerfile_arcname(self):
+        # Dockerfile is added to the shared context archive as an extra
+        # member, even if it's excluded by .dockerignore
+        if self.config.dockerfile.name is None:
+            return 'Dockerfile.' + self.config.tag
+        arcname = os.path.relpath(self.config.dockerfile.name, self.config.context)
+        if arcname.startswith(os.pardir + os.sep):
+            arcname = 'Dockerfile.' + self.config.tag
+        return arcname
+
+    def export(self, image_id):
+        with self.tracer.span('export', self.config.tag):
+            self.export_stale(image_id)
+
+    def export_stale(self, image_id):
+        exports = self.config.exports
+        if self.export_cache is not None:
+            exports = [exported_path for exported_path in exports
+                       if not self.export_cache.is_fresh(self.config.tag, exported_path, image_id)]
+        if not exports:
+            return
+        with self.lease(pool.CALL) as client:
+            container = client.containers.create(image_id)
         try:
-            for exported_path in self.config.exports:
-                docker_copy(container, exported_path.container_src_path, exported_path.dest_path)
+            # Paths are fetched from the container in parallel
+            with futures.ThreadPoolExecutor(max_workers=EXPORT_WORKERS) as executor:
+                fs = [executor.submit(self.export_path, container, image_id, exported_path)
+                      for exported_path in exports]
+            for f in fs:
+                f.result()
         finally:
-            container.remove()
+            # Containers are removed on failures and interrupts as well,
+            # with their anonymous volumes
+            with self.lease(pool.CALL) as client:
+                self.bind(client, container).remove(v=True, force=True)
+
+    def export_path(self, container, image_id, exported_path):
+        with self.lease(pool.STREAM) as client, \
+                self.tracer.span('docker_copy', self.config.tag, path=exported_path.container_src_path):
+            paths = docker_copy(self.bind(client, container),
+                                exported_path.container_src_path, exported_path.dest_path,
+                                incremental=self.incremental_exports, delete=self.prune_exports,
+                                protected=self.protected_paths)
+        self.contexts.invalidate(exported_path.dest_path)
+        if self.export_cache is not None:
+            self.export_cache.store(self.config.tag, exported_path, image_id, paths)
+
+    def lease(self, lane):
+        return pool.lease(self.client, self.clients, lane)
+
+    def bind(self, client, container):
+        # Use the container through the leased client
+        if client is self.client:
+            return container
+        return client.containers.prepare_model(container.attrs)
 
     def redirect_output(self, line):
-        print(self.config.tag, '|', line, end='')
-
-
-def docker_copy(container, src_path, dest_path):
+        if self.output is not None:
+            self.output.write(self.config.tag, line)
+        else:
+            print(self.config.tag, '|', line, end='')
+
+
+@contextlib.contextmanager
+def capture_responses(api):
+    # Collect HTTP responses that the API client receives in the current
+    # thread. Streamed responses can be shut down from other threads.
+    responses = []
+    hooks = getattr(api, 'hooks', None)
+    if hooks is None:
+        yield responses
+        return
+    thread = threading.current_thread()
+
+    def hook(response, **kwargs):
+        if threading.current_thread() is thread:
+            responses.append(response)
+
+    hooks['response'].append(hook)
+    try:
+        yield responses
+    finally:
+        hooks['response'].remove(hook)
+
+
+def docker_copy(container, src_path, dest_path, incremental=False, delete=False, protected=()):
+    # Return paths of the extracted members. In incremental mode only
+    # files that differ from the ones at the destination are written, with
+    # delete the files that are not in the archive are removed, unless the
+    # directory holds the working directory or one of the protected paths
     copy_contents = False
     if src_path.endswith('/.'):
         src_path = os.path.dirname(src_path)
         copy_contents = True
 
+    extract = sync_member if incremental else extract_member
+    extracted = []
     tar_stream, _ = container.get_archive(src_path)
-    with tarfile.open(fileobj=tar_stream, mode='r|') as tf:
+    # The stream is read in large blocks, tarfile keeps its own small
+    # buffer because it copies the remainder of the buffer on every read
+    fileobj = io.BufferedReader(RawStream(tar_stream), buffer_size=COPY_BUFSIZE)
+    with tarfile.open(fileobj=fileobj, mode='r|') as tf:
         tfi = iter(tf)
         member = next(tfi)
         if not member.isdir():
@@ -160,7 +634,7 @@ def docker_copy(container, src_path, dest_path):
             if os.path.isdir(dest_path):
                 dest_path = os.path.join(dest_path, os.path.basename(member.name))
             member.name = dest_path
-            tf.extract(member)
+            extracted.append(extract(tf, member, ''))
         else:
             dest_path_existed = os.path.exists(dest_path)
             if dest_path_existed:
@@ -168,8 +642,137 @@ def docker_copy(container, src_path, dest_path):
                     raise Exception('cannot copy a directory to a file')
             else:
                 os.mkdir(dest_path)
+            root = dest_path
+            if dest_path_existed and not copy_contents:
+                root = os.path.join(dest_path, member.name)
+            if delete:
+                check_prune_root(root, protected)
             for m in tfi:
                 if m.name.startswith(member.name):
                     if copy_contents or not dest_path_existed:
                         m.name = m.name.replace(member.name + '/', '', 1)
-                    tf.extract(m, dest_path)
+                    extracted.append(extract(tf, m, dest_path))
+            if delete:
+                remove_stale(root, extracted)
+    return extracted
+
+
+def extract_member(tf, member, path):
+    tf.extract(member, path)
+    return os.path.join(path, member.name)
+
+
+def sync_member(tf, member, path):
+    target = os.path.join(path, member.name)
+    if member.isdir():
+        if not os.path.isdir(target):
+            os.makedirs(target)
+            os.chmod(target, member.mode)
+    elif member.isfile():
+        sync_file(tf.extractfile(member), member, target)
+    else:
+        try:
+            if member.issym() and os.readlink(target) == member.linkname:
+                return target
+        except OSError:
+            pass
+        if os.path.lexists(target) and not os.path.isdir(target):
+            os.remove(target)
+        tf.extract(member, path)
+    return target
+
+
+def sync_file(fileobj, member, path):
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        st = None
+    if st is None or not stat.S_ISREG(st.st_mode) or st.st_size != member.size:
+        write_file(fileobj, member, path)
+        return
+
+    # Contents of the member are hashed while being spooled, and written
+    # only if they differ from the file on disk
+    h = hashlib.sha256()
+    with tempfile.SpooledTemporaryFile(max_size=COPY_BUFSIZE) as spool:
+        for chunk in iter(lambda: fileobj.read(COPY_BUFSIZE), b''):
+            h.update(chunk)
+            spool.write(chunk)
+        if h.hexdigest() != file_digest(path):
+            spool.seek(0)
+            write_file(spool, member, path)
+        elif stat.S_IMODE(st.st_mode) != member.mode:
+            os.chmod(path, member.mode)
+
+
+def write_file(fileobj, member, path):
+    dirname, basename = os.path.split(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    # The file is replaced at once, so a build that reads the context
+    # never sees it half-written
+    fd, temp_path = tempfile.mkstemp(prefix='.' + basename + '.', dir=dirname or os.curdir)
+    try:
+        with open(fd, 'wb') as fp:
+            shutil.copyfileobj(fileobj, fp, COPY_BUFSIZE)
+        os.chmod(temp_path, member.mode)
+        os.utime(temp_path, (member.mtime, member.mtime))
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def check_prune_root(root, protected):
+    # Everything in the root that is not exported is removed
+    root = os.path.realpath(root)
+    for path in [os.getcwd()] + list(protected):
+        path = os.path.realpath(path)
+        if path == root or path.startswith(os.path.join(root, '')):
+            raise Exception("refusing to remove files from '{}' that are not exported, it holds '{}'".format(
+                root, path))
+
+
+def remove_stale(root, extracted):
+    keep = {os.path.normpath(path) for path in extracted}
+    for dirpath, dirnames, filenames in os.walk(root, topdown=False):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if os.path.normpath(path) not in keep:
+                os.remove(path)
+        for name in dirnames:
+            path = os.path.join(dirpath, name)
+            if os.path.normpath(path) in keep:
+                continue
+            if os.path.islink(path):
+                os.remove(path)
+            else:
+                os.rmdir(path)
+
+
+class RawStream(io.RawIOBase):
+    # File-like wrapper of the archive returned by get_archive, which is
+    # either a file object or an iterator of chunks, depending on the
+    # version of docker-py
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.chunks = iter(stream) if not hasattr(stream, 'read') else None
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.chunks is None:
+            data = self.stream.read(len(b))
+        else:
+            data = self.pending
+            while not data:
+                data = next(self.chunks, None)
+                if data is None:
+                    return 0
+            self.pending = data[len(b):]
+            data = data[:len(b)]
+        b[:len(data)] = data
+        return len(data)
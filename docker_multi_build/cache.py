@@ -0,0 +1,171 @@
+import hashlib
+import json
+import os
+import stat
+import threading
+
+import attr
+import docker.errors
+
+from . import pool
+from .config import get_saved_dockerfile
+from .context import file_digest, scan_context
+from .sort_configs import get_dependencies, get_export_destination
+
+
+@attr.s
+class BuildCache:
+    # Contexts are scanned once per run. In-line Dockerfiles saved to the
+    # contexts are left out of the digests, contents of the Dockerfile
+    # are part of the fingerprint. Files written by exports are left out
+    # only for the exporting config and its dependents: the fingerprint
+    # taken before the exports stays valid after them, and images that
+    # copy the files depend on the exporting image anyway.
+    client = attr.ib(repr=False)
+    entries = attr.ib(default=attr.Factory(dict))
+    clients = attr.ib(default=None, repr=False)
+    excluded = attr.ib(default=attr.Factory(dict), repr=False)
+    scans = attr.ib(default=attr.Factory(dict), repr=False)
+    digests = attr.ib(default=attr.Factory(dict), repr=False)
+    locks = attr.ib(default=attr.Factory(dict), repr=False)
+    lock = attr.ib(default=attr.Factory(threading.Lock), repr=False)
+
+    def prepare(self, configs, all_dependents):
+        # Called at the start of every run
+        saved_dockerfiles = {os.path.realpath(path) for path in map(get_saved_dockerfile, configs.values())
+                             if path is not None}
+        destinations = {tag: {get_export_destination(export) for export in config.exports}
+                        for tag, config in configs.items()}
+        all_dependencies = get_dependencies(all_dependents)
+        self.excluded = {}
+        for tag in configs:
+            excluded = set(saved_dockerfiles)
+            for exporter in [tag] + all_dependencies[tag]:
+                excluded.update(destinations[exporter])
+            self.excluded[tag] = frozenset(excluded)
+        self.scans = {}
+        self.digests = {}
+
+    def context_digest(self, context, excluded=frozenset()):
+        context = os.path.realpath(context)
+        with self.lock:
+            context_lock = self.locks.setdefault(context, threading.Lock())
+        with context_lock:
+            entries = self.scans.get(context)
+            if entries is None:
+                entries = self.scans[context] = scan_entries(context)
+            digest = self.digests.get((context, excluded))
+            if digest is None:
+                digest = self.digests[context, excluded] = context_digest(context, excluded, entries)
+        return digest
+
+    def lookup(self, config, parent_ids):
+        # Return the fingerprint of the config and the ID of the image
+        # built with the same fingerprint, if it's still tagged
+        digest = self.context_digest(config.context, self.excluded.get(config.tag, frozenset()))
+        fp = fingerprint(config, parent_ids, digest)
+        entry = self.entries.get(config.tag)
+        if entry is None or entry['fingerprint'] != fp:
+            return fp, None
+        try:
+            with pool.lease(self.client, self.clients, pool.CALL) as client:
+                image = client.images.get(config.tag)
+        except docker.errors.ImageNotFound:
+            return fp, None
+        if image.id != entry['image_id']:
+            return fp, None
+        return fp, image.id
+
+    def store(self, tag, fp, image_id):
+        self.entries[tag] = {'fingerprint': fp, 'image_id': image_id}
+
+
+@attr.s
+class ExportCache:
+    # Manifests of exported paths. An export is fresh when it was copied
+    # from the same image and the files it wrote are still in place.
+    entries = attr.ib(default=attr.Factory(dict))
+
+    def is_fresh(self, tag, exported_path, image_id):
+        entry = self.entries.get(export_key(tag, exported_path))
+        if entry is None or entry['image_id'] != image_id:
+            return False
+        if not os.path.lexists(exported_path.dest_path):
+            return False
+        for path, (size, mtime_ns, digest) in entry['files'].items():
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                return False
+            if st.st_size != size:
+                return False
+            # Contents are checked only if the file has been touched
+            if st.st_mtime_ns != mtime_ns and file_digest(path) != digest:
+                return False
+        for path in entry.get('dirs', []):
+            if not os.path.isdir(path) or os.path.islink(path):
+                return False
+        for path, target in entry.get('links', {}).items():
+            try:
+                if os.readlink(path) != target:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def store(self, tag, exported_path, image_id, paths):
+        # Directories and symlinks are recorded too, an export may write
+        # nothing else
+        files = {}
+        dirs = []
+        links = {}
+        for path in paths:
+            path = os.path.abspath(path)
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode):
+                files[path] = [st.st_size, st.st_mtime_ns, file_digest(path)]
+            elif stat.S_ISDIR(st.st_mode):
+                dirs.append(path)
+            elif stat.S_ISLNK(st.st_mode):
+                links[path] = os.readlink(path)
+        self.entries[export_key(tag, exported_path)] = {'image_id': image_id, 'files': files, 'dirs': dirs,
+                                                        'links': links}
+
+
+def export_key(tag, exported_path):
+    return '{} {}:{}'.format(tag, exported_path.container_src_path, exported_path.dest_path)
+
+
+def fingerprint(config, parent_ids, digest=None):
+    if digest is None:
+        digest = context_digest(config.context)
+    doc = {
+        'dockerfile': config.dockerfile.contents,
+        'args': config.args,
+        'exports': [[export.container_src_path, export.dest_path] for export in config.exports],
+        'context': digest,
+        'parents': list(parent_ids),
+    }
+    return hashlib.sha256(json.dumps(doc, sort_keys=True).encode()).hexdigest()
+
+
+def context_digest(context, excluded=(), entries=None):
+    # File contents are not read, size and modification time are enough
+    # to tell that the context has changed. Files below the excluded real
+    # paths are left out, unless the context itself is excluded.
+    context = os.path.realpath(context)
+    if entries is None:
+        entries = scan_entries(context)
+    excluded_arcnames = [os.path.relpath(path, context).replace(os.sep, '/') for path in excluded
+                         if path.startswith(os.path.join(context, ''))]
+    h = hashlib.sha256()
+    for arcname, entry in entries:
+        if any(arcname == other or arcname.startswith(other + '/') for other in excluded_arcnames):
+            continue
+        h.update(entry)
+    return h.hexdigest()
+
+
+def scan_entries(context):
+    return [(arcname, '{}\0{}\0{}\0{}\n'.format(arcname, st.st_size, st.st_mtime_ns, st.st_mode).encode())
+            for arcname, _, st in scan_context(context)]
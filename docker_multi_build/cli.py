@@ -1,22 +1,85 @@
+import functools
+import json
 import os
+import signal
 
 import click
-import docker
 
 from . import config
-from . import build
+from . import plan as planning
+from . import selection
+from . import state
 
 
 CLI_DEFAULT_FILE = 'docker-multi-build.yml'
 
+# Options shared by the commands
+targets_argument = click.argument('targets', metavar='[TARGET]...', nargs=-1)
+file_option = click.option('-f', '--file', metavar='PATH', type=click.File(), default=CLI_DEFAULT_FILE,
+                           help='Specify an alternate multi-build file (default: {}).'.format(CLI_DEFAULT_FILE))
+changed_since_option = click.option('--changed-since', metavar='REV',
+                                    help='Build only images whose context or Dockerfile changed since git revision '
+                                         'REV, and their dependents.')
+cache_configs_option = click.option('--cache-configs/--no-cache-configs', default=True,
+                                    help='Keep the loaded multi-build file in .docker-multi-build/config-cache.json '
+                                         'until it or the Dockerfiles it references change (default: True).')
 
-@click.command()
-@click.option('-f', '--file', metavar='PATH', type=click.File(), default=CLI_DEFAULT_FILE,
-              help='Specify an alternate multi-build file (default: {}).'.format(CLI_DEFAULT_FILE))
+
+class DefaultGroup(click.Group):
+    # Arguments that don't start with a command name are passed to the
+    # default command, so 'docker-multi-build [OPTIONS] [TARGET]...'
+    # builds images
+    default_command = 'build'
+
+    def parse_args(self, ctx, args):
+        if not args or args[0] not in self.commands and args[0] != '--help':
+            args = [self.default_command] + list(args)
+        return super().parse_args(ctx, args)
+
+
+@click.group(cls=DefaultGroup)
+def cli():
+    pass
+
+
+@cli.command('build')
+@targets_argument
+@file_option
+@changed_since_option
+@click.option('--watch', is_flag=True,
+              help='Keep running and rebuild images whose context or Dockerfile changes, and their dependents.')
 @click.option('--concurrent/--no-concurrent', default=True,
               help='Run builds concurrently (default: True).')
-@click.option('-H', '--host', metavar='HOST', envvar='DOCKER_HOST', default=None,
-              help='Daemon socket to connect to.')
+@click.option('-k', '--keep-going', is_flag=True,
+              help='Keep building images that do not depend on a failed one, instead of stopping at the first '
+                   'failure.')
+@click.option('-j', '--jobs', metavar='N', type=click.IntRange(min=1), default=None,
+              help='Maximum number of concurrent builds.')
+@click.option('--asyncio', 'use_asyncio', is_flag=True,
+              help='Run builds on an event loop instead of threads, the daemon must listen on a unix socket.')
+@click.option('--prefetch/--no-prefetch', default=True,
+              help='Pull base images that are not built from the multi-build file and images of the layer cache in '
+                   'the background, while contexts are uploaded (default: True).')
+@click.option('--cache-registry', metavar='PREFIX',
+              help='Use PREFIX/<tag> as the layer cache of images that have no cache_from setting.')
+@click.option('--skip-unchanged/--no-skip-unchanged', default=True,
+              help='Skip builds and exports of images that have not changed since the last build (default: True).')
+@cache_configs_option
+@click.option('--write-dockerfiles/--no-write-dockerfiles', default=True,
+              help='Save in-line Dockerfiles to build contexts as Dockerfile.<tag> (default: True).')
+@click.option('--prune-exports', is_flag=True,
+              help='Remove files from exported directories that are not in the image.')
+@click.option('--progress', type=click.Choice(['auto', 'plain', 'tty']), default='plain',
+              help='Print every line of output, or only the latest line of each image, auto picks the latter on a '
+                   'terminal (default: plain).')
+@click.option('--log-dir', metavar='PATH', type=click.Path(file_okay=False),
+              help='Write output of each image to PATH/<tag>.log.')
+@click.option('--output-rate', metavar='N', type=click.IntRange(min=1), default=None,
+              help='Maximum number of lines per second printed for each image.')
+@click.option('--trace', metavar='PATH', type=click.Path(dir_okay=False, writable=True),
+              help='Write Chrome trace events of the run to PATH.')
+@click.option('-H', '--host', metavar='HOST', envvar='DOCKER_HOST', multiple=True,
+              help='Daemon socket to connect to, repeat to distribute builds across several daemons.')
 @click.option('--tls', is_flag=True,
               help='Use TLS; implied by --tlsverify.')
 @click.option('--tlscacert', metavar='CA_PATH', type=click.Path(exists=True),
@@ -27,16 +90,204 @@ CLI_DEFAULT_FILE = 'docker-multi-build.yml'
               help='Path to TLS key file.')
 @click.option('--tlsverify', envvar='DOCKER_TLS_VERIFY', is_flag=True,
               help='Use TLS and verify the remote.')
-def cli(file, concurrent, host, tls, tlscacert, tlscert, tlskey, tlsverify):
-    configs = config.load(file)
+def build_command(targets, file, changed_since, watch, concurrent, keep_going, jobs, use_asyncio, prefetch,
+                  cache_registry, skip_unchanged, cache_configs, write_dockerfiles, prune_exports, progress, log_dir,
+                  output_rate, trace, host, tls, tlscacert, tlscert, tlskey, tlsverify):
+    """Build images."""
+    # Docker client is imported only when images are built
+    import docker
+
+    from . import aio
+    from . import build
+    from . import cache
+    from . import context
+    from . import distribute
+    from . import output
+    from . import pool
+    from . import prefetch as prefetching
+    from . import trace as tracing
+
+    if watch:
+        if changed_since is not None:
+            raise click.UsageError('--watch can not be combined with --changed-since')
+        if state.default_path(file) is None:
+            raise click.BadParameter('the multi-build file must be a file', param_hint='--watch')
+    configs, all_dependents, parents = load_configs(file, targets, changed_since, cache_configs)
+    st = state.State.load(state.default_path(file))
+    index = context.StatIndex.load(state.default_path(file, context.INDEX_FILENAME))
     tls_config = load_tls_config(tls, tlscacert, tlscert, tlskey, tlsverify)
-    client = docker.DockerClient(host, tls=tls_config)
-    b = build.Builder(client)
-    if concurrent:
-        mb = build.MultiBuilder(builder=b)
+    hosts = host or (None,)
+    if use_asyncio and len(hosts) > 1:
+        raise click.UsageError('--asyncio supports a single --host')
+    ec = cache.ExportCache(st.exports) if skip_unchanged else None
+    tty = progress == 'tty' or progress == 'auto' and click.get_text_stream('stdout').isatty()
+    out = output.Output(tty=tty, log_dir=log_dir, rate=output_rate)
+    tracer = tracing.Tracer(enabled=trace is not None)
+    # Shared by the multi builder and the builders, running builds are
+    # stopped on the first failure, on interrupt and on changes in watch
+    # mode
+    cancellation = build.Cancellation()
+    contexts = context.ContextArchives(index)
+    # Pruned exports must not remove the multi-build file or sources
+    protected_paths = [os.path.dirname(os.path.abspath(file.name))] + [config.context for config in configs.values()]
+    builder_options = dict(contexts=contexts, write_dockerfiles=write_dockerfiles,
+                           prune_exports=prune_exports, protected_paths=protected_paths, export_cache=ec,
+                           output=out, tracer=tracer, cancellation=cancellation, cache_registry=cache_registry)
+    builders = []
+    for daemon_host in hosts:
+        client = docker.DockerClient(daemon_host, tls=tls_config)
+        # Every concurrent build and export streams over a client of its own
+        clients = pool.ClientPool(functools.partial(docker.DockerClient, daemon_host, tls=tls_config),
+                                  size=jobs + build.EXPORT_WORKERS if jobs else None)
+        prefetcher = None
+        if prefetch:
+            prefetcher = prefetching.Prefetcher(prefetching.DockerPull(client, clients, cancellation), output=out)
+        builders.append(build.Builder(client, clients=clients, prefetcher=prefetcher, **builder_options))
+    if len(builders) == 1:
+        b = builders[0]
+        bc = cache.BuildCache(b.client, st.builds, clients=b.clients) if skip_unchanged else None
+    else:
+        b = distribute.DistributedBuilder(builders, tags=set(configs))
+        bc = cache.BuildCache(b.cluster_client(), st.builds) if skip_unchanged else None
+    # Images that the selected ones depend on are not built, they are
+    # taken as they are, and missing ones turn the build cache off for
+    # their dependents
+    built = find_images(b.client if len(builders) == 1 else b.cluster_client(), parents)
+    if use_asyncio:
+        if tls_config is not None:
+            raise click.UsageError('--asyncio does not support TLS')
+        try:
+            api = aio.AsyncAPIClient.from_host(hosts[0])
+        except ValueError as exc:
+            raise click.BadParameter(str(exc), param_hint='--host')
+        b = aio.AsyncBuilder(b.client, api=api, prefetcher=b.prefetcher, **builder_options)
+        # Multi builders shut their executors down, a new one is made
+        # for every run
+        multi_builder = functools.partial(aio.AsyncMultiBuilder, builder=b, jobs=jobs if concurrent else 1,
+                                          durations=st.durations, cache=bc, tracer=tracer,
+                                          cancellation=cancellation, keep_going=keep_going)
+    elif concurrent:
+        multi_builder = functools.partial(build.MultiBuilder, builder=b, jobs=jobs, durations=st.durations,
+                                          cache=bc, tracer=tracer, cancellation=cancellation, keep_going=keep_going)
     else:
-        mb = build.SequentialMultiBuilder(builder=b)
-    build.build_all(configs, multi_builder=mb)
+        multi_builder = functools.partial(build.SequentialMultiBuilder, builder=b, durations=st.durations,
+                                          cache=bc, cancellation=cancellation, keep_going=keep_going)
+    # SIGTERM interrupts the build like SIGINT does, so that running
+    # builds are stopped and containers of exports are removed
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    prefetchers = [daemon_builder.prefetcher for daemon_builder in builders if daemon_builder.prefetcher is not None]
+    try:
+        with out:
+            # Images are pulled ahead only when every build runs on the
+            # same daemon, otherwise cache images are pulled by the daemon
+            # that runs the build right before it
+            if prefetchers and len(builders) == 1:
+                selected = {tag: config for tag, config in configs.items() if tag not in parents}
+                prefetchers[0].start(prefetching.external_base_images(selected) +
+                                     prefetching.cache_images(selected, cache_registry))
+            if watch:
+                watch_configs(file, configs, all_dependents, targets, multi_builder, cancellation, contexts, out, st,
+                              index)
+            else:
+                contexts.prepare(configs)
+                build.build_all(configs, multi_builder=multi_builder(), all_dependents=all_dependents, built=built)
+    except build.BuildsFailed as exc:
+        raise click.ClickException('{}:\n{}'.format(exc, '\n'.join(
+            '  {}: {}'.format(tag, error) for tag, error in sorted(exc.failures.items()))))
+    finally:
+        for prefetcher in prefetchers:
+            prefetcher.close()
+        st.save()
+        index.save()
+        if trace is not None:
+            # Waits for clients tell whether --jobs outgrows the pools
+            tracer.metadata['client_pools'] = {daemon_host or 'default': daemon_builder.clients.stats()
+                                               for daemon_host, daemon_builder in zip(hosts, builders)}
+            tracer.save(trace)
+
+
+@cli.command('plan')
+@targets_argument
+@file_option
+@changed_since_option
+@cache_configs_option
+@click.option('--format', 'output_format', type=click.Choice(['text', 'json']), default='text',
+              help='Print the plan as text or as JSON (default: text).')
+def plan_command(targets, file, changed_since, cache_configs, output_format):
+    """Print the build order without building anything."""
+    configs, all_dependents, parents = load_configs(file, targets, changed_since, cache_configs)
+    st = state.State.load(state.default_path(file))
+    p = planning.make_plan(selection.subgraph(all_dependents, set(configs) - parents), st.durations)
+    if output_format == 'json':
+        click.echo(json.dumps(p.dump(), indent=2))
+        return
+    click.echo('Build order:')
+    for number, tag in enumerate(p.order, 1):
+        click.echo('  {}. {}'.format(number, tag))
+    click.echo('Levels:')
+    for depth, level in enumerate(p.levels):
+        click.echo('  {}: {}'.format(depth, ', '.join(level)))
+    click.echo('Critical path: {}'.format(' -> '.join(p.critical_path)))
+    click.echo('Images: {}, levels: {}, widest level: {}, estimated parallelism: {:.2f}'.format(
+        len(p.order), len(p.levels), p.widest_level, p.parallelism))
+
+
+def load_configs(file, targets, changed_since, cache_configs=True):
+    # Return configs to build, their dependency graph and tags of the
+    # images that are not built but the built ones depend on. Configs and
+    # the graph include the latter.
+    cache_path = state.default_path(file, config.CACHE_FILENAME) if cache_configs else None
+    configs, all_dependents = config.ConfigCache(cache_path).load(file)
+    if not targets and changed_since is None:
+        return configs, all_dependents, set()
+    try:
+        changed = None
+        if changed_since is not None:
+            if state.default_path(file) is None:
+                raise click.BadParameter('the multi-build file must be a file', param_hint='--changed-since')
+            changed = selection.changed_since(configs, changed_since, file.name)
+        selected = selection.select(configs, all_dependents, targets, changed)
+        parents = selection.outside_dependencies(all_dependents, set(selected))
+        tags = set(selected) | parents
+        return ({tag: config for tag, config in configs.items() if tag in tags},
+                selection.subgraph(all_dependents, tags), parents)
+    except selection.SelectionError as exc:
+        raise click.UsageError(str(exc))
+
+
+def find_images(client, tags):
+    # Return IDs of the images of the tags, None for missing images
+    import docker.errors
+
+    image_ids = {}
+    for tag in tags:
+        try:
+            image_ids[tag] = client.images.get(tag).id
+        except docker.errors.ImageNotFound:
+            image_ids[tag] = None
+    return image_ids
+
+
+def watch_configs(file, configs, all_dependents, targets, multi_builder, cancellation, contexts, out, st, index):
+    from . import watch as watching
+
+    def build_round(configs, all_dependents, built):
+        contexts.prepare(configs)
+        try:
+            return multi_builder().build_all(configs, all_dependents, built)
+        finally:
+            st.save()
+            index.save()
+
+    watcher = watching.Watcher(file.name, configs, all_dependents, build_round,
+                               cancellation=cancellation, contexts=contexts, targets=targets,
+                               echo=lambda message: out.write('watch', message + '\n'))
+    try:
+        watcher.run()
+    except watching.WatchError as exc:
+        raise click.ClickException(str(exc))
+    except KeyboardInterrupt:
+        pass
 
 
 def load_tls_config(tls, tlscacert, tlscert, tlskey, tlsverify):
@@ -50,6 +301,8 @@ def load_tls_config(tls, tlscacert, tlscert, tlskey, tlsverify):
             tlscert = os.path.join(docker_cert_path, 'cert.pem')
         if not tlskey:
             tlskey = os.path.join(docker_cert_path, 'key.pem')
+    import docker.tls
+
     return docker.tls.TLSConfig(
         client_cert=(tlscert, tlskey),
         ca_cert=tlscacert,
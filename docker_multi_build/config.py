@@ -1,4 +1,7 @@
+from collections import OrderedDict
+import hashlib
 import io
+import json
 import os
 
 import attr
@@ -6,6 +9,12 @@ from attr import NOTHING, Factory
 from attr.validators import instance_of
 import yaml
 
+from .sort_configs import sort_configs
+
+
+CACHE_FILENAME = 'config-cache.json'
+CACHE_VERSION = 2
+
 
 @attr.s
 class Dockerfile:
@@ -26,6 +35,7 @@ class BuildConfig:
     context = attr.ib(default='.')
     args = attr.ib(default=Factory(dict))
     exports = attr.ib(default=Factory(list))
+    cache_from = attr.ib(default=Factory(list))
 
 
 def load(stream):
@@ -54,7 +64,8 @@ def _load_build_config(tag, raw_config, default_context):
     dockerfile = _load_dockerfile(raw_config, context)
     args = raw_config.get('args', NOTHING)
     exports = _load_exports(raw_config)
-    return BuildConfig(tag, dockerfile, context, args, exports)
+    cache_from = _load_cache_from(raw_config)
+    return BuildConfig(tag, dockerfile, context, args, exports, cache_from)
 
 
 def _load_context(raw_config, default_context):
@@ -98,7 +109,43 @@ def _parse_export(raw_export):
     return BuildExport(*parts)
 
 
-class CustomLoader(yaml.Loader):
+def _load_cache_from(raw_config):
+    try:
+        cache_from = raw_config['cache_from']
+    except KeyError:
+        return NOTHING
+    if isinstance(cache_from, str):
+        return [cache_from]
+    return list(cache_from)
+
+
+def get_cache_from(config, cache_registry=None):
+    # Return images to use as cache sources of the build. Without
+    # cache_from the image of the same name in the cache registry is
+    # used, if there is one.
+    if config.cache_from:
+        return list(config.cache_from)
+    if cache_registry:
+        return ['{}/{}'.format(cache_registry.rstrip('/'), config.tag)]
+    return []
+
+
+def get_saved_dockerfile(config):
+    # Return the path in the context that the in-line Dockerfile of the
+    # config is saved to, None for Dockerfiles that are files already
+    if config.dockerfile.name is not None:
+        return
+    return os.path.join(config.context, 'Dockerfile.' + config.tag)
+
+
+# LibYAML parser is several times faster than the pure Python one
+try:
+    _BaseLoader = yaml.CSafeLoader
+except AttributeError:
+    _BaseLoader = yaml.SafeLoader
+
+
+class CustomLoader(_BaseLoader):
     pass
 
 
@@ -109,3 +156,130 @@ def inline_constructor(loader, node):
 
 
 CustomLoader.add_constructor('!inline', inline_constructor)
+
+
+@attr.s
+class ConfigCache:
+    # Loaded configs and their dependency graph. The cache is valid while
+    # the multi-build file and the Dockerfiles it references have the
+    # same contents, files are read again only when their sizes or
+    # modification times change.
+    path = attr.ib(default=None)
+
+    def load(self, stream):
+        # Return configs and the dependents of every tag, as sorted by
+        # sort_configs
+        if self.path is None:
+            configs = load(stream)
+            return configs, sort_configs(list(configs.values()))
+
+        data = self.read()
+        if data is not None and data.get('name') == stream.name and data.get('cwd') == os.getcwd():
+            sources = _fresh_sources(data['sources'])
+            if sources is not None:
+                configs, all_dependents = _decode_graph(data)
+                if sources != data['sources']:
+                    self.save(stream.name, sources, configs, all_dependents)
+                return configs, all_dependents
+
+        contents = stream.read()
+        loaded_stream = io.StringIO(contents)
+        loaded_stream.name = stream.name
+        configs = load(loaded_stream)
+        all_dependents = sort_configs(list(configs.values()))
+        sources = [_stamp(stream.name, contents)]
+        sources.extend(_stamp(config.dockerfile.name, config.dockerfile.contents)
+                       for config in configs.values() if config.dockerfile.name is not None)
+        if None not in sources:
+            self.save(stream.name, sources, configs, all_dependents)
+        return configs, all_dependents
+
+    def read(self):
+        try:
+            with open(self.path) as fp:
+                data = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            return
+        if not isinstance(data, dict) or data.get('version') != CACHE_VERSION:
+            return
+        return data
+
+    def save(self, name, sources, configs, all_dependents):
+        data = _encode_graph(configs, all_dependents)
+        data.update(version=CACHE_VERSION, name=name, cwd=os.getcwd(), sources=sources)
+        try:
+            text = json.dumps(data)
+        except TypeError:
+            # Build arguments are not strings, e.g. dates
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as fp:
+            fp.write(text)
+        os.replace(temp_path, self.path)
+
+
+def _stamp(path, contents):
+    # Return the path, size, modification time and digest of the file,
+    # or None if the file has changed since the contents were read
+    try:
+        st = os.stat(path)
+        with open(path) as fp:
+            current = fp.read()
+    except OSError:
+        return
+    if current != contents:
+        return
+    return [path, st.st_size, st.st_mtime_ns, _text_digest(contents)]
+
+
+def _fresh_sources(sources):
+    # Return sources with updated sizes and modification times, or None
+    # if contents of any of them have changed
+    fresh = []
+    for path, size, mtime_ns, digest in sources:
+        try:
+            st = os.stat(path)
+            if st.st_size == size and st.st_mtime_ns == mtime_ns:
+                fresh.append([path, size, mtime_ns, digest])
+                continue
+            with open(path) as fp:
+                contents = fp.read()
+        except OSError:
+            return
+        if _text_digest(contents) != digest:
+            return
+        fresh.append([path, st.st_size, st.st_mtime_ns, digest])
+    return fresh
+
+
+def _text_digest(contents):
+    return hashlib.sha256(contents.encode('utf-8', 'surrogateescape')).hexdigest()
+
+
+def _encode_graph(configs, all_dependents):
+    return {
+        'configs': [{
+            'tag': config.tag,
+            'dockerfile': [config.dockerfile.contents, config.dockerfile.name],
+            'context': config.context,
+            'args': config.args,
+            'exports': [[export.container_src_path, export.dest_path] for export in config.exports],
+            'cache_from': config.cache_from,
+        } for config in configs.values()],
+        'dependents': [[tag, [dependent.tag for dependent in dependents]]
+                       for tag, dependents in all_dependents.items()],
+    }
+
+
+def _decode_graph(data):
+    configs = {}
+    for raw_config in data['configs']:
+        contents, name = raw_config['dockerfile']
+        configs[raw_config['tag']] = BuildConfig(raw_config['tag'], Dockerfile(contents, name=name),
+                                                 raw_config['context'], raw_config['args'],
+                                                 [BuildExport(*export) for export in raw_config['exports']],
+                                                 raw_config['cache_from'])
+    all_dependents = OrderedDict((tag, [configs[dependent] for dependent in dependents])
+                                 for tag, dependents in data['dependents'])
+    return configs, all_dependents
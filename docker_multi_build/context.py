@@ -0,0 +1,297 @@
+import base64
+import functools
+import hashlib
+import json
+import os
+import stat
+import tarfile
+import threading
+
+import attr
+
+from . import dockerignore
+from .config import get_saved_dockerfile
+from .state import STATE_DIRNAME
+
+try:
+    import grp
+    import pwd
+except ImportError:
+    grp = pwd = None
+
+
+CHUNK_SIZE = 1024 * 1024
+END_OF_ARCHIVE = tarfile.NUL * tarfile.BLOCKSIZE * 2
+INDEX_FILENAME = 'context-index.json'
+
+
+class ContextChanged(OSError):
+    pass
+
+
+@attr.s
+class ContextArchives:
+    # Tar archives of build contexts. Each context is scanned once and
+    # the archive is shared between all configs that use it, until an
+    # export writes into it.
+    index = attr.ib(default=None, repr=False)
+    archives = attr.ib(default=attr.Factory(dict), repr=False)
+    excluded = attr.ib(default=attr.Factory(dict), repr=False)
+    locks = attr.ib(default=attr.Factory(dict), repr=False)
+    lock = attr.ib(default=attr.Factory(threading.Lock), repr=False)
+
+    def prepare(self, configs):
+        # Called before the builds of the configs start. In-line
+        # Dockerfiles saved to the contexts are left out of the archives,
+        # every build adds its own Dockerfile, and builds rewrite them
+        # while other builds send the same context.
+        excluded = {}
+        for config in configs.values():
+            path = get_saved_dockerfile(config)
+            if path is not None:
+                excluded.setdefault(os.path.abspath(config.context), set()).add(os.path.basename(path))
+        with self.lock:
+            changed = [context for context in set(excluded) | set(self.excluded)
+                       if excluded.get(context) != self.excluded.get(context)]
+            self.excluded = excluded
+        for context in changed:
+            self.invalidate(context)
+
+    def get(self, context):
+        context = os.path.abspath(context)
+        with self.lock:
+            context_lock = self.locks.setdefault(context, threading.Lock())
+            excluded = self.excluded.get(context, set())
+        with context_lock:
+            archive = self.archives.get(context)
+            if archive is None:
+                archive = self.archives[context] = ContextArchive.create(context, self.index, excluded)
+        return archive
+
+    def invalidate(self, path):
+        path = os.path.abspath(path)
+        with self.lock:
+            contexts = [context for context in self.locks
+                        if path == context or path.startswith(os.path.join(context, ''))]
+        for context in contexts:
+            # Wait until the archive that is being created is stored
+            with self.locks[context]:
+                self.archives.pop(context, None)
+
+
+@attr.s
+class ContextArchive:
+    # Archive is never stored, only headers of members are prepared. File
+    # contents are read from disk while the archive is streamed.
+    context = attr.ib()
+    members = attr.ib(repr=False)
+
+    @classmethod
+    def create(cls, context, index=None, excluded=()):
+        # Excluded arcnames are left out besides the ones excluded by
+        # .dockerignore
+        context = os.path.abspath(context)
+        known = index.get(context) if index is not None else {}
+        headers = {}
+        members = []
+        for arcname, path, st in scan_context(context):
+            if arcname in excluded:
+                continue
+            key = [st.st_size, st.st_mtime_ns, st.st_mode, st.st_uid, st.st_gid]
+            try:
+                known_key, header = known[arcname]
+            except KeyError:
+                known_key = header = None
+            if known_key != key:
+                info = tarinfo_from_stat(path, arcname, st)
+                if info is None:
+                    continue
+                header = info.tobuf(tarfile.GNU_FORMAT, 'utf-8', 'surrogateescape')
+            headers[arcname] = (key, header)
+            size = st.st_size if stat.S_ISREG(st.st_mode) else 0
+            members.append(Member(path, header, size))
+        if index is not None:
+            index.update(context, headers)
+        return cls(context, members)
+
+    def stream(self, dockerfile_name, dockerfile_contents):
+        # Small members are joined into chunks of CHUNK_SIZE, so an HTTP
+        # chunk is not sent for every tiny file
+        buf = bytearray()
+        for member in self.members:
+            buf += member.header
+            if member.size:
+                for chunk in member.read():
+                    if len(chunk) == CHUNK_SIZE:
+                        if buf:
+                            yield bytes(buf)
+                            buf.clear()
+                        yield chunk
+                    else:
+                        buf += chunk
+                buf += padding(member.size)
+            if len(buf) >= CHUNK_SIZE:
+                yield bytes(buf)
+                buf.clear()
+        for chunk in dockerfile_member(dockerfile_name, dockerfile_contents):
+            buf += chunk
+        buf += END_OF_ARCHIVE
+        yield bytes(buf)
+
+
+@attr.s(slots=True)
+class Member:
+    path = attr.ib()
+    header = attr.ib(repr=False)
+    size = attr.ib()
+
+    def read(self):
+        # Size in the header is the one found when the context was
+        # scanned. A file that was replaced since then, e.g. by an export
+        # into the context, is not sent with a wrong size.
+        remaining = self.size
+        with open(self.path, 'rb') as fp:
+            if os.fstat(fp.fileno()).st_size != self.size:
+                raise ContextChanged(self.changed_message())
+            while remaining:
+                chunk = fp.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise ContextChanged(self.changed_message())
+                remaining -= len(chunk)
+                yield chunk
+
+    def changed_message(self):
+        return ("file '{}' has changed since its build context was scanned, it was written while the context was "
+                "being sent; build again".format(self.path))
+
+
+@attr.s
+class StatIndex:
+    # Persistent mapping of stat results of context files to their tar
+    # headers, files that didn't change since the last run are not
+    # processed again
+    path = attr.ib(default=None)
+    contexts = attr.ib(default=attr.Factory(dict), repr=False)
+
+    @classmethod
+    def load(cls, path):
+        if path is None:
+            return cls()
+        try:
+            with open(path) as fp:
+                data = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            return cls(path)
+        contexts = {context: {arcname: (key, base64.b64decode(header))
+                              for arcname, (key, header) in headers.items()}
+                    for context, headers in data.items()}
+        return cls(path, contexts)
+
+    def get(self, context):
+        return self.contexts.get(context, {})
+
+    def update(self, context, headers):
+        self.contexts[context] = headers
+
+    def save(self):
+        if self.path is None:
+            return
+        data = {context: {arcname: (key, base64.b64encode(header).decode('ascii'))
+                          for arcname, (key, header) in headers.items()}
+                for context, headers in self.contexts.items()}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as fp:
+            json.dump(data, fp)
+        os.replace(temp_path, self.path)
+
+
+def scan_context(context):
+    # Yield arcname, path and stat result of every file and directory in
+    # the context that is not excluded by .dockerignore
+    matcher = dockerignore.load(context) + dockerignore.parse([STATE_DIRNAME])
+    dirs = ['']
+    while dirs:
+        reldir = dirs.pop()
+        try:
+            entries = sorted(os.scandir(os.path.join(context, reldir)), key=lambda e: e.name)
+        except FileNotFoundError:
+            continue
+        subdirs = []
+        for entry in entries:
+            arcname = reldir + '/' + entry.name if reldir else entry.name
+            excluded = matcher.matches(arcname)
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if not excluded:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                yield arcname, entry.path, st
+            if is_dir and (not excluded or matcher.may_include_below(arcname)):
+                subdirs.append(arcname)
+        # Depth-first, in sorted order
+        dirs.extend(reversed(subdirs))
+
+
+def tarinfo_from_stat(path, arcname, st):
+    info = tarfile.TarInfo(arcname)
+    if stat.S_ISREG(st.st_mode):
+        info.type = tarfile.REGTYPE
+        info.size = st.st_size
+    elif stat.S_ISDIR(st.st_mode):
+        info.type = tarfile.DIRTYPE
+    elif stat.S_ISLNK(st.st_mode):
+        info.type = tarfile.SYMTYPE
+        info.linkname = os.readlink(path)
+    else:
+        # Sockets, FIFOs and devices are not sent
+        return
+    info.mode = stat.S_IMODE(st.st_mode)
+    info.uid = st.st_uid
+    info.gid = st.st_gid
+    info.mtime = st.st_mtime
+    info.uname = _user_name(st.st_uid)
+    info.gname = _group_name(st.st_gid)
+    return info
+
+
+@functools.lru_cache(maxsize=None)
+def _user_name(uid):
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except (AttributeError, KeyError):
+        return ''
+
+
+@functools.lru_cache(maxsize=None)
+def _group_name(gid):
+    try:
+        return grp.getgrgid(gid).gr_name
+    except (AttributeError, KeyError):
+        return ''
+
+
+def dockerfile_member(name, contents):
+    data = contents.encode('utf-8')
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = 0o644
+    yield info.tobuf(tarfile.GNU_FORMAT, 'utf-8', 'surrogateescape')
+    yield data
+    yield padding(len(data))
+
+
+def padding(size):
+    remainder = size % tarfile.BLOCKSIZE
+    if remainder:
+        return tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+    return b''
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
@@ -0,0 +1,145 @@
+import threading
+
+import attr
+import docker.errors
+
+from .sort_configs import get_base_image
+
+
+CHUNK_SIZE = 1024 * 1024
+
+
+@attr.s
+class DistributedBuilder:
+    # Builds every config with one of the builders, each talks to its
+    # own daemon. A config goes to the least busy daemon, the daemon that
+    # already holds the base image wins unless it's busier by more than
+    # transfer_cost builds. Otherwise the base image is copied to the
+    # chosen daemon first. Only daemons whose image has the ID expected in
+    # this run hold it, the ID of an image built by this builder, or the
+    # one found by its cluster client, e.g. for the build cache.
+    builders = attr.ib()
+    tags = attr.ib(default=attr.Factory(set))
+    transfer_cost = attr.ib(default=1)
+
+    locations = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+    image_ids = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+    load = attr.ib(init=False, repr=False)
+    lock = attr.ib(default=attr.Factory(threading.Lock), init=False, repr=False)
+    transfer_locks = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+
+    def __attrs_post_init__(self):
+        self.load = [0] * len(self.builders)
+
+    def build(self, config, export=True):
+        base_image = get_base_image(config)
+        if base_image not in self.tags:
+            base_image = None
+        holders = self.locate(base_image) if base_image is not None else set()
+        index = self.place(holders)
+        try:
+            if base_image is not None and holders and index not in holders:
+                self.transfer(base_image, min(holders), index)
+            image_id = self.builders[index].build(config, export=export)
+        finally:
+            with self.lock:
+                self.load[index] -= 1
+        with self.lock:
+            self.image_ids[config.tag] = image_id
+            self.locations[config.tag] = (image_id, {index})
+        return image_id
+
+    def run_exports(self, config, image_id):
+        with self.lock:
+            self.image_ids[config.tag] = image_id
+        holders = self.locate(config.tag)
+        self.builders[min(holders) if holders else 0].run_exports(config, image_id)
+
+    def place(self, holders):
+        with self.lock:
+            def cost(index):
+                penalty = self.transfer_cost if holders and index not in holders else 0
+                return self.load[index] + penalty, index not in holders, index
+            index = min(range(len(self.builders)), key=cost)
+            self.load[index] += 1
+        return index
+
+    def locate(self, tag):
+        # Daemons that hold the expected image, images that were not
+        # built in this run are looked up once per ID
+        with self.lock:
+            image_id = self.image_ids.get(tag)
+            located = self.locations.get(tag)
+        if located is not None and located[0] == image_id:
+            return set(located[1])
+        holders = set()
+        for index, builder in enumerate(self.builders):
+            try:
+                image = builder.client.images.get(tag)
+            except docker.errors.ImageNotFound:
+                continue
+            # Other daemons may hold an old image of the same tag
+            if image_id is None or image.id == image_id:
+                holders.add(index)
+        with self.lock:
+            located = self.locations.get(tag)
+            if located is None or located[0] != image_id:
+                located = self.locations[tag] = (image_id, holders)
+            return set(located[1])
+
+    def cluster_client(self):
+        # Images found by the client are expected on the other daemons
+        return ClusterClient([builder.client for builder in self.builders], image_ids=self.image_ids)
+
+    def transfer(self, tag, src, dest):
+        with self.lock:
+            transfer_lock = self.transfer_locks.setdefault((tag, dest), threading.Lock())
+        with transfer_lock:
+            with self.lock:
+                if dest in self.locations[tag][1]:
+                    return
+            copy_image(self.builders[src].client, self.builders[dest].client, tag)
+            with self.lock:
+                self.locations[tag][1].add(dest)
+
+
+def copy_image(src_client, dest_client, tag):
+    # The image is saved by tag, so it keeps the tag on the other daemon,
+    # and streamed without being stored
+    data = src_client.api.get_image(tag)
+    if hasattr(data, 'read'):
+        data = iter(lambda: data.read(CHUNK_SIZE), b'')
+    result = dest_client.api.load_image(data)
+    if result is not None:
+        # Newer docker-py streams the progress of loading
+        for _ in result:
+            pass
+
+
+@attr.s
+class ClusterClient:
+    # Enough of DockerClient for BuildCache, an image is found on any of
+    # the daemons. IDs of the found images are recorded in image_ids.
+    clients = attr.ib()
+    image_ids = attr.ib(default=None, repr=False)
+    images = attr.ib(init=False)
+
+    def __attrs_post_init__(self):
+        self.images = ClusterImages(self.clients, self.image_ids)
+
+
+@attr.s
+class ClusterImages:
+    clients = attr.ib()
+    image_ids = attr.ib(default=None, repr=False)
+
+    def get(self, name):
+        for client in self.clients:
+            try:
+                image = client.images.get(name)
+            except docker.errors.ImageNotFound:
+                continue
+            if self.image_ids is not None:
+                self.image_ids[name] = image.id
+            return image
+        raise docker.errors.ImageNotFound('image {} not found on any daemon'.format(name))
@@ -1,50 +1,85 @@
+from collections import OrderedDict
+import hashlib
 import re
+import threading
 
 import attr
 
 
+INSTRUCTION_RE = re.compile(r'^\s*(\w+)\s+(.*)$')  # matched group is insn
+CONTINUATION_RE = re.compile(r'^.*\\\s*$')          # line continues?
+COMMENT_RE = re.compile(r'^\s*#')                   # line is a comment?
+
+CACHE_SIZE = 1024
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
 def parse(lines):
     return [Instruction(token.instruction, token.arguments)
-            for token in tokenize(lines)]
+            for token in iter_tokens(lines)]
+
+
+def parse_contents(contents):
+    # Instructions are cached by digest of the Dockerfile, so that
+    # dependency checks of one config share a single parse
+    key = hashlib.sha1(contents.encode('utf-8')).digest()
+    with _cache_lock:
+        try:
+            instructions = _cache[key]
+        except KeyError:
+            pass
+        else:
+            _cache.move_to_end(key)
+            return instructions
+
+    instructions = tuple(parse(contents.splitlines()))
+    with _cache_lock:
+        _cache[key] = instructions
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return instructions
 
 
 def tokenize(lines):
+    return list(iter_tokens(lines))
+
+
+def iter_tokens(lines):
     # The function is taken from
     # https://github.com/DBuildService/dockerfile-parse with minor
     # changes
-    instructions = []
-    lineno = -1
-    insnre = re.compile(r'^\s*(\w+)\s+(.*)$')  # matched group is insn
-    contre = re.compile(r'^.*\\\s*$')          # line continues?
-    commentre = re.compile(r'^\s*#')           # line is a comment?
     in_continuation = False
-    current_instruction = None
-    for line in lines:
-        lineno += 1
-        if commentre.match(line):
+    instruction = None
+    for lineno, line in enumerate(lines):
+        if COMMENT_RE.match(line):
             continue
         if not in_continuation:
-            m = insnre.match(line)
+            m = INSTRUCTION_RE.match(line)
             if not m:
                 continue
-            current_instruction = Token(instruction=m.groups()[0].upper(),
-                                        startline=lineno,
-                                        endline=lineno,
-                                        content=line,
-                                        arguments=_rstrip_backslash(m.groups()[1]))
+            instruction = m.group(1).upper()
+            startline = lineno
+            content = [line]
+            arguments = [_rstrip_backslash(m.group(2))]
+            has_arguments = bool(arguments[0])
         else:
-            current_instruction.content += line
-            current_instruction.endline = lineno
-            if current_instruction.arguments:
-                current_instruction.arguments += _rstrip_backslash(line)
+            content.append(line)
+            if has_arguments:
+                arguments.append(_rstrip_backslash(line))
             else:
-                current_instruction.arguments = _rstrip_backslash(line.lstrip())
-
-        in_continuation = contre.match(line)
-        if not in_continuation and current_instruction is not None:
-            instructions.append(current_instruction)
+                arguments.append(_rstrip_backslash(line.lstrip()))
+                has_arguments = bool(arguments[-1])
 
-    return instructions
+        in_continuation = CONTINUATION_RE.match(line)
+        if not in_continuation and instruction is not None:
+            yield Token(instruction=instruction,
+                        startline=startline,
+                        endline=lineno,
+                        content=''.join(content),
+                        arguments=''.join(arguments))
+            instruction = None
 
 
 def _rstrip_backslash(l):
@@ -54,7 +89,7 @@ def _rstrip_backslash(l):
     return l
 
 
-@attr.s
+@attr.s(slots=True)
 class Token:
     instruction = attr.ib()
     startline = attr.ib()
@@ -63,7 +98,7 @@ class Token:
     arguments = attr.ib()
 
 
-@attr.s
+@attr.s(slots=True, frozen=True)
 class Instruction:
     name = attr.ib()
     arguments = attr.ib()
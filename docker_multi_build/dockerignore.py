@@ -0,0 +1,140 @@
+import fnmatch
+import os
+import re
+
+import attr
+
+
+def load(context):
+    try:
+        with open(os.path.join(context, '.dockerignore')) as fp:
+            return parse(fp.read().splitlines())
+    except FileNotFoundError:
+        return PatternMatcher([])
+
+
+def parse(lines):
+    patterns = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        pattern = Pattern.parse(line)
+        if pattern.dirs:
+            patterns.append(pattern)
+    return PatternMatcher(patterns)
+
+
+@attr.s
+class PatternMatcher:
+    # Matching rules are taken from
+    # https://github.com/moby/moby/blob/master/pkg/fileutils/fileutils.go,
+    # paths are relative to the context and separated by '/'
+    patterns = attr.ib()
+
+    def __add__(self, other):
+        return PatternMatcher(self.patterns + other.patterns)
+
+    def matches(self, path):
+        parent_dirs = path.split('/')[:-1]
+        matched = False
+        for pattern in self.patterns:
+            match = pattern.match(path)
+            if not match and len(pattern.dirs) <= len(parent_dirs):
+                match = pattern.match('/'.join(parent_dirs[:len(pattern.dirs)]))
+            if match:
+                matched = not pattern.exclusion
+        return matched
+
+    def may_include_below(self, dirpath):
+        # An excluded directory still has to be walked if an exception
+        # can match some path below it
+        dirs = dirpath.split('/')
+        for pattern in self.patterns:
+            if not pattern.exclusion:
+                continue
+            if '**' in pattern.cleaned:
+                return True
+            if len(pattern.dirs) > len(dirs) and all(
+                    fnmatch.fnmatchcase(d, p) for d, p in zip(dirs, pattern.dirs)):
+                return True
+        return False
+
+
+@attr.s
+class Pattern:
+    dirs = attr.ib()
+    exclusion = attr.ib(default=False)
+    regex = attr.ib(default=None, repr=False)
+
+    @classmethod
+    def parse(cls, line):
+        exclusion = line.startswith('!')
+        if exclusion:
+            line = line[1:]
+        dirs = _clean(line)
+        return cls(dirs, exclusion, re.compile(translate('/'.join(dirs))))
+
+    @property
+    def cleaned(self):
+        return '/'.join(self.dirs)
+
+    def match(self, path):
+        return self.regex.match(path) is not None
+
+
+def _clean(pattern):
+    # Leading and trailing slashes and '.' components are not relevant,
+    # '..' removes the previous component
+    dirs = []
+    for part in pattern.strip().split('/'):
+        if part in ('', '.'):
+            continue
+        if part == '..':
+            if dirs:
+                dirs.pop()
+            continue
+        dirs.append(part)
+    return dirs
+
+
+def translate(pattern):
+    # Same as fnmatch.translate, but '*' and '?' do not match '/', and
+    # '**' matches any number of directories
+    i, n = 0, len(pattern)
+    res = ['^']
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            if i < n and pattern[i] == '*':
+                i += 1
+                if i < n and pattern[i] == '/':
+                    i += 1
+                res.append('.*' if i >= n else '(.*/)?')
+            else:
+                res.append('[^/]*')
+        elif c == '?':
+            res.append('[^/]')
+        elif c == '[':
+            j = i
+            if j < n and pattern[j] == '!':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            while j < n and pattern[j] != ']':
+                j += 1
+            if j >= n:
+                res.append('\\[')
+            else:
+                stuff = pattern[i:j].replace('\\', '\\\\')
+                i = j + 1
+                if stuff[0] == '!':
+                    stuff = '^' + stuff[1:]
+                elif stuff[0] == '^':
+                    stuff = '\\' + stuff
+                res.append('[{}]'.format(stuff))
+        else:
+            res.append(re.escape(c))
+    res.append('$')
+    return ''.join(res)
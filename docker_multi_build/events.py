@@ -0,0 +1,46 @@
+from collections import deque
+import re
+
+import attr
+from docker.errors import BuildError
+
+
+IMAGE_ID_RE = re.compile(r'^(Successfully built |sha256:)([0-9a-f]+)')
+TAIL_SIZE = 20
+
+
+@attr.s
+class BuildEvents:
+    # Follows the events of a build as they arrive. Only the last event
+    # and a few last lines of output are kept, no matter how much the
+    # build prints.
+    last_event = attr.ib(default=None)
+    image_id = attr.ib(default=None)
+    error = attr.ib(default=None)
+    tail = attr.ib(default=attr.Factory(lambda: deque(maxlen=TAIL_SIZE)), repr=False)
+
+    def feed(self, event):
+        self.last_event = event
+        aux = event.get('aux')
+        if isinstance(aux, dict) and aux.get('ID'):
+            self.image_id = aux['ID']
+        line = event.get('stream')
+        if line:
+            self.tail.append(line)
+            match = IMAGE_ID_RE.search(line)
+            if match:
+                self.image_id = match.group(2)
+        if 'error' in event:
+            self.error = event['error']
+
+    def result(self):
+        # Return the ID of the built image, or raise BuildError with the
+        # last lines of output
+        if self.last_event is None:
+            raise BuildError('Unknown')
+        if self.error is None and self.image_id is not None:
+            return self.image_id
+        reason = self.error or self.last_event
+        if self.tail:
+            reason = '{}\n{}'.format(reason, ''.join(self.tail).rstrip('\n'))
+        raise BuildError(reason)
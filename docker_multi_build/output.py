@@ -0,0 +1,155 @@
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+
+import attr
+
+
+INTERVAL = 0.1
+CLOSE = object()
+
+
+@attr.s
+class Output:
+    # Output of concurrent builds is queued and written by a single
+    # thread in batches, so build threads never wait for the terminal.
+    # Text is split into lines per tag, lines of different tags never
+    # interleave.
+    stream = attr.ib(default=attr.Factory(lambda: sys.stdout), repr=False)
+    tty = attr.ib(default=False)
+    log_dir = attr.ib(default=None)
+    rate = attr.ib(default=None)
+    interval = attr.ib(default=INTERVAL)
+
+    queue = attr.ib(default=attr.Factory(queue.Queue), init=False, repr=False)
+    thread = attr.ib(default=None, init=False, repr=False)
+    pending = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+    windows = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+    latest = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+    drawn = attr.ib(default=0, init=False, repr=False)
+    log_files = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def start(self):
+        if self.log_dir is not None:
+            os.makedirs(self.log_dir, exist_ok=True)
+        self.thread = threading.Thread(target=self.run, name='output', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.queue.put(CLOSE)
+        self.thread.join()
+
+    def write(self, tag, text):
+        self.queue.put((tag, text))
+
+    def run(self):
+        closed = False
+        while not closed:
+            items = [self.queue.get()]
+            if items[0] is not CLOSE:
+                # Let more output pile up, it's written at once
+                time.sleep(self.interval)
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            for item in items:
+                if item is CLOSE:
+                    closed = True
+                    continue
+                tag, text = item
+                lines.extend(self.split_lines(tag, text))
+            if closed:
+                # Unterminated lines are written as they are
+                lines.extend((tag, text) for tag, text in self.pending.items() if text)
+                self.pending.clear()
+            try:
+                self.write_lines(lines, final=closed)
+            except Exception:
+                # Output errors must not bring the build down
+                pass
+        for fp in self.log_files.values():
+            fp.close()
+
+    def split_lines(self, tag, text):
+        text = self.pending.pop(tag, '') + text
+        *lines, rest = text.split('\n')
+        if rest:
+            self.pending[tag] = rest
+        return [(tag, line) for line in lines]
+
+    def write_lines(self, lines, final=False):
+        for tag, line in lines:
+            self.log(tag, line)
+        if self.tty:
+            for tag, line in lines:
+                self.latest[tag] = line
+            self.redraw()
+        else:
+            self.stream.write(''.join(self.format_line(tag, line) for tag, line in self.limit(lines, final)))
+        self.stream.flush()
+        for fp in self.log_files.values():
+            fp.flush()
+
+    def limit(self, lines, final=False):
+        # Lines over the rate of a tag are dropped from the terminal, the
+        # number of dropped lines is reported once the next second starts
+        if self.rate is None:
+            yield from lines
+            return
+        now = time.monotonic()
+        for tag, window in self.windows.items():
+            if window[2] and (final or now - window[0] >= 1):
+                yield tag, '... {} lines skipped'.format(window[2])
+                self.windows[tag] = [now, 0, 0]
+        for tag, line in lines:
+            window = self.windows.get(tag)
+            if window is None or now - window[0] >= 1:
+                window = self.windows[tag] = [now, 0, 0]
+            if window[1] < self.rate:
+                window[1] += 1
+                yield tag, line
+            else:
+                window[2] += 1
+        if final:
+            for tag, window in self.windows.items():
+                if window[2]:
+                    yield tag, '... {} lines skipped'.format(window[2])
+
+    def redraw(self):
+        # Show the latest line of every tag, in order of appearance. The
+        # cursor can't move up past the top of the terminal, only the tags
+        # that appeared last are shown when there are more than its rows.
+        width, height = shutil.get_terminal_size()
+        latest = list(self.latest.items())[-max(height - 1, 1):]
+        chunks = []
+        if self.drawn:
+            chunks.append('\x1b[{}F'.format(self.drawn))
+        for tag, line in latest:
+            chunks.append('\x1b[2K' + self.format_line(tag, line)[:width - 1].rstrip('\n') + '\n')
+        self.drawn = len(latest)
+        self.stream.write(''.join(chunks))
+
+    def log(self, tag, line):
+        if self.log_dir is None:
+            return
+        fp = self.log_files.get(tag)
+        if fp is None:
+            filename = tag.replace('/', '_').replace(':', '_') + '.log'
+            fp = self.log_files[tag] = open(os.path.join(self.log_dir, filename), 'w')
+        fp.write(line + '\n')
+
+    def format_line(self, tag, line):
+        return '{} | {}\n'.format(tag, line)
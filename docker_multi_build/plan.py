@@ -0,0 +1,76 @@
+import attr
+
+from .sort_configs import get_dependencies
+
+
+@attr.s
+class Plan:
+    # Build order and dependency levels of a sorted graph. An image is on
+    # the level of its longest chain of dependencies. Images of different
+    # levels may build at the same time too, so the widest level is not a
+    # bound of concurrency. Estimated parallelism is the sum of weights
+    # divided by the weight of the critical path.
+    order = attr.ib()
+    levels = attr.ib()
+    critical_path = attr.ib()
+    weights = attr.ib(repr=False)
+
+    @property
+    def total_weight(self):
+        return sum(self.weights.values())
+
+    @property
+    def critical_weight(self):
+        return sum(self.weights[tag] for tag in self.critical_path)
+
+    @property
+    def widest_level(self):
+        return max((len(level) for level in self.levels), default=0)
+
+    @property
+    def parallelism(self):
+        critical_weight = self.critical_weight
+        return self.total_weight / critical_weight if critical_weight else 0
+
+    def dump(self):
+        return {
+            'order': self.order,
+            'levels': self.levels,
+            'critical_path': self.critical_path,
+            'weights': self.weights,
+            'widest_level': self.widest_level,
+            'parallelism': self.parallelism,
+        }
+
+
+def make_plan(all_dependents, durations=None):
+    # Images are weighted by their recorded build durations, images that
+    # have never been built weigh as much as an average known image, or 1
+    # when nothing is known, like in MultiBuilder.setup_priorities
+    durations = durations or {}
+    known = [durations[tag] for tag in all_dependents if tag in durations]
+    default_weight = sum(known) / len(known) if known else 1
+    weights = {tag: durations.get(tag, default_weight) for tag in all_dependents}
+
+    all_dependencies = get_dependencies(all_dependents)
+    depths = {}
+    finish = {}
+    previous = {}
+    for tag in all_dependents:
+        dependencies = all_dependencies[tag]
+        depths[tag] = max((depths[dependency] + 1 for dependency in dependencies), default=0)
+        slowest = max(dependencies, key=lambda dependency: finish[dependency], default=None)
+        previous[tag] = slowest
+        finish[tag] = weights[tag] + (finish[slowest] if slowest is not None else 0)
+
+    levels = [[] for _ in range(max(depths.values(), default=-1) + 1)]
+    for tag in all_dependents:
+        levels[depths[tag]].append(tag)
+
+    critical_path = []
+    tag = max(finish, key=finish.get, default=None)
+    while tag is not None:
+        critical_path.append(tag)
+        tag = previous[tag]
+    critical_path.reverse()
+    return Plan(list(all_dependents), levels, critical_path, weights)
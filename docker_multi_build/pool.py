@@ -0,0 +1,90 @@
+import contextlib
+import os
+import threading
+
+import attr
+
+
+STREAM = 'stream'
+CALL = 'call'
+
+
+@attr.s
+class ClientPool:
+    # Docker clients shared by build and export threads. A client is used
+    # by one thread at a time and keeps its connection between uses. Long
+    # streams of builds and archives have their own lane, so short calls
+    # like images.get never wait behind them.
+    factory = attr.ib(repr=False)
+    size = attr.ib(default=None)
+    lanes = attr.ib(init=False)
+
+    def __attrs_post_init__(self):
+        if self.size is None:
+            # Default number of workers of ThreadPoolExecutor before Python
+            # 3.8, it's never less than min(32, CPUs + 4) of later versions
+            self.size = (os.cpu_count() or 1) * 5
+        self.lanes = {STREAM: Lane(self.size), CALL: Lane(self.size)}
+
+    def lease(self, lane):
+        return self.lanes[lane].lease(self.factory)
+
+    def stats(self):
+        return {name: lane.stats() for name, lane in self.lanes.items()}
+
+
+@attr.s
+class Lane:
+    size = attr.ib()
+    idle = attr.ib(default=attr.Factory(list), repr=False)
+    created = attr.ib(default=0)
+    leases = attr.ib(default=0)
+    reuses = attr.ib(default=0)
+    waits = attr.ib(default=0)
+    cond = attr.ib(default=attr.Factory(threading.Condition), repr=False)
+
+    @contextlib.contextmanager
+    def lease(self, factory):
+        client = None
+        with self.cond:
+            self.leases += 1
+            if not self.idle and self.created >= self.size:
+                self.waits += 1
+                while not self.idle:
+                    self.cond.wait()
+            if self.idle:
+                client = self.idle.pop()
+                self.reuses += 1
+            else:
+                self.created += 1
+        if client is None:
+            try:
+                client = factory()
+            except BaseException:
+                with self.cond:
+                    self.created -= 1
+                    self.cond.notify()
+                raise
+        try:
+            yield client
+        finally:
+            with self.cond:
+                self.idle.append(client)
+                self.cond.notify()
+
+    def stats(self):
+        with self.cond:
+            return {'created': self.created, 'leases': self.leases, 'reuses': self.reuses, 'waits': self.waits}
+
+
+def lease(client, clients, lane):
+    # Lease a client of the lane, or use the only client if there is no
+    # pool
+    if clients is None:
+        return _single(client)
+    return clients.lease(lane)
+
+
+@contextlib.contextmanager
+def _single(client):
+    yield client
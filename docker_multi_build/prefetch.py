@@ -0,0 +1,160 @@
+from concurrent import futures
+import contextlib
+import threading
+import time
+
+import attr
+import docker.errors
+import docker.utils
+
+from . import pool
+from .build import capture_responses
+from .config import get_cache_from
+from .sort_configs import get_base_image, get_base_reference
+
+
+PULL_WORKERS = 4
+
+
+class PullError(Exception):
+    pass
+
+
+def external_base_images(configs):
+    # Return base images that are not built from the configs, in order
+    # of the configs and without duplicates. Images that are built from
+    # scratch have no base, and bases with build arguments are only
+    # known to the daemon.
+    images = []
+    for config in configs.values():
+        if get_base_image(config) in configs:
+            continue
+        image = get_base_reference(config)
+        if image == 'scratch' or '$' in image or image in images:
+            continue
+        images.append(image)
+    return images
+
+
+def cache_images(configs, cache_registry=None):
+    # Return images of the layer cache of the configs without duplicates
+    images = []
+    for config in configs.values():
+        for image in get_cache_from(config, cache_registry):
+            if image not in images:
+                images.append(image)
+    return images
+
+
+@attr.s
+class Prefetcher:
+    # Images needed by the builds are pulled in the background while
+    # contexts are uploaded. Every image is pulled once, however many
+    # builds wait for it, and images that are present already are not
+    # pulled at all, like builds don't pull them without --pull. The
+    # backend has exists(image) and pull(image) methods, the latter
+    # yields progress events of the daemon.
+    backend = attr.ib(repr=False)
+    output = attr.ib(default=None, repr=False)
+    workers = attr.ib(default=PULL_WORKERS)
+
+    executor = attr.ib(default=None, init=False, repr=False)
+    pulls = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+    lock = attr.ib(default=attr.Factory(threading.Lock), init=False, repr=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def start(self, images):
+        with self.lock:
+            for image in images:
+                if image in self.pulls:
+                    continue
+                if self.executor is None:
+                    self.executor = futures.ThreadPoolExecutor(self.workers)
+                self.pulls[image] = self.executor.submit(self.pull, image)
+
+    def wait(self, images):
+        # Wait for the started pulls of the images. Failed pulls are
+        # reported already, the build pulls the image once more and fails
+        # with the error of the daemon.
+        with self.lock:
+            pulls = [self.pulls[image] for image in images if image in self.pulls]
+        futures.wait(pulls)
+
+    def pull(self, image):
+        # Return True if the image has been pulled, False if it's present
+        if self.backend.exists(image):
+            return False
+        started = time.monotonic()
+        self.write(image, 'Pulling {}'.format(image))
+        try:
+            for event in self.backend.pull(image):
+                if 'error' in event:
+                    raise PullError(event['error'])
+                line = format_event(event)
+                if line is not None:
+                    self.write(image, line)
+        except Exception as exc:
+            self.write(image, 'Failed to pull {}: {}'.format(image, exc))
+            raise
+        self.write(image, 'Pulled {} in {:.1f}s'.format(image, time.monotonic() - started))
+        return True
+
+    def write(self, image, line):
+        if self.output is not None:
+            self.output.write(image, line + '\n')
+        else:
+            print(image, '|', line)
+
+    def close(self):
+        # Pulls that no build waits for are not waited for either
+        with self.lock:
+            for f in self.pulls.values():
+                f.cancel()
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+
+
+def format_event(event):
+    # Progress bars of layers are skipped, they are redrawn several times
+    # a second
+    if 'progressDetail' in event and event['progressDetail']:
+        return
+    status = event.get('status')
+    if not status:
+        return
+    if event.get('id'):
+        return '{}: {}'.format(event['id'], status)
+    return status
+
+
+@attr.s
+class DockerPull:
+    # Pull backend of the Docker daemon. Streams of pulls are registered
+    # with the cancellation, so they are shut down with the builds.
+    client = attr.ib(repr=False)
+    clients = attr.ib(default=None, repr=False)
+    cancellation = attr.ib(default=None, repr=False)
+
+    def exists(self, image):
+        with pool.lease(self.client, self.clients, pool.CALL) as client:
+            try:
+                client.images.get(image)
+            except docker.errors.ImageNotFound:
+                return False
+        return True
+
+    def pull(self, image):
+        repository, tag = docker.utils.parse_repository_tag(image)
+        with pool.lease(self.client, self.clients, pool.STREAM) as client:
+            with capture_responses(client.api) as responses:
+                events = client.api.pull(repository, tag or 'latest', stream=True, decode=True)
+            with contextlib.ExitStack() as stack:
+                if self.cancellation is not None:
+                    for response in responses:
+                        stack.enter_context(self.cancellation.stream(image, response))
+                yield from events
@@ -0,0 +1,125 @@
+from collections import OrderedDict
+import io
+import os
+import subprocess
+
+from . import config as config_module
+from . import dockerignore
+from .sort_configs import get_dependencies, get_direct_dependents
+from .state import STATE_DIRNAME
+
+
+class SelectionError(Exception):
+    pass
+
+
+def select(configs, all_dependents, targets=(), changed=None):
+    # Return configs of the targets and their dependencies, or of all tags
+    # if there are no targets. If changed tags are given, only they and
+    # their dependents are kept.
+    selected = set(configs)
+    if targets:
+        unknown = sorted(set(targets) - set(configs))
+        if unknown:
+            raise SelectionError('unknown targets: {}'.format(', '.join(unknown)))
+        selected = with_dependencies(all_dependents, targets)
+    if changed is not None:
+        selected &= with_dependents(all_dependents, changed)
+    return {tag: config for tag, config in configs.items() if tag in selected}
+
+
+def subgraph(all_dependents, tags):
+    # Return dependents of the given tags among themselves, in the same
+    # order as sort_configs would return them
+    return OrderedDict((tag, [dependent for dependent in dependents if dependent.tag in tags])
+                       for tag, dependents in all_dependents.items() if tag in tags)
+
+
+def outside_dependencies(all_dependents, tags):
+    # Return direct dependencies of the tags that are not among them
+    all_dependencies = get_dependencies(all_dependents)
+    return {dependency for tag in tags for dependency in all_dependencies[tag] if dependency not in tags}
+
+
+def with_dependencies(all_dependents, tags):
+    all_dependencies = get_dependencies(all_dependents)
+    return _closure(tags, lambda tag: all_dependencies[tag])
+
+
+def with_dependents(all_dependents, tags):
+    return _closure(tags, lambda tag: get_direct_dependents(all_dependents, tag))
+
+
+def _closure(tags, neighbours):
+    seen = set(tags)
+    stack = list(tags)
+    while stack:
+        for other in neighbours(stack.pop()):
+            if other not in seen:
+                seen.add(other)
+                stack.append(other)
+    return seen
+
+
+def changed_since(configs, rev, path):
+    # Return tags of the configs whose context files or Dockerfiles have
+    # changed since the git revision. path is the multi-build file, its
+    # old version tells which in-line Dockerfiles have changed.
+    cwd = os.path.dirname(os.path.realpath(path))
+    toplevel = git(['rev-parse', '--show-toplevel'], cwd).strip()
+    changed_files = [os.path.join(toplevel, name) for name in
+                     git(['diff', '--name-only', '-z', rev, '--', '.'], toplevel).split('\0') +
+                     git(['ls-files', '--others', '--exclude-standard', '-z', '--', '.'], toplevel).split('\0')
+                     if name]
+    old_configs = load_old_configs(rev, path, toplevel)
+
+    changed = set()
+    for tag, config in configs.items():
+        old_config = old_configs.get(tag)
+        if old_config is None or old_config != config:
+            changed.add(tag)
+        elif config.dockerfile.name is not None and os.path.realpath(config.dockerfile.name) in changed_files:
+            changed.add(tag)
+        elif is_context_changed(config.context, changed_files):
+            changed.add(tag)
+    return changed
+
+
+def is_context_changed(context, changed_files):
+    context = os.path.realpath(context)
+    prefix = os.path.join(context, '')
+    matcher = None
+    for path in changed_files:
+        if not path.startswith(prefix):
+            continue
+        if matcher is None:
+            matcher = dockerignore.load(context) + dockerignore.parse([STATE_DIRNAME])
+        if not matcher.matches(os.path.relpath(path, context).replace(os.sep, '/')):
+            return True
+    return False
+
+
+def load_old_configs(rev, path, toplevel):
+    relpath = os.path.relpath(os.path.realpath(path), toplevel).replace(os.sep, '/')
+    try:
+        contents = git(['show', '{}:{}'.format(rev, relpath)], toplevel)
+    except SelectionError:
+        # The file didn't exist, everything has changed
+        return {}
+    stream = io.StringIO(contents)
+    # Paths in the old file are resolved as in the current one
+    stream.name = path
+    try:
+        return config_module.load(stream)
+    except (OSError, ValueError, TypeError):
+        # Dockerfiles referenced by the old file may be gone
+        return {}
+
+
+def git(args, cwd):
+    try:
+        return subprocess.check_output(['git'] + args, cwd=cwd, stderr=subprocess.PIPE).decode()
+    except FileNotFoundError:
+        raise SelectionError('git is not installed')
+    except subprocess.CalledProcessError as exc:
+        raise SelectionError(exc.stderr.decode().strip() or 'git {} failed'.format(' '.join(args)))
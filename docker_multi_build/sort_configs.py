@@ -2,7 +2,7 @@ from collections import OrderedDict
 import os
 import shlex
 
-from .dockerfile import parse
+from .dockerfile import parse_contents
 
 
 class DependencyError(Exception):
@@ -11,34 +11,98 @@ class DependencyError(Exception):
 
 def sort_configs(configs):
     # Topological sort (Cormen/Tarjan algorithm) implementation is taken
-    # from docker-compose
-    unmarked = configs[:]
-    temporary_marked = set()
+    # from docker-compose, recursion is replaced with a stack, so deep
+    # graphs don't hit the recursion limit
+    dependents = get_all_dependents(configs)
+    temporary_marked = OrderedDict()
+    marked = set()
     sorted_configs = []
-    dependents = {config.tag: list(get_config_dependents(config, configs)) for config in configs}
-
-    def visit(n):
-        if n.tag in temporary_marked:
-            if is_base_image(n, n):
-                raise DependencyError('An image can not be based on itself: %s' % n.tag)
-            # Skip other checks if image depends on itself
-            if is_exported_file_copied(n, n):
-                return
-            raise DependencyError('Circular dependency between %s' % ' and '.join(temporary_marked))
-
-        if n in unmarked:
-            temporary_marked.add(n.tag)
-            dependents
-            for m in dependents[n.tag]:
-                visit(m)
-            temporary_marked.remove(n.tag)
-            unmarked.remove(n)
-            sorted_configs.insert(0, n)
-
-    while unmarked:
-        visit(unmarked[-1])
 
-    return OrderedDict([(n.tag, dependents[n.tag]) for n in sorted_configs])
+    for config in reversed(configs):
+        if config.tag in marked:
+            continue
+        temporary_marked[config.tag] = None
+        stack = [(config, iter(dependents[config.tag]))]
+        while stack:
+            n, it = stack[-1]
+            for m in it:
+                if m.tag in temporary_marked:
+                    if is_base_image(m, m):
+                        raise DependencyError('An image can not be based on itself: %s' % m.tag)
+                    # Skip other checks if image depends on itself
+                    if is_exported_file_copied(m, m):
+                        continue
+                    raise DependencyError('Circular dependency between %s' % ' and '.join(temporary_marked))
+                if m.tag not in marked:
+                    temporary_marked[m.tag] = None
+                    stack.append((m, iter(dependents[m.tag])))
+                    break
+            else:
+                stack.pop()
+                del temporary_marked[n.tag]
+                marked.add(n.tag)
+                sorted_configs.append(n)
+
+    return OrderedDict([(n.tag, dependents[n.tag]) for n in reversed(sorted_configs)])
+
+
+def get_dependencies(all_dependents):
+    dependencies = {tag: [] for tag in all_dependents}
+    for tag in all_dependents:
+        for dependent in get_direct_dependents(all_dependents, tag):
+            dependencies[dependent].append(tag)
+    return dependencies
+
+
+def get_direct_dependents(all_dependents, tag):
+    for dependent in all_dependents[tag]:
+        if dependent.tag != tag:
+            yield dependent.tag
+
+
+def get_all_dependents(configs):
+    # Every Dockerfile is parsed once. Base images are looked up by tag,
+    # copied paths are matched against a prefix tree of exported paths.
+    tags = {config.tag for config in configs}
+    exported_paths = PrefixTree()
+    for config in configs:
+        for exported_path in get_exported_paths(config):
+            exported_paths.add(exported_path, config.tag)
+
+    dependents = {config.tag: [] for config in configs}
+    for config in configs:
+        instructions = parse_contents(config.dockerfile.contents)
+        dependencies = set()
+        base_image = _get_base_image(config, instructions)
+        if base_image in tags:
+            dependencies.add(base_image)
+        for copied_path in _get_copied_paths(instructions):
+            dependencies.update(exported_paths.prefixes_of(os.path.normpath(copied_path)))
+        for tag in dependencies:
+            dependents[tag].append(config)
+    return dependents
+
+
+class PrefixTree:
+    # Character trie, so that matching is the same as in
+    # is_exported_file_copied, e.g. 'dist' is a prefix of 'dist-info'
+    def __init__(self):
+        self.root = {}
+
+    def add(self, key, value):
+        node = self.root
+        for c in key:
+            node = node.setdefault(c, {})
+        node.setdefault(None, []).append(value)
+
+    def prefixes_of(self, key):
+        node = self.root
+        yield from node.get(None, ())
+        for c in key:
+            node = node.get(c)
+            if node is None:
+                return
+            yield from node.get(None, ())
 
 
 def get_config_dependents(config_a, all_configs):
@@ -52,14 +116,25 @@ def is_base_image(config_a, config_b):
 
 
 def get_base_image(config):
-    instructions = parse(config.dockerfile.contents.splitlines())
+    instructions = parse_contents(config.dockerfile.contents)
+    return _get_base_image(config, instructions)
+
+
+def get_base_reference(config):
+    # Return the base image with its tag or digest, as it's pulled
+    instructions = parse_contents(config.dockerfile.contents)
+    return _get_base_reference(config, instructions)
+
+
+def _get_base_reference(config, instructions):
     for instr in instructions:
         if instr.name == 'FROM':
-            base_image = instr.arguments
-            break
-    else:
-        raise ValueError("Dockerfile of image '{}' doesn't contain FROM-clause".format(config.tag))
+            return instr.arguments.strip().partition(' ')[0]
+    raise ValueError("Dockerfile of image '{}' doesn't contain FROM-clause".format(config.tag))
 
+
+def _get_base_image(config, instructions):
+    base_image = _get_base_reference(config, instructions)
     if '@' in base_image:
         parts = base_image.split('@', 1)
     elif ':' in base_image:
@@ -70,12 +145,7 @@ def get_base_image(config):
 
 
 def is_exported_file_copied(config_a, config_b):
-    for export in config_a.exports:
-        exported_path = export.dest_path
-        if exported_path == '.':
-            exported_path = os.path.basename(export.container_src_path)
-        exported_path = os.path.normpath(exported_path)
-
+    for exported_path in get_exported_paths(config_a):
         for copied_path in get_copied_paths(config_b):
             copied_path = os.path.normpath(copied_path)
             if copied_path.startswith(exported_path):
@@ -84,8 +154,31 @@ def is_exported_file_copied(config_a, config_b):
     return False
 
 
+def get_exported_paths(config):
+    for export in config.exports:
+        exported_path = export.dest_path
+        if exported_path == '.':
+            exported_path = os.path.basename(export.container_src_path)
+        yield os.path.normpath(exported_path)
+
+
+def get_export_destination(export):
+    # Return the real path the export writes, like docker_copy resolves
+    # it: a file or a directory exported to an existing directory is
+    # written into it, unless the contents of the directory are exported
+    src_path = export.container_src_path
+    dest_path = export.dest_path
+    if not src_path.endswith('/.') and os.path.isdir(dest_path):
+        dest_path = os.path.join(dest_path, os.path.basename(src_path.rstrip('/')))
+    return os.path.realpath(dest_path)
+
+
 def get_copied_paths(config):
-    instructions = parse(config.dockerfile.contents.splitlines())
+    instructions = parse_contents(config.dockerfile.contents)
+    return _get_copied_paths(instructions)
+
+
+def _get_copied_paths(instructions):
     for instr in instructions:
         if instr.name in ('COPY', 'ADD'):
             args = shlex.split(instr.arguments)
@@ -0,0 +1,52 @@
+import json
+import os
+
+import attr
+
+
+STATE_DIRNAME = '.docker-multi-build'
+STATE_FILENAME = 'state.json'
+
+
+def default_path(stream, filename=STATE_FILENAME):
+    try:
+        stream_name = stream.name
+    except AttributeError:
+        return
+    if stream_name.startswith('<'):
+        # stdin and other pseudo-files
+        return
+    return os.path.join(os.path.dirname(stream_name), STATE_DIRNAME, filename)
+
+
+@attr.s
+class State:
+    path = attr.ib(default=None)
+    durations = attr.ib(default=attr.Factory(dict))
+    builds = attr.ib(default=attr.Factory(dict))
+    exports = attr.ib(default=attr.Factory(dict))
+
+    @classmethod
+    def load(cls, path):
+        if path is None:
+            return cls()
+        try:
+            with open(path) as fp:
+                data = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            # Corrupt state only costs the recorded durations and caches
+            data = {}
+        return cls(path, durations=data.get('durations', {}), builds=data.get('builds', {}),
+                   exports=data.get('exports', {}))
+
+    def save(self):
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as fp:
+            json.dump(self.dump(), fp, indent=2, sort_keys=True)
+        os.replace(temp_path, self.path)
+
+    def dump(self):
+        return {'durations': self.durations, 'builds': self.builds, 'exports': self.exports}
@@ -0,0 +1,97 @@
+import asyncio
+import contextlib
+import json
+import os
+import threading
+import time
+
+import attr
+
+
+@attr.s
+class Tracer:
+    # Records spans of work as Chrome trace events, one row per thread or
+    # per task of an event loop. The file can be loaded in
+    # chrome://tracing or Perfetto. Metadata of the run is saved as
+    # otherData.
+    enabled = attr.ib(default=True)
+    events = attr.ib(default=attr.Factory(list), repr=False)
+    metadata = attr.ib(default=attr.Factory(dict), repr=False)
+    started = attr.ib(default=attr.Factory(time.perf_counter), repr=False)
+    threads = attr.ib(default=attr.Factory(dict), repr=False)
+    lock = attr.ib(default=attr.Factory(threading.Lock), repr=False)
+
+    def now(self):
+        return time.perf_counter()
+
+    @contextlib.contextmanager
+    def span(self, name, tag=None, **args):
+        if not self.enabled:
+            yield args
+            return
+        start = self.now()
+        try:
+            # Arguments can be added while the span is open
+            yield args
+        finally:
+            self.add(name, start, self.now(), tag, **args)
+
+    def add(self, name, start, end, tag=None, **args):
+        if not self.enabled:
+            return
+        if tag is not None:
+            args['tag'] = tag
+        event = {
+            'name': name if tag is None else '{} {}'.format(name, tag),
+            'cat': name,
+            'ph': 'X',
+            'ts': (start - self.started) * 1e6,
+            'dur': (end - start) * 1e6,
+            'pid': os.getpid(),
+            'tid': self.thread_id(tag),
+            'args': args,
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def thread_id(self, tag=None):
+        # Small numbers are easier to read than thread idents, the thread
+        # name is given to the row in metadata. Tasks of an event loop all
+        # run on its thread, their spans overlap, so every task gets a row
+        # named after the tag of its first span.
+        thread = threading.current_thread()
+        task = current_task()
+        if task is None:
+            key, name = thread.ident, thread.name
+        else:
+            key, name = task, '{} {}'.format(thread.name, tag or 'task')
+        with self.lock:
+            tid = self.threads.get(key)
+            if tid is None:
+                tid = self.threads[key] = len(self.threads) + 1
+                self.events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid,
+                                    'args': {'name': name}})
+        return tid
+
+    def save(self, path):
+        with self.lock:
+            data = {'traceEvents': list(self.events), 'displayTimeUnit': 'ms'}
+            if self.metadata:
+                data['otherData'] = dict(self.metadata)
+        with open(path, 'w') as fp:
+            json.dump(data, fp)
+
+
+def current_task():
+    # Task of the event loop that runs in the current thread, if any
+    loop = asyncio._get_running_loop()
+    if loop is None:
+        return
+    try:
+        return asyncio.current_task(loop)
+    except AttributeError:
+        # Python 3.6
+        return asyncio.Task.current_task(loop)
+
+
+NULL_TRACER = Tracer(enabled=False)
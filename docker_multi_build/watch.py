@@ -0,0 +1,308 @@
+from concurrent import futures
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+
+import attr
+import yaml
+
+from . import config as config_module
+from . import dockerignore
+from . import selection
+from .build import Cancellation
+from .sort_configs import DependencyError, get_export_destination, sort_configs
+from .state import STATE_DIRNAME
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_MOVE_SELF | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+POLL_INTERVAL = 0.1
+
+
+class WatchError(Exception):
+    pass
+
+
+@attr.s
+class Inotify:
+    # Directory watches through the inotify API of libc, files are
+    # watched through their directories so that editors replacing them
+    # are noticed
+    fd = attr.ib(default=None)
+    dirs = attr.ib(default=attr.Factory(dict), repr=False)
+    wds = attr.ib(default=attr.Factory(dict), repr=False)
+    libc = attr.ib(default=None, repr=False)
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            libc.inotify_init1
+        except (OSError, AttributeError):
+            raise WatchError('inotify is not available on this system')
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            raise WatchError('cannot initialize inotify: {}'.format(os.strerror(ctypes.get_errno())))
+        self.libc = libc
+        self.fd = fd
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            self.dirs.clear()
+            self.wds.clear()
+
+    def add_watch(self, path):
+        if path in self.wds:
+            return
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                # Removed before it could be watched
+                return
+            if err == errno.ENOSPC:
+                raise WatchError('too many directories to watch, raise fs.inotify.max_user_watches')
+            raise WatchError("cannot watch '{}': {}".format(path, os.strerror(err)))
+        self.dirs[wd] = path
+        self.wds[path] = wd
+
+    def read(self, timeout=None):
+        # Return a list of (path, mask) of the events, or an empty list
+        # if nothing happened in timeout seconds. When the kernel queue
+        # overflows every watched directory is reported.
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    events.extend((path, IN_Q_OVERFLOW) for path in self.wds)
+                    continue
+                directory = self.dirs.get(wd)
+                if directory is None:
+                    continue
+                if mask & IN_IGNORED:
+                    del self.dirs[wd]
+                    self.wds.pop(directory, None)
+                    continue
+                path = os.path.join(directory, os.fsdecode(name)) if name else directory
+                events.append((path, mask))
+        return events
+
+
+@attr.s
+class Watcher:
+    # Rebuilds the images whose contexts or Dockerfiles change, and their
+    # dependents. Configs, the dependency graph and daemon connections
+    # are kept between rebuilds. A change to an image that is being
+    # rebuilt cancels it and the builds that depend on it, they are
+    # started again with the next round.
+    path = attr.ib()
+    configs = attr.ib(repr=False)
+    all_dependents = attr.ib(repr=False)
+    build = attr.ib(repr=False)
+    cancellation = attr.ib(default=attr.Factory(Cancellation), repr=False)
+    contexts = attr.ib(default=None, repr=False)
+    delay = attr.ib(default=0.2)
+    targets = attr.ib(default=())
+    echo = attr.ib(default=print, repr=False)
+    inotify = attr.ib(default=attr.Factory(Inotify), repr=False)
+
+    built = attr.ib(default=attr.Factory(dict), init=False, repr=False)
+    pending = attr.ib(default=attr.Factory(set), init=False, repr=False)
+    running = attr.ib(default=None, init=False, repr=False)
+    round_tags = attr.ib(default=attr.Factory(set), init=False, repr=False)
+
+    def run(self, rounds=None):
+        # Watch until interrupted, or until the given number of rounds
+        # of builds is finished
+        with self.inotify, futures.ThreadPoolExecutor(max_workers=1) as executor:
+            self.watch_all()
+            self.pending = set(self.configs)
+            try:
+                while rounds is None or rounds > 0 or self.running is not None:
+                    if self.running is None and self.pending and (rounds is None or rounds > 0):
+                        self.start_round(executor)
+                        if rounds is not None:
+                            rounds -= 1
+                    events = self.inotify.read(POLL_INTERVAL if self.running is not None else None)
+                    if events:
+                        self.changed(self.collect(events))
+                    if self.running is not None and self.running.done():
+                        self.finish_round()
+            except BaseException:
+                # Don't wait for the running builds on interrupt
+                self.cancellation.cancel(self.configs)
+                raise
+
+    def start_round(self, executor):
+        # Besides the changed images and their dependents, images that
+        # failed or were cancelled in the previous rounds are built again
+        tags = selection.with_dependents(self.all_dependents, self.pending) | (set(self.configs) - set(self.built))
+        self.built = {tag: image_id for tag, image_id in self.built.items() if tag not in tags}
+        self.pending = set()
+        self.round_tags = tags
+        self.cancellation.reset()
+        self.echo('building {}'.format(', '.join(tag for tag in self.all_dependents if tag in tags)))
+        self.running = executor.submit(self.build, self.configs, self.all_dependents, dict(self.built))
+
+    def finish_round(self):
+        try:
+            self.built.update(self.running.result())
+        except Exception as exc:
+            self.echo('build failed: {}'.format(exc))
+        else:
+            self.echo('done, watching for changes')
+        self.running = None
+
+    def collect(self, events):
+        # Wait until the events stop coming, editors and exports write
+        # files in several steps
+        paths = set()
+        while events:
+            for path, mask in events:
+                paths.add(path)
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    self.watch_new_dir(path)
+            events = self.inotify.read(self.delay)
+        return paths
+
+    def changed(self, paths):
+        tags = set()
+        if os.path.realpath(self.path) in paths or paths & self.dockerfile_paths():
+            tags |= self.reload()
+        ignored = self.ignored_paths()
+        paths = [path for path in paths if not any(is_below(path, other) for other in ignored)]
+        if self.contexts is not None:
+            for path in paths:
+                self.contexts.invalidate(path)
+        for tag, config in self.configs.items():
+            if selection.is_context_changed(config.context, paths):
+                tags.add(tag)
+        if not tags:
+            return
+        self.pending |= tags
+        if self.running is not None:
+            obsolete = selection.with_dependents(self.all_dependents, tags) & self.round_tags
+            if obsolete:
+                self.cancellation.cancel(obsolete)
+        self.echo('changed: {}'.format(', '.join(sorted(tags))))
+
+    def reload(self):
+        # Return tags whose configs have changed, Dockerfiles are read
+        # again along with the multi-build file
+        try:
+            with open(self.path) as fp:
+                configs = config_module.load(fp)
+            all_dependents = sort_configs(list(configs.values()))
+            if self.targets:
+                configs = selection.select(configs, all_dependents, self.targets)
+                all_dependents = sort_configs(list(configs.values()))
+        except (OSError, ValueError, TypeError, DependencyError, selection.SelectionError, yaml.YAMLError) as exc:
+            self.echo('cannot load {}: {}'.format(self.path, exc))
+            return set()
+        changed = {tag for tag, config in configs.items() if self.configs.get(tag) != config}
+        self.configs = configs
+        self.all_dependents = all_dependents
+        self.built = {tag: image_id for tag, image_id in self.built.items() if tag in configs}
+        self.pending &= set(configs)
+        self.watch_all()
+        return changed
+
+    def watch_all(self):
+        self.inotify.add_watch(os.path.dirname(os.path.realpath(self.path)))
+        for path in self.dockerfile_paths():
+            self.inotify.add_watch(os.path.dirname(path))
+        ignored = self.ignored_paths()
+        for context in {os.path.realpath(config.context) for config in self.configs.values()}:
+            self.watch_tree(context, ignored)
+
+    def watch_new_dir(self, path):
+        ignored = self.ignored_paths()
+        for context in {os.path.realpath(config.context) for config in self.configs.values()}:
+            if is_below(path, context):
+                self.watch_tree(context, ignored, os.path.relpath(path, context).replace(os.sep, '/'))
+
+    def watch_tree(self, context, ignored, reldir=''):
+        # Watch the directories of the context that can hold files sent
+        # to the daemon
+        matcher = dockerignore.load(context) + dockerignore.parse([STATE_DIRNAME])
+        dirs = [reldir]
+        while dirs:
+            reldir = dirs.pop()
+            path = os.path.join(context, reldir) if reldir else context
+            if any(is_below(path, other) for other in ignored):
+                continue
+            self.inotify.add_watch(path)
+            try:
+                entries = list(os.scandir(path))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for entry in entries:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                arcname = reldir + '/' + entry.name if reldir else entry.name
+                if not matcher.matches(arcname) or matcher.may_include_below(arcname):
+                    dirs.append(arcname)
+
+    def dockerfile_paths(self):
+        return {os.path.realpath(config.dockerfile.name) for config in self.configs.values()
+                if config.dockerfile.name is not None}
+
+    def ignored_paths(self):
+        # Files written by the builds themselves: exports and in-line
+        # Dockerfiles saved to contexts
+        ignored = set()
+        contexts = {os.path.realpath(config.context) for config in self.configs.values()}
+        for config in self.configs.values():
+            for exported_path in config.exports:
+                dest_path = get_export_destination(exported_path)
+                # Contents exported right into a context can't be told
+                # apart from the files of the context
+                if not any(is_below(context, dest_path) for context in contexts):
+                    ignored.add(dest_path)
+            if config.dockerfile.name is None:
+                ignored.add(os.path.join(os.path.realpath(config.context), 'Dockerfile.' + config.tag))
+        return ignored
+
+
+def is_below(path, other):
+    return path == other or path.startswith(os.path.join(other, ''))
@@ -0,0 +1,240 @@
+import asyncio
+import io
+import json
+import os
+import tarfile
+import tempfile
+import threading
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+from docker_multi_build.aio import AsyncAPIClient, AsyncBuilder, AsyncMultiBuilder
+from docker_multi_build.cache import ExportCache
+from docker_multi_build.config import BuildConfig, BuildExport, Dockerfile
+from docker_multi_build.sort_configs import sort_configs
+from docker_multi_build.trace import Tracer
+
+
+class FakeDaemon:
+    # Serves the few endpoints of the Engine API used by AsyncBuilder
+    def __init__(self):
+        self.images = {}
+        self.contexts = {}
+        self.containers = {}
+        self.building = 0
+        self.max_building = 0
+
+    async def handle(self, reader, writer):
+        method, target, _ = (await reader.readline()).decode().split(' ', 2)
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode().rstrip('\r\n')
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.lower()] = value.strip()
+        if headers.get('transfer-encoding') == 'chunked':
+            body = b''
+            while True:
+                size = int(await reader.readline(), 16)
+                body += await reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                body = body[:-2]
+        else:
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+        url = urlsplit(target)
+        params = {name: values[0] for name, values in parse_qs(url.query).items()}
+        path = url.path.split('/', 2)[2]
+        if path == 'build':
+            await self.build(writer, params, body)
+        elif path.startswith('images/'):
+            name = path.split('/')[1]
+            if name in self.images:
+                self.respond(writer, 200, {'Id': self.images[name]})
+            else:
+                self.respond(writer, 404, {'message': 'No such image: ' + name})
+        elif path == 'containers/create':
+            container_id = 'c{}'.format(len(self.containers))
+            self.containers[container_id] = json.loads(body.decode())['Image']
+            self.respond(writer, 201, {'Id': container_id})
+        elif path.endswith('/archive'):
+            buf = io.BytesIO()
+            with tarfile.open(fileobj=buf, mode='w') as tf:
+                dirname = os.path.basename(params['path'])
+                info = tarfile.TarInfo(dirname)
+                info.type = tarfile.DIRTYPE
+                tf.addfile(info)
+                info = tarfile.TarInfo(dirname + '/beep')
+                info.size = 4
+                tf.addfile(info, io.BytesIO(b'beep'))
+            self.respond(writer, 200, buf.getvalue())
+        elif method == 'DELETE':
+            del self.containers[path.split('/')[1]]
+            self.respond(writer, 204, None)
+        await writer.drain()
+        writer.close()
+
+    async def build(self, writer, params, body):
+        with tarfile.open(fileobj=io.BytesIO(body)) as tf:
+            self.contexts[params['t']] = sorted(tf.getnames())
+        self.building += 1
+        self.max_building = max(self.max_building, self.building)
+        writer.write(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n')
+        image_id = '{:012x}'.format(len(self.images) + 1)
+        events = json.dumps({'stream': 'Step 1/1 : FROM busybox\n'}) + json.dumps(
+            {'stream': 'Successfully built {}\n'.format(image_id)})
+        # An event is split between chunks
+        for chunk in [events[:30], events[30:]]:
+            await asyncio.sleep(0.05)
+            writer.write('{:x}\r\n{}\r\n'.format(len(chunk), chunk).encode())
+        writer.write(b'0\r\n\r\n')
+        self.building -= 1
+        self.images[image_id] = self.images[params['t']] = 'sha256:' + image_id
+
+    def respond(self, writer, status, body):
+        if isinstance(body, dict):
+            body = json.dumps(body).encode()
+        body = body or b''
+        writer.write('HTTP/1.1 {} Fake\r\nContent-Length: {}\r\n\r\n'.format(status, len(body)).encode() + body)
+
+
+@pytest.fixture
+def fake_daemon():
+    # Paths of unix sockets are short
+    socket_dir = tempfile.mkdtemp()
+    socket_path = os.path.join(socket_dir, 'docker.sock')
+    daemon = FakeDaemon()
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(asyncio.start_unix_server(daemon.handle, socket_path))
+    yield daemon, AsyncAPIClient(socket_path), loop
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+    loop.close()
+    os.remove(socket_path)
+    os.rmdir(socket_dir)
+
+
+def test_async_multi_builder(isolated_filesystem, fake_daemon):
+    daemon, api, loop = fake_daemon
+    isolated_filesystem.join('beep.txt').write('beep')
+    configs = {
+        'base': BuildConfig('base', dockerfile=Dockerfile('FROM busybox'), exports=[BuildExport('/out/.', 'dist')]),
+        'app': BuildConfig('app', dockerfile=Dockerfile('FROM base')),
+        'lonely': BuildConfig('lonely', dockerfile=Dockerfile('FROM busybox')),
+        'copier': BuildConfig('copier', dockerfile=Dockerfile('FROM busybox\nCOPY dist/ /dist/')),
+    }
+    output = []
+
+    class RecordingBuilder(AsyncBuilder):
+        def redirect_output(self, line):
+            output.append((self.config.tag, line))
+
+    durations = {}
+    tracer = Tracer()
+    builder = RecordingBuilder(client=None, api=api, tracer=tracer)
+    mb = AsyncMultiBuilder(builder=builder, durations=durations, tracer=tracer, loop=loop)
+    mb.build_all(configs, sort_configs(list(configs.values())))
+
+    assert set(daemon.contexts) == set(configs)
+    # Copier waits for the exports
+    assert {'Dockerfile.copier', 'beep.txt', 'dist/beep'} <= set(daemon.contexts['copier'])
+    assert daemon.max_building > 1
+    assert daemon.containers == {}
+    assert set(durations) == set(configs)
+    assert isolated_filesystem.join('dist', 'beep').read() == 'beep'
+    assert ('app', 'Step 1/1 : FROM busybox\n') in output
+    spans = {(event['cat'], event['args']['tag']) for event in tracer.events if event['ph'] == 'X'}
+    for name in ['queue', 'write_dockerfile', 'build_image', 'context', 'upload', 'first event']:
+        assert {tag for cat, tag in spans if cat == name} == set(configs)
+    assert ('export', 'base') in spans and ('docker_copy', 'base') in spans
+    # Builds overlap, every task has a row of its own
+    rows = {event['tid'] for event in tracer.events if event.get('cat') == 'build_image'}
+    assert len(rows) == len(configs)
+
+
+def test_api_errors(fake_daemon):
+    _, api, loop = fake_daemon
+    with pytest.raises(Exception, match='No such image: beep'):
+        loop.run_until_complete(api.call('GET', '/images/beep/json'))
+
+
+def test_async_multi_builder_fails_fast():
+    configs = {
+        'broken': BuildConfig('broken', dockerfile=Dockerfile('FROM busybox')),
+        'slow': BuildConfig('slow', dockerfile=Dockerfile('FROM busybox')),
+    }
+    stopped = []
+
+    class FailingBuilder(AsyncBuilder):
+        async def build(self, config, export=True):
+            if config.tag == 'broken':
+                await asyncio.sleep(0.01)
+                raise RuntimeError('boom')
+            try:
+                await asyncio.sleep(5)
+            finally:
+                stopped.append(config.tag)
+
+    # The real error is raised, not one of the cancellation
+    with pytest.raises(RuntimeError, match='boom'):
+        AsyncMultiBuilder(builder=FailingBuilder(client=None, api=None)).build_all(
+            configs, sort_configs(list(configs.values())))
+    assert stopped == ['slow']
+
+
+def test_async_multi_builder_interrupted():
+    configs = {
+        'interrupted': BuildConfig('interrupted', dockerfile=Dockerfile('FROM busybox')),
+        'slow': BuildConfig('slow', dockerfile=Dockerfile('FROM busybox')),
+    }
+    stopped = []
+
+    class InterruptedBuilder(AsyncBuilder):
+        async def build(self, config, export=True):
+            if config.tag == 'interrupted':
+                await asyncio.sleep(0.01)
+                raise KeyboardInterrupt
+            try:
+                await asyncio.sleep(5)
+            finally:
+                await asyncio.sleep(0)
+                stopped.append(config.tag)
+
+    loop = asyncio.new_event_loop()
+    mb = AsyncMultiBuilder(builder=InterruptedBuilder(client=None, api=None), loop=loop)
+    with pytest.raises(KeyboardInterrupt):
+        mb.build_all(configs, sort_configs(list(configs.values())))
+    assert stopped == ['slow']
+    assert mb.cancellation.is_cancelled('slow')
+    assert all(task.done() for task in asyncio.all_tasks(loop))
+    loop.close()
+
+
+def test_export_cache_runs_in_executor(isolated_filesystem, fake_daemon):
+    daemon, api, loop = fake_daemon
+    configs = {
+        'base': BuildConfig('base', dockerfile=Dockerfile('FROM busybox'), exports=[BuildExport('/out/.', 'dist')]),
+    }
+    threads = []
+
+    class RecordingExportCache(ExportCache):
+        def is_fresh(self, *args):
+            threads.append(threading.current_thread())
+            return super().is_fresh(*args)
+
+        def store(self, *args):
+            threads.append(threading.current_thread())
+            return super().store(*args)
+
+    export_cache = RecordingExportCache()
+    builder = AsyncBuilder(client=None, api=api, export_cache=export_cache)
+    AsyncMultiBuilder(builder=builder, loop=loop).build_all(configs, sort_configs(list(configs.values())))
+    assert len(threads) == 2
+    assert threading.main_thread() not in threads
+
+    # The export is fresh, it's not copied and stored again
+    builder = AsyncBuilder(client=None, api=api, export_cache=export_cache)
+    loop.run_until_complete(builder.run_exports(configs['base'], daemon.images['base']))
+    assert len(threads) == 3
@@ -1,12 +1,20 @@
+import io
 import os
+import socket
+import tarfile
+import threading
 import time
 
+import attr
 import docker
 import pytest
 import requests
 
 from docker_multi_build.config import BuildConfig, Dockerfile, BuildExport
-from docker_multi_build.build import MultiBuilder, Builder, build_all, docker_copy
+from docker_multi_build.build import (MultiBuilder, SequentialMultiBuilder, Builder, BuildCancelled, BuildsFailed,
+                                      Cancellation, build_all, capture_responses, close_response, docker_copy)
+from docker_multi_build.cache import ExportCache
+from docker_multi_build.sort_configs import sort_configs
 
 
 DIRNAME = os.path.dirname(__file__)
@@ -78,6 +86,7 @@ def test_write_dockerfile(isolated_filesystem):
     builder.write_dockerfile()
     with open('Dockerfile.image_a') as fp:
         assert fp.read() == config_with_inline.dockerfile.contents
+    assert config_with_inline.dockerfile.name is None
 
     config_without_inline = BuildConfig(
         tag='image_b',
@@ -87,6 +96,436 @@ def test_write_dockerfile(isolated_filesystem):
     builder.write_dockerfile()
     assert not os.path.exists('Dockerfile.image_b')
 
+    builder = Builder(client=None, write_dockerfiles=False)
+    builder.config = attr.assoc(config_with_inline, tag='image_c')
+    builder.write_dockerfile()
+    assert not os.path.exists('Dockerfile.image_c')
+
+
+def test_build_image_shares_context(isolated_filesystem):
+    class FakeAPI:
+        def __init__(self):
+            self.contexts = []
+
+        def build(self, fileobj, custom_context, dockerfile, **kwargs):
+            assert custom_context
+            with tarfile.open(fileobj=io.BytesIO(b''.join(fileobj))) as tf:
+                self.contexts.append({m.name: tf.extractfile(m).read() for m in tf if m.isfile()})
+            return 'sha256:' + dockerfile
+
+    class FakeClient:
+        api = FakeAPI()
+        images = {}
+
+    isolated_filesystem.join('beep.txt').write('beep')
+    builder = Builder(client=FakeClient())
+    for tag in ['image_a', 'image_b']:
+        builder.config = BuildConfig(tag, dockerfile=Dockerfile('FROM busybox', name='Dockerfile.' + tag))
+        builder.build_image()
+    assert FakeClient.api.contexts == [
+        {'beep.txt': b'beep', 'Dockerfile.image_a': b'FROM busybox'},
+        {'beep.txt': b'beep', 'Dockerfile.image_b': b'FROM busybox'},
+    ]
+    assert len(builder.contexts.archives) == 1
+
+
+def test_multi_builder_submits_dependents_early():
+    configs = {
+        'slow': BuildConfig('slow', dockerfile=Dockerfile('FROM busybox')),
+        'fast': BuildConfig('fast', dockerfile=Dockerfile('FROM busybox')),
+        'fast-dependent': BuildConfig('fast-dependent', dockerfile=Dockerfile('FROM fast')),
+    }
+    dependent_started = threading.Event()
+
+    class FakeBuilder:
+        def build(self, config, export=True):
+            if config.tag == 'slow':
+                # Wave-based scheduling would deadlock here
+                assert dependent_started.wait(timeout=5)
+            elif config.tag == 'fast-dependent':
+                dependent_started.set()
+
+    mb = MultiBuilder(builder=FakeBuilder())
+    mb.build_all(configs, sort_configs(list(configs.values())))
+
+
+def test_multi_builder_starts_critical_path_first():
+    configs = {
+        'lonely': BuildConfig('lonely', dockerfile=Dockerfile('FROM busybox')),
+        'base': BuildConfig('base', dockerfile=Dockerfile('FROM busybox')),
+        'wheel': BuildConfig('wheel', dockerfile=Dockerfile('FROM base')),
+        'final': BuildConfig('final', dockerfile=Dockerfile('FROM wheel')),
+        'slow': BuildConfig('slow', dockerfile=Dockerfile('FROM busybox')),
+    }
+    all_dependents = sort_configs(list(configs.values()))
+
+    class FakeBuilder:
+        def __init__(self):
+            self.built = []
+
+        def build(self, config, export=True):
+            self.built.append(config.tag)
+
+    # Nothing is recorded, stages are ranked by depth
+    b = FakeBuilder()
+    mb = MultiBuilder(builder=b, jobs=1)
+    mb.build_all(configs, all_dependents)
+    assert b.built[:3] == ['base', 'wheel', 'final']
+
+    # Recorded durations outweigh the depth
+    b = FakeBuilder()
+    durations = {'lonely': 1, 'base': 1, 'wheel': 1, 'final': 1, 'slow': 10}
+    mb = MultiBuilder(builder=b, jobs=1, durations=durations)
+    mb.build_all(configs, all_dependents)
+    assert b.built[:4] == ['slow', 'base', 'wheel', 'final']
+    assert set(durations) == set(configs)
+    assert durations['slow'] < 10
+
+
+def test_multi_builder_exports_in_background():
+    configs = {
+        'wheel': BuildConfig('wheel', dockerfile=Dockerfile('FROM busybox'),
+                             exports=[BuildExport('/out/.', 'dist')]),
+        'based': BuildConfig('based', dockerfile=Dockerfile('FROM wheel')),
+        'copier': BuildConfig('copier', dockerfile=Dockerfile('FROM busybox\nCOPY dist/ /dist/')),
+    }
+    based_started = threading.Event()
+    exported = threading.Event()
+
+    class FakeBuilder:
+        def build(self, config, export=True):
+            assert not export
+            if config.tag == 'based':
+                based_started.set()
+            elif config.tag == 'copier':
+                assert exported.is_set()
+
+        def run_exports(self, config, image_id):
+            assert config.tag == 'wheel'
+            # Waits for a dependent that doesn't need the exports
+            assert based_started.wait(timeout=5)
+            exported.set()
+
+    mb = MultiBuilder(builder=FakeBuilder())
+    mb.build_all(configs, sort_configs(list(configs.values())))
+
+
+def test_multi_builder_resumes_and_cancels():
+    configs = {
+        'base': BuildConfig('base', dockerfile=Dockerfile('FROM busybox')),
+        'wheel': BuildConfig('wheel', dockerfile=Dockerfile('FROM base')),
+        'final': BuildConfig('final', dockerfile=Dockerfile('FROM wheel')),
+        'lonely': BuildConfig('lonely', dockerfile=Dockerfile('FROM busybox')),
+    }
+    all_dependents = sort_configs(list(configs.values()))
+    cancellation = Cancellation()
+
+    class FakeBuilder:
+        def __init__(self):
+            self.built = []
+
+        def build(self, config, export=True):
+            self.built.append(config.tag)
+            if config.tag == 'wheel':
+                # Made obsolete while it runs
+                cancellation.cancel({'wheel', 'final'})
+                raise BuildCancelled(config.tag)
+            return 'sha256:' + config.tag
+
+    # Finished stages are not built again, their dependents get their IDs
+    b = FakeBuilder()
+    mb = MultiBuilder(builder=b, cancellation=cancellation)
+    built = mb.build_all(configs, all_dependents, built={'base': 'sha256:old', 'lonely': 'sha256:lonely'})
+    assert b.built == ['wheel']
+    assert built == {'base': 'sha256:old', 'lonely': 'sha256:lonely'}
+
+    # Cancelled tags are not started
+    b = FakeBuilder()
+    cancellation.reset()
+    cancellation.cancel({'lonely'})
+    mb = MultiBuilder(builder=b, cancellation=cancellation, jobs=1)
+    built = mb.build_all(configs, all_dependents)
+    assert sorted(b.built) == ['base', 'wheel']
+    assert built == {'base': 'sha256:base'}
+
+
+def test_multi_builder_fails_fast():
+    configs = {
+        'bad': BuildConfig('bad', dockerfile=Dockerfile('FROM busybox')),
+        'slow': BuildConfig('slow', dockerfile=Dockerfile('FROM busybox')),
+        'queued': BuildConfig('queued', dockerfile=Dockerfile('FROM busybox')),
+    }
+    durations = {'bad': 3, 'slow': 2, 'queued': 1}
+    cancellation = Cancellation()
+    slow_started = threading.Event()
+
+    class FakeBuilder:
+        def __init__(self):
+            self.built = []
+
+        def build(self, config, export=True):
+            self.built.append(config.tag)
+            if config.tag == 'bad':
+                assert slow_started.wait(timeout=5)
+                raise ValueError('bad')
+            if config.tag == 'slow':
+                slow_started.set()
+                # Stands in for the stream that is shut down
+                deadline = time.monotonic() + 5
+                while not cancellation.is_cancelled('slow'):
+                    assert time.monotonic() < deadline
+                    time.sleep(0.01)
+                raise BuildCancelled('slow')
+            return 'sha256:' + config.tag
+
+    b = FakeBuilder()
+    mb = MultiBuilder(builder=b, jobs=2, durations=durations, cancellation=cancellation)
+    with pytest.raises(ValueError):
+        mb.build_all(configs, sort_configs(list(configs.values())))
+    assert sorted(b.built) == ['bad', 'slow']
+
+
+def test_keep_going():
+    configs = {
+        'bad': BuildConfig('bad', dockerfile=Dockerfile('FROM busybox')),
+        'bad-dependent': BuildConfig('bad-dependent', dockerfile=Dockerfile('FROM bad')),
+        'good': BuildConfig('good', dockerfile=Dockerfile('FROM busybox')),
+        'good-dependent': BuildConfig('good-dependent', dockerfile=Dockerfile('FROM good')),
+    }
+    all_dependents = sort_configs(list(configs.values()))
+
+    class FakeBuilder:
+        def __init__(self):
+            self.built = []
+
+        def build(self, config, export=True):
+            self.built.append(config.tag)
+            if config.tag == 'bad':
+                raise ValueError('bad')
+            return 'sha256:' + config.tag
+
+    for multi_builder_class in [MultiBuilder, SequentialMultiBuilder]:
+        b = FakeBuilder()
+        mb = multi_builder_class(builder=b, keep_going=True)
+        with pytest.raises(BuildsFailed) as exc_info:
+            mb.build_all(configs, all_dependents)
+        assert list(exc_info.value.failures) == ['bad']
+        assert sorted(b.built) == ['bad', 'good', 'good-dependent']
+
+
+def test_cancellation_closes_streams():
+    class FakeResponse:
+        closed = False
+
+        def close(self):
+            self.closed = True
+
+    cancellation = Cancellation()
+    response = FakeResponse()
+    with cancellation.stream('image_a', response):
+        cancellation.cancel({'image_b'})
+        assert not response.closed
+        cancellation.cancel({'image_a'})
+        assert response.closed
+    assert cancellation.streams == {}
+
+    # Streams of builds that are cancelled already are closed at once
+    response = FakeResponse()
+    cancellation.reset()
+    cancellation.cancel_all()
+    with cancellation.stream('image_c', response):
+        assert response.closed
+
+
+def test_close_response_wakes_reader():
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    peer_closed = threading.Event()
+
+    def serve():
+        conn, _ = server.accept()
+        with conn:
+            conn.recv(65536)
+            conn.sendall(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n2\r\n{}\r\n')
+            conn.settimeout(5)
+            if conn.recv(1) == b'':
+                peer_closed.set()
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+    session = requests.Session()
+    with capture_responses(session) as responses:
+        response = session.post('http://127.0.0.1:{}/build'.format(server.getsockname()[1]), stream=True)
+    assert responses == [response]
+    chunks = response.iter_content(1)
+    next(chunks)
+
+    started = time.monotonic()
+    threading.Timer(0.1, close_response, [response]).start()
+    with pytest.raises(Exception):
+        # Blocks until the socket is shut down
+        list(chunks)
+    assert time.monotonic() - started < 4
+    thread.join()
+    server.close()
+    assert peer_closed.is_set()
+
+
+def test_export_paths_in_parallel():
+    exports = [BuildExport('/out/beep', 'beep'), BuildExport('/out/boop', 'boop')]
+    barrier = threading.Barrier(len(exports), timeout=5)
+
+    class FakeContainer:
+        removed = None
+
+        def remove(self, **kwargs):
+            self.removed = kwargs
+
+    container = FakeContainer()
+
+    class FakeClient:
+        class containers:
+            @staticmethod
+            def create(tag):
+                return container
+
+    class ParallelBuilder(Builder):
+        def export_path(self, container, image_id, exported_path):
+            # Every path waits for the others
+            barrier.wait()
+
+    builder = ParallelBuilder(client=FakeClient())
+    builder.run_exports(BuildConfig('image_a', dockerfile=Dockerfile('FROM busybox'), exports=exports), 'sha256:a')
+    assert container.removed == {'v': True, 'force': True}
+
+
+class ArchiveContainer:
+    # Serves get_archive from a dict of paths and contents, directories
+    # have None as contents
+    def __init__(self, files):
+        self.files = files
+
+    def get_archive(self, path):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w') as tf:
+            for name, contents in sorted(self.files.items()):
+                if not (name == path or name.startswith(path + '/')):
+                    continue
+                info = tarfile.TarInfo(name.lstrip('/'))
+                info.mtime = 1000000000
+                if contents is None:
+                    info.type = tarfile.DIRTYPE
+                    info.mode = 0o755
+                    tf.addfile(info)
+                else:
+                    info.size = len(contents)
+                    info.mode = 0o644
+                    tf.addfile(info, io.BytesIO(contents))
+        buf.seek(0)
+        return buf, {}
+
+
+def test_docker_copy_incremental(isolated_filesystem):
+    container = ArchiveContainer({
+        '/out': None,
+        '/out/beep': b'beep',
+        '/out/sub': None,
+        '/out/sub/boop': b'boop',
+    })
+    extracted = docker_copy(container, '/out/.', 'dest', incremental=True)
+    assert sorted(extracted) == ['dest/beep', 'dest/sub', 'dest/sub/boop']
+    with open('dest/sub/boop', 'rb') as fp:
+        assert fp.read() == b'boop'
+    assert os.stat('dest/beep').st_mtime == 1000000000
+
+    # Unchanged files are not touched, changed ones are rewritten
+    os.utime('dest/beep', (1, 1))
+    with open('dest/sub/boop', 'wb') as fp:
+        fp.write(b'bzzz')
+    with open('dest/stale', 'wb') as fp:
+        fp.write(b'stale')
+    os.chmod('dest/beep', 0o600)
+    docker_copy(container, '/out/.', 'dest', incremental=True)
+    assert os.stat('dest/beep').st_mtime == 1
+    assert os.stat('dest/beep').st_mode & 0o777 == 0o644
+    with open('dest/sub/boop', 'rb') as fp:
+        assert fp.read() == b'boop'
+    assert os.path.exists('dest/stale')
+
+    docker_copy(container, '/out/.', 'dest', incremental=True, delete=True)
+    assert not os.path.exists('dest/stale')
+    assert sorted(os.listdir('dest')) == ['beep', 'sub']
+
+    # Single file to a directory
+    docker_copy(container, '/out/beep', 'dest/sub', incremental=True)
+    with open('dest/sub/beep', 'rb') as fp:
+        assert fp.read() == b'beep'
+
+
+def test_docker_copy_refuses_to_prune(isolated_filesystem):
+    container = ArchiveContainer({'/out': None, '/out/beep': b'beep'})
+    isolated_filesystem.join('docker-multi-build.yml').write('{}')
+    isolated_filesystem.join('app', 'main.py').write('main', ensure=True)
+    for src_path, dest_path, protected in [('/out/.', '.', ()), ('/out/.', 'app', ['app']), ('/out/.', '..', ())]:
+        with pytest.raises(Exception, match='refusing to remove files'):
+            docker_copy(container, src_path, dest_path, incremental=True, delete=True, protected=protected)
+    assert os.path.exists('docker-multi-build.yml')
+    assert os.path.exists('app/main.py')
+
+    # Exports next to the protected paths are pruned
+    isolated_filesystem.join('dist', 'stale').write('stale', ensure=True)
+    docker_copy(container, '/out/.', 'dist', incremental=True, delete=True, protected=['app'])
+    assert os.listdir('dist') == ['beep']
+
+
+def test_docker_copy_chunked_archive(isolated_filesystem):
+    class ChunkedContainer(ArchiveContainer):
+        def get_archive(self, path):
+            buf, stat = super().get_archive(path)
+            return iter(lambda: buf.read(100), b''), stat
+
+    container = ChunkedContainer({'/out': None, '/out/beep': b'beep' * 1000})
+    docker_copy(container, '/out', 'dest')
+    with open('dest/beep', 'rb') as fp:
+        assert fp.read() == b'beep' * 1000
+
+
+def test_export_skips_fresh_paths(isolated_filesystem):
+    exports = [BuildExport('/out/beep', 'beep'), BuildExport('/out/boop', 'boop')]
+    config = BuildConfig('image_a', dockerfile=Dockerfile('FROM busybox'), exports=exports)
+    images = {'sha256:a': ArchiveContainer({'/out/beep': b'beep', '/out/boop': b'boop'})}
+
+    class FakeClient:
+        class containers:
+            created = []
+
+            @classmethod
+            def create(cls, image):
+                cls.created.append(image)
+                container = images[image]
+                container.remove = lambda **kwargs: None
+                return container
+
+    copied = []
+
+    class RecordingBuilder(Builder):
+        def export_path(self, container, image_id, exported_path):
+            copied.append(exported_path.dest_path)
+            super().export_path(container, image_id, exported_path)
+
+    builder = RecordingBuilder(client=FakeClient(), export_cache=ExportCache())
+    builder.run_exports(config, 'sha256:a')
+    builder.run_exports(config, 'sha256:a')
+    assert FakeClient.containers.created == ['sha256:a']
+    assert sorted(copied) == ['beep', 'boop']
+
+    # Only the removed path is copied again
+    os.remove('boop')
+    copied.clear()
+    builder.run_exports(config, 'sha256:a')
+    assert copied == ['boop']
+
 
 def test_build_all(isolated_filesystem, docker_in_docker):
     configs = {
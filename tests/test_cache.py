@@ -0,0 +1,242 @@
+import os
+import shutil
+
+import attr
+import docker.errors
+
+from docker_multi_build.build import Builder, MultiBuilder, SequentialMultiBuilder
+from docker_multi_build.cache import BuildCache, ExportCache, context_digest, fingerprint
+from docker_multi_build.config import BuildConfig, BuildExport, Dockerfile
+from docker_multi_build.sort_configs import sort_configs
+
+
+def test_fingerprint(isolated_filesystem):
+    config = BuildConfig('image_a', dockerfile=Dockerfile('FROM busybox\nCOPY beep.txt /'))
+    isolated_filesystem.join('beep.txt').write('beep')
+    fp = fingerprint(config, ['sha256:a'])
+    assert fingerprint(config, ['sha256:a']) == fp
+    assert fingerprint(config, ['sha256:b']) != fp
+    assert fingerprint(attr.assoc(config, args={'beep': 'boop'}), ['sha256:a']) != fp
+    assert fingerprint(attr.assoc(config, dockerfile=Dockerfile('FROM busybox')), ['sha256:a']) != fp
+
+    isolated_filesystem.join('beep.txt').write('boop!')
+    assert fingerprint(config, ['sha256:a']) != fp
+
+
+def test_context_digest_ignores_state(isolated_filesystem):
+    digest = context_digest('.')
+    os.makedirs('.docker-multi-build')
+    isolated_filesystem.join('.docker-multi-build', 'state.json').write('{}')
+    assert context_digest('.') == digest
+
+
+def test_build_cache(isolated_filesystem):
+    configs = {
+        'image_a': BuildConfig('image_a', dockerfile=Dockerfile('FROM busybox')),
+        'image_b': BuildConfig('image_b', dockerfile=Dockerfile('FROM image_a')),
+    }
+    all_dependents = sort_configs(list(configs.values()))
+    client = FakeClient()
+    b = FakeBuilder(client)
+    cache = BuildCache(client)
+
+    MultiBuilder(builder=b, cache=cache).build_all(configs, all_dependents)
+    assert b.built == ['image_a', 'image_b']
+
+    # Nothing has changed
+    b.built = []
+    MultiBuilder(builder=b, cache=cache).build_all(configs, all_dependents)
+    assert b.built == []
+
+    # Image is gone, its dependent gets a new parent
+    del client.images.tags['image_a']
+    MultiBuilder(builder=b, cache=cache).build_all(configs, all_dependents)
+    assert b.built == ['image_a', 'image_b']
+
+
+def test_build_cache_digests_contexts_once(isolated_filesystem, monkeypatch):
+    configs = {tag: BuildConfig(tag, dockerfile=Dockerfile('FROM busybox')) for tag in ['a', 'b', 'c']}
+    scanned = []
+
+    def scan_context(context):
+        scanned.append(context)
+        return iter([])
+
+    monkeypatch.setattr('docker_multi_build.cache.scan_context', scan_context)
+    cache = BuildCache(FakeClient())
+    MultiBuilder(builder=FakeBuilder(cache.client), cache=cache).build_all(
+        configs, sort_configs(list(configs.values())))
+    assert len(scanned) == 1
+
+
+def test_build_cache_skips_exported_files(isolated_filesystem):
+    # Files exported into the context don't change the fingerprint, so
+    # the second run is skipped already
+    configs = {
+        'image_a': BuildConfig('image_a', dockerfile=Dockerfile('FROM busybox'),
+                               exports=[BuildExport('/out/wheel', '.'), BuildExport('/out/.', 'dist')]),
+    }
+    all_dependents = sort_configs(list(configs.values()))
+    client = FakeClient()
+
+    class ExportingBuilder(FakeBuilder):
+        def build(self, config, export=True):
+            image_id = super().build(config, export)
+            isolated_filesystem.join('wheel').write(image_id)
+            isolated_filesystem.join('dist', 'beep').write(image_id, ensure=True)
+            return image_id
+
+    b = ExportingBuilder(client)
+    cache = BuildCache(client)
+    MultiBuilder(builder=b, cache=cache).build_all(configs, all_dependents)
+    MultiBuilder(builder=b, cache=cache).build_all(configs, all_dependents)
+    assert b.built == ['image_a']
+
+    isolated_filesystem.join('beep.txt').write('beep')
+    MultiBuilder(builder=b, cache=cache).build_all(configs, all_dependents)
+    assert b.built == ['image_a', 'image_a']
+
+
+def test_build_cache_skips_saved_dockerfiles(isolated_filesystem):
+    configs = {
+        'image_a': BuildConfig('image_a', dockerfile=Dockerfile('FROM busybox')),
+        'image_b': BuildConfig('image_b', dockerfile=Dockerfile('FROM busybox\nCOPY . /')),
+    }
+    all_dependents = sort_configs(list(configs.values()))
+    client = FakeClient()
+
+    class SavingBuilder(FakeBuilder):
+        def build(self, config, export=True):
+            writer = Builder(client=None)
+            writer.config = config
+            writer.write_dockerfile()
+            return super().build(config, export)
+
+    b = SavingBuilder(client)
+    cache = BuildCache(client)
+    MultiBuilder(builder=b, cache=cache).build_all(configs, all_dependents)
+    assert sorted(b.built) == ['image_a', 'image_b']
+    assert os.path.exists('Dockerfile.image_a')
+
+    b.built = []
+    MultiBuilder(builder=b, cache=cache).build_all(configs, all_dependents)
+    assert b.built == []
+
+
+def test_build_cache_sees_exports_of_other_images(isolated_filesystem):
+    # image_c copies the context without depending on image_a, files
+    # exported by image_a change its fingerprint
+    configs = {
+        'image_a': BuildConfig('image_a', dockerfile=Dockerfile('FROM busybox'),
+                               exports=[BuildExport('/out/.', 'dist')]),
+        'image_b': BuildConfig('image_b', dockerfile=Dockerfile('FROM image_a\nCOPY dist /dist')),
+        'image_c': BuildConfig('image_c', dockerfile=Dockerfile('FROM busybox\nCOPY . /')),
+    }
+    all_dependents = sort_configs(list(configs.values()))
+    client = FakeClient()
+    b = FakeBuilder(client)
+    cache = BuildCache(client)
+    MultiBuilder(builder=b, cache=cache).build_all(configs, all_dependents)
+
+    isolated_filesystem.join('dist', 'beep').write('beep', ensure=True)
+    b.built = []
+    MultiBuilder(builder=b, cache=cache).build_all(configs, all_dependents)
+    assert b.built == ['image_c']
+
+
+def test_build_cache_with_built_dependencies(isolated_filesystem):
+    # Dependencies that are not selected are taken as they are, the
+    # dependent is fingerprinted with their current IDs
+    configs = {
+        'image_a': BuildConfig('image_a', dockerfile=Dockerfile('FROM busybox')),
+        'image_b': BuildConfig('image_b', dockerfile=Dockerfile('FROM image_a')),
+    }
+    all_dependents = sort_configs(list(configs.values()))
+    for multi_builder_class in [MultiBuilder, SequentialMultiBuilder]:
+        client = FakeClient()
+        b = FakeBuilder(client)
+        cache = BuildCache(client)
+        for parent_id in ['sha256:old', 'sha256:old', 'sha256:new', None, None]:
+            multi_builder_class(builder=b, cache=cache).build_all(configs, all_dependents, {'image_a': parent_id})
+        # Missing dependencies turn the cache off
+        assert b.built == ['image_b', 'image_b', 'image_b', 'image_b']
+
+
+class FakeBuilder:
+    def __init__(self, client):
+        self.client = client
+        self.built = []
+
+    def build(self, config, export=True):
+        self.built.append(config.tag)
+        image_id = 'sha256:{}'.format(len(self.client.images.ids))
+        self.client.images.ids.append(image_id)
+        self.client.images.tags[config.tag] = image_id
+        return image_id
+
+    def run_exports(self, config, image_id):
+        pass
+
+
+class FakeClient:
+    def __init__(self):
+        self.images = FakeImages()
+
+
+class FakeImages:
+    def __init__(self):
+        self.ids = []
+        self.tags = {}
+
+    def get(self, name):
+        try:
+            return FakeImage(self.tags[name])
+        except KeyError:
+            raise docker.errors.ImageNotFound(name)
+
+
+@attr.s
+class FakeImage:
+    id = attr.ib()
+
+
+def test_export_cache(isolated_filesystem):
+    exported_path = BuildExport('/out/.', 'dist')
+    cache = ExportCache()
+    assert not cache.is_fresh('image_a', exported_path, 'sha256:a')
+
+    os.makedirs('dist')
+    isolated_filesystem.join('dist', 'beep').write('beep')
+    cache.store('image_a', exported_path, 'sha256:a', ['dist', 'dist/beep'])
+    assert cache.is_fresh('image_a', exported_path, 'sha256:a')
+    assert not cache.is_fresh('image_a', exported_path, 'sha256:b')
+    assert not cache.is_fresh('image_b', exported_path, 'sha256:a')
+
+    # Touched but unchanged
+    os.utime('dist/beep', (1, 1))
+    assert cache.is_fresh('image_a', exported_path, 'sha256:a')
+
+    isolated_filesystem.join('dist', 'beep').write('boop')
+    os.utime('dist/beep', (1, 1))
+    assert not cache.is_fresh('image_a', exported_path, 'sha256:a')
+
+    os.remove('dist/beep')
+    assert not cache.is_fresh('image_a', exported_path, 'sha256:a')
+
+
+def test_export_cache_without_files(isolated_filesystem):
+    exported_path = BuildExport('/out/.', 'dist')
+    cache = ExportCache()
+    os.makedirs('dist/empty')
+    os.symlink('empty', 'dist/link')
+    cache.store('image_a', exported_path, 'sha256:a', ['dist', 'dist/empty', 'dist/link'])
+    assert cache.is_fresh('image_a', exported_path, 'sha256:a')
+
+    os.remove('dist/link')
+    os.symlink('elsewhere', 'dist/link')
+    assert not cache.is_fresh('image_a', exported_path, 'sha256:a')
+
+    cache.store('image_a', exported_path, 'sha256:a', [])
+    assert cache.is_fresh('image_a', exported_path, 'sha256:a')
+    shutil.rmtree('dist')
+    assert not cache.is_fresh('image_a', exported_path, 'sha256:a')
@@ -4,7 +4,8 @@ import os
 import pytest
 import yaml
 
-from docker_multi_build.config import BuildConfig, Dockerfile, BuildExport, load
+from docker_multi_build.config import BuildConfig, ConfigCache, Dockerfile, BuildExport, get_cache_from, load
+from docker_multi_build.sort_configs import sort_configs
 
 table_load = [(
     'image_a:\n',
@@ -24,14 +25,17 @@ table_load = [(
     '  args:\n'
     '    beep: boop\n'
     '  exports:\n'
-    '    - /out/dumb-init_1.2.0_amd64:vendor/\n',
+    '    - /out/dumb-init_1.2.0_amd64:vendor/\n'
+    '  cache_from:\n'
+    '    - registry.example.com/image_a\n',
     {
         'image_a': BuildConfig(
             tag='image_a',
             dockerfile=Dockerfile('FROM debian:jessie\nCMD ["/bin/true"]\n'),
             context='.',
             args={'beep': 'boop'},
-            exports=[BuildExport('/out/dumb-init_1.2.0_amd64', 'vendor/')]),
+            exports=[BuildExport('/out/dumb-init_1.2.0_amd64', 'vendor/')],
+            cache_from=['registry.example.com/image_a']),
     }
 )]
 
@@ -43,6 +47,14 @@ def test_load(dockerfile, source, expected):
     assert loaded == expected
 
 
+def test_get_cache_from():
+    config = BuildConfig('app', dockerfile=Dockerfile('FROM busybox'))
+    assert get_cache_from(config) == []
+    assert get_cache_from(config, 'localhost:5000/cache/') == ['localhost:5000/cache/app']
+    config = BuildConfig('app', dockerfile=Dockerfile('FROM busybox'), cache_from=['app:previous'])
+    assert get_cache_from(config, 'localhost:5000/cache') == ['app:previous']
+
+
 def test_context_path(isolated_filesystem):
     name = 'docker-multi-build.yml'
     dockerfile_contents = 'FROM busybox'
@@ -114,6 +126,45 @@ def test_context_path(isolated_filesystem):
     assert configs['image_a'].dockerfile == Dockerfile(dockerfile_contents, 'blarp/beep/Dockerfile.boop')
 
 
+def test_config_cache(isolated_filesystem, monkeypatch):
+    with open('Dockerfile.wheel', 'w') as fp:
+        fp.write('FROM base\n')
+    with open('docker-multi-build.yml', 'w') as fp:
+        fp.write('base:\n'
+                 '  dockerfile: !inline |\n'
+                 '    FROM busybox\n'
+                 '  args:\n'
+                 '    beep: boop\n'
+                 '  exports:\n'
+                 '    - /out/.:dist\n'
+                 '  cache_from: registry.example.com/base\n'
+                 'wheel:\n'
+                 '  dockerfile: Dockerfile.wheel\n')
+    cache = ConfigCache('.docker-multi-build/config-cache.json')
+
+    def cached_load():
+        with open('docker-multi-build.yml') as fp:
+            return cache.load(fp)
+
+    configs, all_dependents = cached_load()
+    assert all_dependents == sort_configs(list(configs.values()))
+    assert configs['base'].cache_from == ['registry.example.com/base']
+
+    # Unchanged files are not parsed again, files that are touched only
+    # are hashed
+    loads = []
+    monkeypatch.setattr('docker_multi_build.config.load', lambda stream: loads.append(stream) or {})
+    os.utime('Dockerfile.wheel')
+    assert cached_load() == (configs, all_dependents)
+    assert list(all_dependents) == list(cached_load()[1])
+    assert loads == []
+
+    with open('Dockerfile.wheel', 'w') as fp:
+        fp.write('FROM busybox\n')
+    assert cached_load() == ({}, {})
+    assert len(loads) == 1
+
+
 @pytest.fixture
 def dockerfile(isolated_filesystem):
     with open('Dockerfile', 'w') as fp:
@@ -0,0 +1,142 @@
+import io
+import os
+import tarfile
+
+import docker.utils
+import pytest
+
+from docker_multi_build.build import Builder
+from docker_multi_build.config import BuildConfig, Dockerfile
+from docker_multi_build.context import ContextArchive, ContextArchives, ContextChanged, StatIndex
+
+
+def read_archive(chunks):
+    with tarfile.open(fileobj=io.BytesIO(b''.join(chunks))) as tf:
+        return {member.name: tf.extractfile(member).read() if member.isfile() else None
+                for member in tf}
+
+
+def test_context_archive(isolated_filesystem):
+    os.makedirs('src/pkg')
+    os.makedirs('.docker-multi-build')
+    isolated_filesystem.join('src', 'pkg', 'beep.py').write('beep')
+    isolated_filesystem.join('boop.log').write('boop')
+    isolated_filesystem.join('.docker-multi-build', 'state.json').write('{}')
+    isolated_filesystem.join('.dockerignore').write('# logs\n*.log\n')
+
+    archive = ContextArchive.create('.')
+    members = read_archive(archive.stream('Dockerfile.image_a', 'FROM busybox\n'))
+    assert members == {
+        '.dockerignore': b'# logs\n*.log\n',
+        'src': None,
+        'src/pkg': None,
+        'src/pkg/beep.py': b'beep',
+        'Dockerfile.image_a': b'FROM busybox\n',
+    }
+
+    # The archive can be streamed again with another Dockerfile
+    members = read_archive(archive.stream('Dockerfile.image_b', 'FROM image_a\n'))
+    assert 'Dockerfile.image_a' not in members
+    assert members['Dockerfile.image_b'] == b'FROM image_a\n'
+
+
+def test_context_archives(isolated_filesystem):
+    os.makedirs('dist')
+    contexts = ContextArchives()
+    archive = contexts.get('.')
+    assert contexts.get('.') is archive
+    assert contexts.get(os.getcwd()) is archive
+
+    contexts.invalidate(os.path.join(os.pardir, 'elsewhere'))
+    assert contexts.get('.') is archive
+
+    isolated_filesystem.join('dist', 'beep.whl').write('beep')
+    contexts.invalidate('dist')
+    new_archive = contexts.get('.')
+    assert new_archive is not archive
+    assert 'dist/beep.whl' in read_archive(new_archive.stream('Dockerfile', 'FROM busybox'))
+
+
+def test_context_archives_leave_saved_dockerfiles_out(isolated_filesystem):
+    class FakeAPI:
+        def __init__(self):
+            self.contexts = {}
+
+        def build(self, fileobj, tag, **kwargs):
+            self.contexts[tag] = read_archive(fileobj)
+            return 'sha256:' + tag
+
+    class FakeClient:
+        api = FakeAPI()
+        images = {}
+
+    isolated_filesystem.join('beep.txt').write('beep')
+    dockerfiles = {'a': 'FROM busybox\nCOPY beep.txt /\n', 'b': 'FROM busybox\nCOPY beep.txt /\nCMD ["beep"]\n'}
+    for _ in range(2):
+        # Every run scans the context again, Dockerfile.b of the last run
+        # is rewritten after the context was scanned for a
+        configs = {tag: BuildConfig(tag, dockerfile=Dockerfile(contents)) for tag, contents in dockerfiles.items()}
+        contexts = ContextArchives()
+        contexts.prepare(configs)
+        builder = Builder(client=FakeClient(), contexts=contexts)
+        for config in configs.values():
+            builder.config = config
+            builder.write_dockerfile()
+            builder.build_image()
+        assert FakeClient.api.contexts == {
+            tag: {'beep.txt': b'beep', 'Dockerfile.' + tag: contents.encode()}
+            for tag, contents in dockerfiles.items()
+        }
+        dockerfiles['b'] = 'FROM busybox\n'
+
+
+def test_context_archive_fails_on_changed_files(isolated_filesystem):
+    isolated_filesystem.join('beep.txt').write('beep')
+    archive = ContextArchive.create('.')
+    isolated_filesystem.join('beep.txt').write('beep!')
+    with pytest.raises(ContextChanged, match='has changed since its build context was scanned'):
+        read_archive(archive.stream('Dockerfile', 'FROM busybox'))
+
+
+def test_context_archive_matches_docker_py(isolated_filesystem):
+    os.makedirs('src/pkg')
+    os.makedirs('vendor/keep')
+    isolated_filesystem.join('src', 'pkg', 'beep.py').write('beep')
+    isolated_filesystem.join('src', 'pkg', 'beep.pyc').write('beep')
+    isolated_filesystem.join('vendor', 'boop.txt').write('boop')
+    isolated_filesystem.join('vendor', 'keep', 'blarp.txt').write('blarp')
+    isolated_filesystem.join('.dockerignore').write('**/*.pyc\nvendor\n!vendor/keep\n')
+    os.symlink('src/pkg/beep.py', 'beep.py')
+
+    archive = ContextArchive.create('.')
+    members = read_archive(archive.stream('Dockerfile', 'FROM busybox'))
+    members.pop('Dockerfile')
+    patterns = ['**/*.pyc', 'vendor', '!vendor/keep']
+    with docker.utils.tar('.', exclude=patterns) as fp:
+        expected = read_archive([fp.read()])
+    assert members == expected
+
+
+def test_stat_index(isolated_filesystem):
+    isolated_filesystem.join('beep.txt').write('beep')
+    index = StatIndex.load(os.path.join('.docker-multi-build', 'context-index.json'))
+    ContextArchive.create('.', index)
+    index.save()
+
+    index = StatIndex.load(index.path)
+    context = os.path.abspath('.')
+    (key, header), = index.get(context).values()
+    info = tarfile.TarInfo.frombuf(header, 'utf-8', 'surrogateescape')
+    assert info.name == 'beep.txt'
+
+    # Unchanged files reuse the known header
+    info.name = 'boop.txt'
+    fake_header = info.tobuf(tarfile.GNU_FORMAT, 'utf-8', 'surrogateescape')
+    index.update(context, {'beep.txt': (key, fake_header)})
+    archive = ContextArchive.create(context, index)
+    assert 'boop.txt' in read_archive(archive.stream('Dockerfile', 'FROM busybox'))
+
+    # Changed files get a new header
+    isolated_filesystem.join('beep.txt').write('beep!')
+    archive = ContextArchive.create(context, index)
+    assert read_archive(archive.stream('Dockerfile', 'FROM busybox'))['beep.txt'] == b'beep!'
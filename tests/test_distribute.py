@@ -0,0 +1,118 @@
+import threading
+
+import attr
+import docker.errors
+import pytest
+
+from docker_multi_build.build import MultiBuilder
+from docker_multi_build.config import BuildConfig, BuildExport, Dockerfile
+from docker_multi_build.distribute import ClusterClient, DistributedBuilder
+from docker_multi_build.sort_configs import sort_configs
+
+
+class FakeDaemon:
+    def __init__(self, name, images=()):
+        self.name = name
+        self.client = self
+        self.api = self
+        self.images = self
+        self.tags = {tag: 'sha256:' + tag for tag in images}
+        self.built = []
+        self.exported = []
+
+    # DockerClient.images
+    def get(self, name):
+        try:
+            return FakeImage(self.tags[name])
+        except KeyError:
+            raise docker.errors.ImageNotFound(name)
+
+    # APIClient
+    def get_image(self, name):
+        yield name.encode()
+
+    def load_image(self, data):
+        name = b''.join(data).decode()
+        self.tags[name] = 'sha256:' + name
+
+    # Builder
+    def build(self, config, export=True):
+        base_image = config.dockerfile.contents.split()[1]
+        assert base_image == 'busybox' or base_image in self.tags
+        self.built.append(config.tag)
+        self.tags[config.tag] = 'sha256:' + config.tag
+        return self.tags[config.tag]
+
+    def run_exports(self, config, image_id):
+        self.exported.append(config.tag)
+
+
+@attr.s
+class FakeImage:
+    id = attr.ib()
+
+
+def test_prefers_daemon_with_base_image():
+    a, b = FakeDaemon('a'), FakeDaemon('b')
+    builder = DistributedBuilder([a, b], tags={'base', 'app', 'lonely'})
+    base = BuildConfig('base', dockerfile=Dockerfile('FROM busybox'), exports=[BuildExport('/out', '.')])
+    app = BuildConfig('app', dockerfile=Dockerfile('FROM base'))
+    builder.build(base)
+    builder.run_exports(base, 'sha256:base')
+    builder.build(app)
+    assert a.built == ['base', 'app']
+    assert a.exported == ['base']
+    assert b.tags == {}
+
+    # Daemon with the base image is busy, the base image is copied
+    builder.load[0] = 2
+    builder.build(BuildConfig('worker', dockerfile=Dockerfile('FROM base')))
+    assert b.built == ['worker']
+    assert 'base' in b.tags
+    assert builder.locate('base') == {0, 1}
+
+
+def test_distributes_concurrent_builds():
+    configs = {'base': BuildConfig('base', dockerfile=Dockerfile('FROM busybox'))}
+    barrier = threading.Barrier(4, timeout=5)
+    for i in range(4):
+        tag = 'app{}'.format(i)
+        configs[tag] = BuildConfig(tag, dockerfile=Dockerfile('FROM base'))
+
+    class WaitingDaemon(FakeDaemon):
+        def build(self, config, export=True):
+            if config.tag != 'base':
+                # All dependents of base build at the same time
+                barrier.wait()
+            return super().build(config, export)
+
+    daemons = [WaitingDaemon('a'), WaitingDaemon('b')]
+    builder = DistributedBuilder(daemons, tags=set(configs))
+    MultiBuilder(builder=builder).build_all(configs, sort_configs(list(configs.values())))
+    assert sorted(daemons[0].built + daemons[1].built) == sorted(configs)
+    assert daemons[0].built[0] == 'base'
+    assert daemons[1].built
+    assert 'base' in daemons[1].tags
+
+
+def test_cluster_client():
+    a, b = FakeDaemon('a', images=['beep']), FakeDaemon('b', images=['boop'])
+    client = ClusterClient([a, b])
+    assert client.images.get('boop').id == 'sha256:boop'
+    with pytest.raises(docker.errors.ImageNotFound):
+        client.images.get('blarp')
+
+
+def test_replaces_stale_base_image():
+    # Daemon b holds an old image of base, the build cache found the
+    # current one on daemon a
+    a, b = FakeDaemon('a', images=['base']), FakeDaemon('b')
+    b.tags['base'] = 'sha256:old'
+    builder = DistributedBuilder([a, b], tags={'base', 'app'})
+    assert builder.cluster_client().images.get('base').id == 'sha256:base'
+    assert builder.locate('base') == {0}
+
+    builder.load[0] = 2
+    builder.build(BuildConfig('app', dockerfile=Dockerfile('FROM base')))
+    assert b.built == ['app']
+    assert b.tags['base'] == 'sha256:base'
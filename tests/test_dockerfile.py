@@ -1,6 +1,6 @@
 import pytest
 
-from docker_multi_build.dockerfile import Token, tokenize
+from docker_multi_build.dockerfile import Instruction, Token, iter_tokens, parse_contents, tokenize
 
 
 NON_ASCII = "žluťoučký"
@@ -67,3 +67,21 @@ table_tokenize = [
 def test_tokenize(lines, expected):
     tokens = tokenize(lines)
     assert tokens == expected
+
+
+def test_iter_tokens():
+    lines = iter(['FROM busybox\n', 'CMD ["/bin/true"]\n'])
+    tokens = iter_tokens(lines)
+    assert next(tokens) == Token('FROM', 0, 0, 'FROM busybox\n', 'busybox')
+    # Lines are consumed lazily
+    assert next(lines) == 'CMD ["/bin/true"]\n'
+
+
+def test_parse_contents():
+    contents = 'FROM busybox\nRUN echo beep \\\n    && echo boop\n'
+    instructions = parse_contents(contents)
+    assert instructions == (
+        Instruction('FROM', 'busybox'),
+        Instruction('RUN', 'echo beep     && echo boop'),
+    )
+    assert parse_contents(contents) is instructions
@@ -0,0 +1,41 @@
+import pytest
+
+from docker_multi_build.dockerignore import parse
+
+
+table_matches = [
+    (['*.log'], 'boop.log', True),
+    (['*.log'], 'beep/boop.log', False),
+    (['*/*.log'], 'beep/boop.log', True),
+    (['**/*.log'], 'beep/boop/blarp.log', True),
+    (['**/*.log'], 'blarp.log', True),
+    (['beep'], 'beep/boop/blarp.txt', True),
+    (['/beep/'], 'beep/boop', True),
+    (['./beep/../boop'], 'boop', True),
+    (['beep?.txt'], 'beep1.txt', True),
+    (['beep?.txt'], 'beep/.txt', False),
+    (['beep[0-9].txt'], 'beep1.txt', True),
+    (['beep[!0-9].txt'], 'beep1.txt', False),
+    (['*.md', '!README.md'], 'README.md', False),
+    (['*.md', '!README.md'], 'CHANGES.md', True),
+    (['!README.md', '*.md'], 'README.md', True),
+    (['# comment', '', 'beep'], 'beep', True),
+    (['# comment'], '# comment', False),
+]
+
+
+@pytest.mark.parametrize('lines, path, expected', table_matches)
+def test_matches(lines, path, expected):
+    assert parse(lines).matches(path) == expected
+
+
+def test_may_include_below():
+    matcher = parse(['vendor', '!vendor/keep'])
+    assert matcher.may_include_below('vendor')
+    assert not matcher.may_include_below('build')
+
+    matcher = parse(['vendor', '!**/keep'])
+    assert matcher.may_include_below('vendor')
+
+    matcher = parse(['vendor'])
+    assert not matcher.may_include_below('vendor')
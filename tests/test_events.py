@@ -0,0 +1,28 @@
+import pytest
+
+from docker_multi_build.events import BuildEvents, TAIL_SIZE
+
+
+@pytest.mark.parametrize('events, expected', [
+    ([{'stream': 'Step 1/1 : FROM busybox\n'}, {'stream': 'Successfully built 0123abcd\n'}], '0123abcd'),
+    ([{'stream': 'Successfully built 0123abcd\n'}, {'stream': 'Successfully tagged image_a:latest\n'}], '0123abcd'),
+    ([{'aux': {'ID': 'sha256:0123abcd'}}, {'stream': 'Successfully tagged image_a:latest\n'}], 'sha256:0123abcd'),
+    ([{'stream': 'sha256:0123abcd\n'}], '0123abcd'),
+])
+def test_image_id(events, expected):
+    parser = BuildEvents()
+    for event in events:
+        parser.feed(event)
+    assert parser.result() == expected
+    assert parser.last_event == events[-1]
+
+
+def test_error_keeps_tail():
+    parser = BuildEvents()
+    for i in range(TAIL_SIZE * 10):
+        parser.feed({'stream': 'line {}\n'.format(i)})
+    parser.feed({'stream': 'Successfully built 0123abcd\n'})
+    parser.feed({'error': 'no space left on device', 'errorDetail': {'message': 'no space left on device'}})
+    assert parser.error == 'no space left on device'
+    assert len(parser.tail) == TAIL_SIZE
+    assert parser.tail[-1] == 'Successfully built 0123abcd\n'
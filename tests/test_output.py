@@ -0,0 +1,57 @@
+import io
+import os
+
+from docker_multi_build.output import Output
+
+
+def test_lines_are_not_interleaved():
+    stream = io.StringIO()
+    with Output(stream, interval=0) as out:
+        out.write('image_a', 'Step 1/2 : ')
+        out.write('image_b', 'Step 1/1 : FROM busybox\n')
+        out.write('image_a', 'FROM busybox\nStep 2/2')
+        out.write('image_a', ' : RUN true\n')
+        out.write('image_b', 'no newline')
+    assert stream.getvalue().splitlines() == [
+        'image_b | Step 1/1 : FROM busybox',
+        'image_a | Step 1/2 : FROM busybox',
+        'image_a | Step 2/2 : RUN true',
+        'image_b | no newline',
+    ]
+
+
+def test_rate_and_log_files(isolated_filesystem):
+    stream = io.StringIO()
+    with Output(stream, log_dir='logs', rate=2, interval=0) as out:
+        out.write('image_a', ''.join('line {}\n'.format(i) for i in range(5)))
+        out.write('org/image_b:latest', 'beep\n')
+    assert stream.getvalue().splitlines() == [
+        'image_a | line 0',
+        'image_a | line 1',
+        'org/image_b:latest | beep',
+        'image_a | ... 3 lines skipped',
+    ]
+    assert sorted(os.listdir('logs')) == ['image_a.log', 'org_image_b_latest.log']
+    assert isolated_filesystem.join('logs', 'image_a.log').read().splitlines() == [
+        'line {}'.format(i) for i in range(5)]
+
+
+def test_tty_shows_latest_lines():
+    stream = io.StringIO()
+    out = Output(stream, tty=True)
+    out.write_lines([('image_a', 'Step 1/2'), ('image_b', 'Step 1/1'), ('image_a', 'Step 2/2')])
+    out.write_lines([('image_b', 'Successfully built 0123abcd')])
+    first, second = stream.getvalue().split('\x1b[2F')
+    assert first == '\x1b[2Kimage_a | Step 2/2\n\x1b[2Kimage_b | Step 1/1\n'
+    assert second == '\x1b[2Kimage_a | Step 2/2\n\x1b[2Kimage_b | Successfully built 0123abcd\n'
+
+
+def test_tty_fits_the_terminal(monkeypatch):
+    monkeypatch.setattr('shutil.get_terminal_size', lambda: os.terminal_size((80, 3)))
+    stream = io.StringIO()
+    out = Output(stream, tty=True)
+    out.write_lines([('image_a', 'beep'), ('image_b', 'beep'), ('image_c', 'beep')])
+    out.write_lines([('image_d', 'boop')])
+    first, second = stream.getvalue().split('\x1b[2F')
+    assert first == '\x1b[2Kimage_b | beep\n\x1b[2Kimage_c | beep\n'
+    assert second == '\x1b[2Kimage_c | beep\n\x1b[2Kimage_d | boop\n'
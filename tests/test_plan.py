@@ -0,0 +1,97 @@
+import json
+import os
+import subprocess
+import sys
+
+from click.testing import CliRunner
+
+import docker_multi_build
+from docker_multi_build.cli import cli
+from docker_multi_build.config import BuildConfig, Dockerfile
+from docker_multi_build.plan import make_plan
+from docker_multi_build.sort_configs import sort_configs
+
+
+MULTI_BUILD = """\
+base:
+  dockerfile: !inline |
+    FROM busybox
+wheel:
+  dockerfile: !inline |
+    FROM base
+app:
+  dockerfile: !inline |
+    FROM base
+final:
+  dockerfile: !inline |
+    FROM wheel
+"""
+
+
+def test_make_plan():
+    configs = [
+        BuildConfig('base', dockerfile=Dockerfile('FROM busybox')),
+        BuildConfig('wheel', dockerfile=Dockerfile('FROM base')),
+        BuildConfig('app', dockerfile=Dockerfile('FROM base')),
+        BuildConfig('final', dockerfile=Dockerfile('FROM wheel')),
+        BuildConfig('lonely', dockerfile=Dockerfile('FROM busybox')),
+    ]
+    all_dependents = sort_configs(configs)
+
+    plan = make_plan(all_dependents)
+    assert plan.order == list(all_dependents)
+    assert sorted(map(sorted, plan.levels)) == [['app', 'wheel'], ['base', 'lonely'], ['final']]
+    assert plan.levels[2] == ['final']
+    assert plan.critical_path == ['base', 'wheel', 'final']
+    assert plan.widest_level == 2
+    assert plan.parallelism == 5 / 3
+
+    plan = make_plan(all_dependents, {'base': 1, 'wheel': 1, 'app': 10, 'final': 1, 'lonely': 1})
+    assert plan.critical_path == ['base', 'app']
+    assert plan.parallelism == 14 / 11
+
+
+def test_widest_level():
+    # b, c and d can build at the same time, though d is on another level
+    configs = [
+        BuildConfig('a', dockerfile=Dockerfile('FROM busybox')),
+        BuildConfig('b', dockerfile=Dockerfile('FROM a')),
+        BuildConfig('c', dockerfile=Dockerfile('FROM a')),
+        BuildConfig('d', dockerfile=Dockerfile('FROM busybox')),
+    ]
+    plan = make_plan(sort_configs(configs))
+    assert sorted(map(sorted, plan.levels)) == [['a', 'd'], ['b', 'c']]
+    assert plan.widest_level == 2
+    assert plan.dump()['widest_level'] == 2
+
+
+def test_plan_command(isolated_filesystem):
+    isolated_filesystem.join('docker-multi-build.yml').write(MULTI_BUILD)
+    result = CliRunner().invoke(cli, ['plan', '--format', 'json', 'final'])
+    assert result.exit_code == 0, result.output
+    assert json.loads(result.output)['order'] == ['base', 'wheel', 'final']
+
+    result = CliRunner().invoke(cli, ['plan'])
+    assert result.exit_code == 0, result.output
+    assert 'Critical path: base -> wheel -> final' in result.output
+    assert 'widest level: 2' in result.output
+
+
+def test_plan_does_not_import_docker(isolated_filesystem):
+    isolated_filesystem.join('docker-multi-build.yml').write(MULTI_BUILD)
+    code = ('import sys\n'
+            'from docker_multi_build.cli import cli\n'
+            'try:\n'
+            '    cli(["plan"])\n'
+            'except SystemExit as exc:\n'
+            '    assert not exc.code\n'
+            'assert "docker" not in sys.modules\n')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(docker_multi_build.__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    subprocess.check_call([sys.executable, '-c', code], stdout=subprocess.DEVNULL, env=env)
+
+
+def test_build_is_default_command(isolated_filesystem):
+    result = CliRunner().invoke(cli, ['-f', 'missing.yml', 'app'])
+    assert result.exit_code == 2
+    assert 'missing.yml' in result.output
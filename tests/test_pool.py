@@ -0,0 +1,45 @@
+import threading
+
+from docker_multi_build.pool import CALL, STREAM, ClientPool
+
+
+def test_clients_are_reused():
+    created = []
+
+    def factory():
+        created.append(object())
+        return created[-1]
+
+    clients = ClientPool(factory, size=2)
+    with clients.lease(STREAM) as a:
+        with clients.lease(STREAM) as b:
+            assert a is not b
+    with clients.lease(STREAM) as c:
+        assert c in (a, b)
+    # Short calls don't share clients with streams
+    with clients.lease(CALL) as d:
+        assert d not in (a, b)
+    assert clients.stats() == {
+        STREAM: {'created': 2, 'leases': 3, 'reuses': 1, 'waits': 0},
+        CALL: {'created': 1, 'leases': 1, 'reuses': 0, 'waits': 0},
+    }
+
+
+def test_lease_waits_for_idle_client():
+    clients = ClientPool(object, size=1)
+    leased = threading.Event()
+    release = threading.Event()
+
+    def stream():
+        with clients.lease(STREAM):
+            leased.set()
+            release.wait(timeout=5)
+
+    thread = threading.Thread(target=stream)
+    thread.start()
+    assert leased.wait(timeout=5)
+    threading.Timer(0.05, release.set).start()
+    with clients.lease(STREAM):
+        pass
+    thread.join()
+    assert clients.stats()[STREAM] == {'created': 1, 'leases': 2, 'reuses': 1, 'waits': 1}
@@ -0,0 +1,132 @@
+import threading
+import time
+
+from docker_multi_build.build import Builder
+from docker_multi_build.config import BuildConfig, Dockerfile
+from docker_multi_build.prefetch import Prefetcher, external_base_images
+
+
+class FakePull:
+    def __init__(self, present=(), barrier=None, errors=None):
+        self.present = set(present)
+        self.barrier = barrier
+        self.errors = errors or {}
+        self.pulled = []
+        self.lock = threading.Lock()
+
+    def exists(self, image):
+        return image in self.present
+
+    def pull(self, image):
+        with self.lock:
+            self.pulled.append(image)
+        if self.barrier is not None:
+            self.barrier.wait(timeout=5)
+        yield {'status': 'Pulling from library/' + image.split(':')[0], 'id': 'latest'}
+        yield {'status': 'Downloading', 'progressDetail': {'current': 1, 'total': 2}, 'id': 'ab12'}
+        if image in self.errors:
+            yield {'error': self.errors[image]}
+            return
+        yield {'status': 'Pull complete', 'progressDetail': {}, 'id': 'ab12'}
+        self.present.add(image)
+
+
+class FakeOutput:
+    def __init__(self):
+        self.lines = []
+
+    def write(self, tag, text):
+        self.lines.append((tag, text.rstrip('\n')))
+
+
+def test_external_base_images():
+    configs = {
+        'base': BuildConfig('base', dockerfile=Dockerfile('FROM python:3.6-alpine')),
+        'app': BuildConfig('app', dockerfile=Dockerfile('FROM base')),
+        'tagged': BuildConfig('tagged', dockerfile=Dockerfile('FROM base:latest')),
+        'other': BuildConfig('other', dockerfile=Dockerfile('FROM python:3.6-alpine')),
+        'pinned': BuildConfig('pinned', dockerfile=Dockerfile('FROM busybox@sha256:abcd')),
+        'empty': BuildConfig('empty', dockerfile=Dockerfile('FROM scratch')),
+        'arg': BuildConfig('arg', dockerfile=Dockerfile('ARG VERSION\nFROM python:${VERSION}')),
+    }
+    assert external_base_images(configs) == ['python:3.6-alpine', 'busybox@sha256:abcd']
+
+
+def test_prefetcher_pulls_concurrently():
+    # Both pulls have to run at the same time to pass the barrier
+    backend = FakePull(present={'busybox'}, barrier=threading.Barrier(2))
+    output = FakeOutput()
+    with Prefetcher(backend, output=output) as prefetcher:
+        prefetcher.start(['python:3.6-alpine', 'busybox', 'alpine'])
+        prefetcher.start(['alpine'])
+        prefetcher.wait(['python:3.6-alpine', 'alpine', 'unknown'])
+        prefetcher.wait(['busybox'])
+
+    assert sorted(backend.pulled) == ['alpine', 'python:3.6-alpine']
+    alpine_lines = [line for tag, line in output.lines if tag == 'alpine']
+    assert alpine_lines[:-1] == ['Pulling alpine', 'latest: Pulling from library/alpine', 'ab12: Pull complete']
+    assert alpine_lines[-1].startswith('Pulled alpine in ')
+    assert not any(tag == 'busybox' for tag, line in output.lines)
+
+
+def test_prefetcher_reports_failures():
+    backend = FakePull(errors={'private/image': 'pull access denied'})
+    output = FakeOutput()
+    with Prefetcher(backend, output=output) as prefetcher:
+        prefetcher.start(['private/image'])
+        prefetcher.wait(['private/image'])
+    assert output.lines[-1] == ('private/image', 'Failed to pull private/image: pull access denied')
+
+
+def test_builder_waits_for_prefetch(isolated_filesystem):
+    events = []
+
+    class SlowPull(FakePull):
+        def pull(self, image):
+            time.sleep(0.05)
+            events.append('pull ' + image)
+            yield {'status': 'Downloaded newer image for ' + image}
+
+    class FakeAPI:
+        def build(self, fileobj, **kwargs):
+            b''.join(fileobj)
+            events.append('build ' + kwargs['tag'])
+            return 'sha256:' + kwargs['tag']
+
+    class FakeClient:
+        api = FakeAPI()
+        images = {}
+
+    with Prefetcher(SlowPull(), output=FakeOutput()) as prefetcher:
+        prefetcher.start(['python:3.6-alpine'])
+        builder = Builder(client=FakeClient(), prefetcher=prefetcher)
+        builder.config = BuildConfig('app', dockerfile=Dockerfile('FROM python:3.6-alpine', name='Dockerfile'))
+        builder.build_image()
+    assert events == ['pull python:3.6-alpine', 'build app']
+
+
+def test_builder_pulls_cache_images(isolated_filesystem):
+    builds = []
+
+    class FakeAPI:
+        def build(self, fileobj, **kwargs):
+            b''.join(fileobj)
+            builds.append(kwargs)
+            return 'sha256:' + kwargs['tag']
+
+    class FakeClient:
+        api = FakeAPI()
+        images = {}
+
+    backend = FakePull(present={'localhost:5000/cache/base'})
+    with Prefetcher(backend, output=FakeOutput()) as prefetcher:
+        builder = Builder(client=FakeClient(), prefetcher=prefetcher, cache_registry='localhost:5000/cache')
+        builder.config = BuildConfig('base', dockerfile=Dockerfile('FROM busybox', name='Dockerfile'))
+        builder.build_image()
+        builder.config = BuildConfig('app', dockerfile=Dockerfile('FROM base', name='Dockerfile'),
+                                     cache_from=['app:previous', 'app:latest'])
+        builder.build_image()
+    # Base images are pulled only ahead of the builds
+    assert sorted(backend.pulled) == ['app:latest', 'app:previous']
+    assert [kwargs['cache_from'] for kwargs in builds] == [['localhost:5000/cache/base'],
+                                                           ['app:previous', 'app:latest']]
@@ -0,0 +1,83 @@
+import os
+import subprocess
+
+import pytest
+
+from docker_multi_build import config
+from docker_multi_build.selection import SelectionError, changed_since, outside_dependencies, select, subgraph
+from docker_multi_build.sort_configs import sort_configs
+
+
+MULTI_BUILD = """\
+base:
+  dockerfile: !inline |
+    FROM busybox
+  context: base
+  exports:
+    - /out/.:dist
+wheel:
+  dockerfile: !inline |
+    FROM busybox
+    COPY dist/ /dist/
+  context: wheel
+app:
+  dockerfile: !inline |
+    FROM base
+  context: app
+lonely:
+  dockerfile: {lonely}
+  context: lonely
+"""
+
+
+def load(contents):
+    with open('docker-multi-build.yml', 'w') as fp:
+        fp.write(contents)
+    with open('docker-multi-build.yml') as fp:
+        configs = config.load(fp)
+    return configs, sort_configs(list(configs.values()))
+
+
+def test_select(isolated_filesystem):
+    os.makedirs('lonely')
+    isolated_filesystem.join('lonely', 'Dockerfile').write('FROM busybox')
+    configs, all_dependents = load(MULTI_BUILD.format(lonely='Dockerfile'))
+
+    assert select(configs, all_dependents) == configs
+    assert set(select(configs, all_dependents, ['wheel'])) == {'base', 'wheel'}
+    assert set(select(configs, all_dependents, ['app', 'lonely'])) == {'base', 'app', 'lonely'}
+    assert set(select(configs, all_dependents, changed={'base'})) == {'base', 'wheel', 'app'}
+    assert set(select(configs, all_dependents, ['wheel'], changed={'wheel', 'lonely'})) == {'wheel'}
+    with pytest.raises(SelectionError):
+        select(configs, all_dependents, ['blarp'])
+
+    assert subgraph(all_dependents, {'base', 'wheel'}) == sort_configs([configs['base'], configs['wheel']])
+    assert outside_dependencies(all_dependents, {'wheel', 'app'}) == {'base'}
+    assert outside_dependencies(all_dependents, {'base', 'app', 'lonely'}) == set()
+
+
+def test_changed_since(isolated_filesystem):
+    def git(*args):
+        subprocess.check_call(['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com'] + list(args))
+
+    for context in ['base', 'wheel', 'app', 'lonely']:
+        os.makedirs(context)
+        isolated_filesystem.join(context, 'beep.txt').write('beep')
+    isolated_filesystem.join('lonely', 'Dockerfile').write('FROM busybox')
+    isolated_filesystem.join('app', '.dockerignore').write('*.log')
+    configs, _ = load(MULTI_BUILD.format(lonely='Dockerfile'))
+    git('init', '-q')
+    git('add', '.')
+    git('commit', '-q', '-m', 'Initial')
+    assert changed_since(configs, 'HEAD', 'docker-multi-build.yml') == set()
+
+    # Ignored and untracked files
+    isolated_filesystem.join('app', 'build.log').write('boop')
+    isolated_filesystem.join('wheel', 'new.txt').write('boop')
+    assert changed_since(configs, 'HEAD', 'docker-multi-build.yml') == {'wheel'}
+
+    # Modified context file, Dockerfile and in-line Dockerfile
+    isolated_filesystem.join('base', 'beep.txt').write('boop')
+    isolated_filesystem.join('lonely', 'Dockerfile').write('FROM alpine')
+    configs, _ = load(MULTI_BUILD.format(lonely='Dockerfile').replace('FROM base', 'FROM base\n    RUN true'))
+    assert changed_since(configs, 'HEAD', 'docker-multi-build.yml') == {'base', 'wheel', 'app', 'lonely'}
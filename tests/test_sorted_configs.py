@@ -1,8 +1,9 @@
 import attr
+import pytest
 
 from docker_multi_build.config import BuildConfig, Dockerfile, BuildExport
 from docker_multi_build.sort_configs import (
-    get_copied_paths, is_exported_file_copied, get_base_image, sort_configs)
+    DependencyError, get_copied_paths, is_exported_file_copied, get_base_image, sort_configs)
 
 
 def test_get_copied_paths():
@@ -139,3 +140,31 @@ RUN virtualenv py27 \
         'build_dep_wheels',
         'image_a',
     ]
+
+
+def test_sort_configs_deep_chain():
+    # Deeper than the recursion limit
+    configs = [BuildConfig('image_0', dockerfile=Dockerfile('FROM busybox'))]
+    for i in range(1, 3000):
+        configs.append(BuildConfig('image_{}'.format(i),
+                                   dockerfile=Dockerfile('FROM image_{}\nCOPY {}_out/ /'.format(i - 1, i - 1)),
+                                   exports=[BuildExport('/out/.', '{}_out'.format(i))]))
+    configs.reverse()
+    sorted_configs = sort_configs(configs)
+    assert list(sorted_configs) == ['image_{}'.format(i) for i in range(3000)]
+    assert [c.tag for c in sorted_configs['image_1']] == ['image_2']
+
+
+def test_sort_configs_circular_dependency():
+    configs = [
+        BuildConfig('image_a', dockerfile=Dockerfile('FROM image_b')),
+        BuildConfig('image_b', dockerfile=Dockerfile('FROM image_a')),
+    ]
+    with pytest.raises(DependencyError) as exc_info:
+        sort_configs(configs)
+    assert 'Circular dependency' in str(exc_info.value)
+
+    configs = [BuildConfig('image_a', dockerfile=Dockerfile('FROM image_a'))]
+    with pytest.raises(DependencyError) as exc_info:
+        sort_configs(configs)
+    assert 'can not be based on itself' in str(exc_info.value)
@@ -0,0 +1,34 @@
+import io
+import os
+
+from docker_multi_build.state import State, default_path
+
+
+def test_default_path():
+    assert default_path(io.StringIO()) is None
+
+    class NamedStream:
+        name = 'blarp/docker-multi-build.yml'
+
+    assert default_path(NamedStream()) == 'blarp/.docker-multi-build/state.json'
+
+
+def test_load_save(isolated_filesystem):
+    path = os.path.join('.docker-multi-build', 'state.json')
+    state = State.load(path)
+    assert state == State(path)
+
+    state.durations['image_a'] = 1.5
+    state.save()
+    assert State.load(path) == State(path, durations={'image_a': 1.5})
+
+    # State without a path is kept in memory only
+    State.load(None).save()
+    assert os.listdir('.docker-multi-build') == ['state.json']
+
+
+def test_load_corrupt(isolated_filesystem):
+    path = os.path.join('.docker-multi-build', 'state.json')
+    os.makedirs('.docker-multi-build')
+    isolated_filesystem.join(path).write('{"durations": {"image_a"')
+    assert State.load(path) == State(path)
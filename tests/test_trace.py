@@ -0,0 +1,54 @@
+import json
+import threading
+
+from docker_multi_build.build import MultiBuilder
+from docker_multi_build.config import BuildConfig, Dockerfile
+from docker_multi_build.sort_configs import sort_configs
+from docker_multi_build.trace import Tracer
+
+
+def test_save(isolated_filesystem):
+    tracer = Tracer()
+    with tracer.span('build_image', 'image_a') as args:
+        args['time_to_first_event'] = 0.5
+    thread = threading.Thread(target=tracer.add, args=('queue', 1, 2, 'image_b'), name='worker')
+    thread.start()
+    thread.join()
+    tracer.metadata['client_pools'] = {'default': {'stream': {'waits': 0}}}
+    tracer.save('trace.json')
+
+    with open('trace.json') as fp:
+        data = json.load(fp)
+    events = data['traceEvents']
+    assert data['otherData'] == {'client_pools': {'default': {'stream': {'waits': 0}}}}
+    spans = [event for event in events if event['ph'] == 'X']
+    names = {event['tid']: event['args']['name'] for event in events if event['ph'] == 'M'}
+    assert [span['name'] for span in spans] == ['build_image image_a', 'queue image_b']
+    assert spans[0]['args'] == {'tag': 'image_a', 'time_to_first_event': 0.5}
+    assert spans[1]['dur'] == 1e6
+    assert names[spans[1]['tid']] == 'worker'
+
+
+def test_disabled():
+    tracer = Tracer(enabled=False)
+    with tracer.span('build_image', 'image_a'):
+        pass
+    tracer.add('queue', 1, 2)
+    assert tracer.events == []
+
+
+def test_multi_builder_queue_wait():
+    configs = {
+        'image_a': BuildConfig('image_a', dockerfile=Dockerfile('FROM busybox')),
+        'image_b': BuildConfig('image_b', dockerfile=Dockerfile('FROM busybox')),
+    }
+
+    class FakeBuilder:
+        def build(self, config, export=True):
+            pass
+
+    tracer = Tracer()
+    mb = MultiBuilder(builder=FakeBuilder(), jobs=1, tracer=tracer)
+    mb.build_all(configs, sort_configs(list(configs.values())))
+    queued = sorted(event['args']['tag'] for event in tracer.events if event.get('cat') == 'queue')
+    assert queued == ['image_a', 'image_b']
@@ -0,0 +1,152 @@
+import os
+import threading
+
+import pytest
+
+from docker_multi_build import config
+from docker_multi_build.sort_configs import sort_configs
+from docker_multi_build.watch import IN_CREATE, Inotify, Watcher, WatchError
+
+
+MULTI_BUILD = """\
+base:
+  dockerfile: !inline |
+    FROM busybox
+  context: base
+  exports:
+    - /out/.:lonely/out
+app:
+  dockerfile: !inline |
+    FROM base
+  context: app
+lonely:
+  dockerfile: Dockerfile
+  context: lonely
+"""
+
+
+@pytest.fixture
+def inotify():
+    inotify = Inotify()
+    try:
+        inotify.open()
+    except WatchError:
+        pytest.skip('inotify is not available')
+    yield inotify
+    inotify.close()
+
+
+def test_inotify(isolated_filesystem, inotify):
+    os.mkdir('dir')
+    path = os.path.realpath('dir')
+    inotify.add_watch(path)
+    assert inotify.read(timeout=0) == []
+
+    isolated_filesystem.join('dir', 'file').write('boop')
+    events = inotify.read(timeout=1)
+    assert (os.path.join(path, 'file'), IN_CREATE) in events
+
+
+def test_watcher(isolated_filesystem, inotify):
+    for context in ['base', 'app', 'lonely']:
+        os.makedirs(context)
+    isolated_filesystem.join('lonely', 'Dockerfile').write('FROM busybox')
+    isolated_filesystem.join('docker-multi-build.yml').write(MULTI_BUILD)
+    with open('docker-multi-build.yml') as fp:
+        configs = config.load(fp)
+
+    rounds = []
+    first_round_done = threading.Event()
+
+    def build(configs, all_dependents, built):
+        rounds.append((sorted(set(configs) - set(built)), built))
+        first_round_done.set()
+        return {tag: 'sha256:{}{}'.format(tag, len(rounds)) for tag in configs}
+
+    def change():
+        assert first_round_done.wait(timeout=5)
+        # Exports don't trigger builds
+        os.makedirs('lonely/out')
+        isolated_filesystem.join('lonely', 'out', 'wheel').write('exported')
+        isolated_filesystem.join('base', 'file').write('changed')
+
+    watcher = Watcher('docker-multi-build.yml', configs, sort_configs(list(configs.values())), build,
+                      inotify=inotify, delay=0.05, echo=lambda message: None)
+    thread = threading.Thread(target=change)
+    thread.start()
+    watcher.run(rounds=2)
+    thread.join()
+
+    assert rounds[0] == (['app', 'base', 'lonely'], {})
+    assert rounds[1] == (['app', 'base'], {'lonely': 'sha256:lonely1'})
+
+
+def test_watcher_reloads_dockerfiles(isolated_filesystem, inotify):
+    for context in ['base', 'app', 'lonely']:
+        os.makedirs(context)
+    isolated_filesystem.join('lonely', 'Dockerfile').write('FROM busybox')
+    isolated_filesystem.join('docker-multi-build.yml').write(MULTI_BUILD)
+    with open('docker-multi-build.yml') as fp:
+        configs = config.load(fp)
+
+    rounds = []
+    first_round_done = threading.Event()
+
+    def build(configs, all_dependents, built):
+        rounds.append(sorted(set(configs) - set(built)))
+        first_round_done.set()
+        return {tag: 'sha256:' + tag for tag in configs}
+
+    def change():
+        assert first_round_done.wait(timeout=5)
+        isolated_filesystem.join('lonely', 'Dockerfile').write('FROM alpine')
+
+    watcher = Watcher('docker-multi-build.yml', configs, sort_configs(list(configs.values())), build,
+                      inotify=inotify, delay=0.05, echo=lambda message: None)
+    thread = threading.Thread(target=change)
+    thread.start()
+    watcher.run(rounds=2)
+    thread.join()
+
+    assert rounds[1] == ['lonely']
+    assert watcher.configs['lonely'].dockerfile.contents == 'FROM alpine'
+
+
+def test_watcher_ignores_exported_files_only(isolated_filesystem, inotify):
+    os.makedirs('src')
+    os.makedirs('wheels')
+    isolated_filesystem.join('docker-multi-build.yml').write(
+        'app:\n'
+        '  dockerfile: !inline |\n'
+        '    FROM busybox\n'
+        '  exports:\n'
+        '    - /out/dumb-init_1.2.0_amd64:.\n'
+        '    - /out/.:dist\n'
+        '    - /out/wheel:wheels\n'
+        '    - /out/.:.\n')
+    with open('docker-multi-build.yml') as fp:
+        configs = config.load(fp)
+
+    rounds = []
+    first_round_done = threading.Event()
+
+    def build(configs, all_dependents, built):
+        rounds.append(sorted(set(configs) - set(built)))
+        first_round_done.set()
+        return {tag: 'sha256:' + tag for tag in configs}
+
+    def change():
+        assert first_round_done.wait(timeout=5)
+        isolated_filesystem.join('dumb-init_1.2.0_amd64').write('exported')
+        isolated_filesystem.join('src', 'a.py').write('changed')
+
+    watcher = Watcher('docker-multi-build.yml', configs, sort_configs(list(configs.values())), build,
+                      inotify=inotify, delay=0.05, echo=lambda message: None)
+    assert watcher.ignored_paths() == {os.path.realpath(path) for path in [
+        'dumb-init_1.2.0_amd64', 'dist', 'wheels/wheel', 'Dockerfile.app']}
+    thread = threading.Thread(target=change)
+    thread.start()
+    watcher.run(rounds=2)
+    thread.join()
+
+    assert rounds == [['app'], ['app']]